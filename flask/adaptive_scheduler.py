@@ -0,0 +1,85 @@
+# adaptive_scheduler.py
+import asyncio
+import time
+
+
+class AdaptiveScheduler:
+    """
+    Periodo di polling adattivo per il ciclo di controllo.
+      - veloce (min_period) se la potenza prelevata è vicina al limite
+        (max_power - grid_power <= near_limit_w, in W: vale anche per limiti
+        zero o negativi, es. ricarica solo da fotovoltaico) o mentre un
+        comando si assesta
+      - normale (base_period) quando qualcosa cambia
+      - in attesa senza variazioni (ricarica ferma, potenza stabile) il periodo
+        cresce di 'backoff' a ogni ciclo fino a max_period
+    wait() dorme fino a una scadenza assoluta (monotonic): la durata del ciclo
+    non si somma al periodo; se un ciclo sfora, si riparte da adesso senza
+    recuperare i cicli persi.
+    """
+    def __init__(self, logger, min_period=3, base_period=30, max_period=120,
+                 near_limit_w=500, settle_s=20, idle_delta_w=100, backoff=1.5):
+        self.logger = logger
+        self.min_period = min_period
+        self.base_period = base_period
+        self.max_period = max_period
+        self.near_limit_w = near_limit_w
+        self.settle_s = settle_s
+        self.idle_delta_w = idle_delta_w
+        self.backoff = backoff
+
+        self.period = base_period
+        self._deadline = None
+        self._settle_until = 0.0
+        self._last_grid_power = None
+        self.stats = {"cycles": 0, "overruns": 0}
+
+    def start(self):
+        """Prima scadenza: inizio del primo ciclo."""
+        self._deadline = time.monotonic()
+
+    def note_command(self):
+        """Un comando è stato inviato: polling veloce finché si assesta."""
+        self._settle_until = time.monotonic() + self.settle_s
+
+    def update(self, grid_power=None, max_power=None, active=True):
+        """
+        Calcola il periodo del prossimo ciclo.
+        grid_power / max_power: None se i dati non sono disponibili.
+        active: False se la ricarica è ferma e non c'è nulla da controllare.
+        """
+        now = time.monotonic()
+        delta = None
+        if grid_power is not None and self._last_grid_power is not None:
+            delta = abs(grid_power - self._last_grid_power)
+        if grid_power is not None:
+            self._last_grid_power = grid_power
+
+        if now < self._settle_until:
+            period = self.min_period
+        elif grid_power is not None and max_power is not None and max_power - grid_power <= self.near_limit_w:
+            period = self.min_period
+        elif grid_power is None:
+            period = self.base_period
+        elif not active and delta is not None and delta < self.idle_delta_w:
+            period = min(max(self.period, self.base_period) * self.backoff, self.max_period)
+        else:
+            period = self.base_period
+
+        if period != self.period:
+            self.logger.info(f"⏱️ Periodo di polling: {self.period:.0f} s → {period:.0f} s")
+        self.period = period
+        return period
+
+    async def wait(self):
+        """Dorme fino alla prossima scadenza assoluta."""
+        now = time.monotonic()
+        if self._deadline is None:
+            self._deadline = now
+        self._deadline += self.period
+        self.stats["cycles"] += 1
+        if self._deadline <= now:
+            self.stats["overruns"] += 1
+            self._deadline = now
+            return
+        await asyncio.sleep(self._deadline - now)
@@ -1,101 +1,171 @@
 import os
-import io
 import json
-import ssl
-from unittest import result
-import requests
 import traceback
 import logging
 import asyncio
-import asyncssh # type: ignore
-import mysql.connector # type: ignore
-import aiohttp
 import time
-import socket
 import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import signal
+import sys
 
-from filelock import FileLock, Timeout
-from datetime import datetime
+from datetime import datetime, timedelta
 from logging.handlers import TimedRotatingFileHandler
 from flask import Flask, request, jsonify, Response
-from datetime import datetime
-from mysql.connector import Error # type: ignore
-from datetime import datetime, timedelta
 from flask_cors import CORS # type: ignore
 from flask_cors import cross_origin # type: ignore
 #from scapy.all import ARP, Ether, srp # type: ignore
-from tesla_proxy import TeslaProxy
+from lazy import Lazy, lazy_module, is_loaded, resolve
+from write_behind import WriteBehindBuffer
+from spool import DurableSpool
+from charge_controller import ChargeController
+from tesla_command_queue import TeslaCommandQueue
+from adaptive_scheduler import AdaptiveScheduler
+from compression import SwingingDoor, DeadbandFilter, IntervalAggregator
+from rollups import RollupManager, ROLLUP_SOURCES, ROLLUP_LEVELS, rollup_table
+from schema import SchemaManager
+
+# Dipendenze pesanti importate al primo uso: i runner e i comandi una tantum
+# caricano solo ciò che usano davvero (tempi misurati da bench_startup.py)
+requests = lazy_module("requests")
+aiohttp = lazy_module("aiohttp")
+np = lazy_module("numpy")
+mysql_connector = lazy_module("mysql.connector")
+tesla_proxy = lazy_module("tesla_proxy")
+device_discovery = lazy_module("device_discovery")
+charging_solver = lazy_module("charging_solver")
+downsampling = lazy_module("downsampling")
+event_stream = lazy_module("event_stream")
 
 app = Flask(__name__)
 CORS(app, origins=["https://esprimo-grafana.sersebasti.com"])
 
 # Percorso al file di configurazione
-config_path = "/app/config.json"
+CONFIG_PATH = "/app/config.json"
+LOCK_PATH = CONFIG_PATH + ".lock"
+config_path = CONFIG_PATH
 
-# Carica la configurazione
-with open(config_path, "r") as f:
-    CONFIG = json.load(f)
-    
-    
-    
-CLIENT_ID = CONFIG["CLIENT_ID"]
-CLIENT_SECRET = CONFIG["CLIENT_SECRET"]
-REDIRECT_URI = CONFIG["REDIRECT_URI"]
-TOKEN_URL = CONFIG["TOKEN_URL"]
-VIN = CONFIG["VIN"]
-MAX_ENERGY_PRELEVABILE = CONFIG["MAX_ENERGY_PRELEVABILE"]
-STATE = CONFIG["STATE"]
-SHELLY_MAC = CONFIG["SHELLY_MAC"]
-SHELLY_IP = CONFIG["SHELLY_IP"]
-ESP8266_IP = CONFIG["ESP8266_IP"]
-ESP8266_NAME = CONFIG["ESP8266_NAME"]
-ESP32_IP_1 = CONFIG["ESP32_IP_1"]
-ESP32_MAC_1 = CONFIG["ESP32_MAC_1"]
-    
-# Verifica se la directory esiste, altrimenti la crea
-log_directory = "/app/logs"
-os.makedirs(log_directory, exist_ok=True)
+# Configurazione, caricata da init()
+CONFIG = {}
 
-# Directory per i dati
+ESP8266_TOKEN = "Merca10tello"
+
+log_directory = "/app/logs"
 data_directory = "/app/data"
-os.makedirs(data_directory, exist_ok=True)
 
-# Configura il logger
 logger = logging.getLogger("TeslaProxy")
-logger.setLevel(logging.DEBUG)
-
-# Imposta il gestore per creare un nuovo file ogni giorno
-handler = TimedRotatingFileHandler(
-    os.path.join(log_directory, "tesla_proxy.log"),
-    when="midnight",
-    interval=1,
-    backupCount=5
-)
 
-# Formato dei log
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
+_INITIALIZED = False
 
-# Aggiungi il gestore al logger
-logger.addHandler(handler)
 
-logger.info("Logger configurato con rotazione giornaliera.")
+def init(path=None, log_file=True):
+    """
+    Inizializzazione esplicita, da chiamare una volta nei punti di ingresso
+    (supervisor.py, wsgi.py, runner) prima di usare il modulo: legge la
+    configurazione, crea le directory e configura il log su file.
+    log_file=False (worker gunicorn): log su stderr, raccolto da gunicorn;
+    la rotazione di tesla_proxy.log resta al solo processo del supervisor.
+    L'import di app.py non ha effetti collaterali; i servizi condivisi
+    (pool MySQL, token, buffer live, ...) vengono creati al primo uso.
+    Le chiamate successive non hanno effetto.
+    """
+    global _INITIALIZED
+    if _INITIALIZED:
+        return
+    _load_config(path or os.getenv("CONFIG_PATH", CONFIG_PATH))
+    _setup_logging(log_file)
+    _INITIALIZED = True
+
+
+def _require_init():
+    return None if _INITIALIZED else "chiamare app.init() prima dell'uso"
+
+
+def _service(name, factory):
+    """Servizio condiviso creato al primo uso (dopo init())."""
+    return Lazy(factory, name, require=_require_init)
+
+
+def _load_config(path):
+    global config_path
+    global CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, TOKEN_URL, VIN, MAX_ENERGY_PRELEVABILE, STATE
+    global SHELLY_MAC, SHELLY_IP, ESP8266_IP, ESP8266_NAME, ESP32_IP_1, ESP32_MAC_1
+    global LAN_SUBNET, DISCOVERY_TIMEOUT, DISCOVERY_CONCURRENCY
+    global CHARGE_MIN_AMPS, CHARGE_MAX_AMPS, CHARGE_SAFETY_MARGIN_W, CHARGE_PHASES, SHELLY_GRID_PHASES
+    global LIVE_BUFFER_HOURS
+    global VOLTAGE_SAMPLE_PERIOD, VOLTAGE_COMPRESSION, VOLTAGE_DEVIATION, VOLTAGE_KEEPALIVE_S, VOLTAGE_STATS_INTERVAL
+
+    # Carica la configurazione
+    config_path = path
+    with open(config_path, "r") as f:
+        CONFIG.clear()
+        CONFIG.update(json.load(f))
+
+    CLIENT_ID = CONFIG["CLIENT_ID"]
+    CLIENT_SECRET = CONFIG["CLIENT_SECRET"]
+    REDIRECT_URI = CONFIG["REDIRECT_URI"]
+    TOKEN_URL = CONFIG["TOKEN_URL"]
+    VIN = CONFIG["VIN"]
+    MAX_ENERGY_PRELEVABILE = CONFIG["MAX_ENERGY_PRELEVABILE"]
+    STATE = CONFIG["STATE"]
+    SHELLY_MAC = CONFIG["SHELLY_MAC"]
+    SHELLY_IP = CONFIG["SHELLY_IP"]
+    ESP8266_IP = CONFIG["ESP8266_IP"]
+    ESP8266_NAME = CONFIG["ESP8266_NAME"]
+    ESP32_IP_1 = CONFIG["ESP32_IP_1"]
+    ESP32_MAC_1 = CONFIG["ESP32_MAC_1"]
+
+    # Parametri della scansione LAN dei dispositivi
+    LAN_SUBNET = CONFIG.get("LAN_SUBNET", "192.168.1.0/24")
+    DISCOVERY_TIMEOUT = float(CONFIG.get("DISCOVERY_TIMEOUT", 1.5))
+    DISCOVERY_CONCURRENCY = int(CONFIG.get("DISCOVERY_CONCURRENCY", 256))
+
+    # Parametri del calcolo della corrente di ricarica
+    CHARGE_MIN_AMPS = int(CONFIG.get("CHARGE_MIN_AMPS", 6))
+    CHARGE_MAX_AMPS = int(CONFIG.get("CHARGE_MAX_AMPS", 13))
+    CHARGE_SAFETY_MARGIN_W = float(CONFIG.get("CHARGE_SAFETY_MARGIN_W", 0))
+    CHARGE_PHASES = int(CONFIG.get("CHARGE_PHASES", 1))
+    # Fasi Shelly che misurano la rete (monofase: fase 2; trifase: tutte e tre)
+    SHELLY_GRID_PHASES = tuple(CONFIG.get("SHELLY_GRID_PHASES", [1] if CHARGE_PHASES == 1 else [0, 1, 2]))
+
+    # Ore di campioni nel buffer live
+    LIVE_BUFFER_HOURS = float(CONFIG.get("LIVE_BUFFER_HOURS", 6))
+
+    # Campionamento e compressione della tensione della batteria
+    VOLTAGE_SAMPLE_PERIOD = float(CONFIG.get("VOLTAGE_SAMPLE_PERIOD", 30))
+    VOLTAGE_COMPRESSION = CONFIG.get("VOLTAGE_COMPRESSION", "swinging_door")   # oppure "deadband"
+    VOLTAGE_DEVIATION = float(CONFIG.get("VOLTAGE_DEVIATION", 0.05))           # V
+    VOLTAGE_KEEPALIVE_S = float(CONFIG.get("VOLTAGE_KEEPALIVE_S", 600))
+    VOLTAGE_STATS_INTERVAL = int(CONFIG.get("VOLTAGE_STATS_INTERVAL", 300))
+
+
+def _setup_logging(log_file=True):
+    # Verifica se le directory di log e dati esistono, altrimenti le crea
+    os.makedirs(log_directory, exist_ok=True)
+    os.makedirs(data_directory, exist_ok=True)
+
+    if log_file:
+        # Imposta il gestore per creare un nuovo file ogni giorno
+        handler = TimedRotatingFileHandler(
+            os.path.join(log_directory, "tesla_proxy.log"),
+            when="midnight",
+            interval=1,
+            backupCount=5
+        )
+    else:
+        handler = logging.StreamHandler(sys.stderr)
 
-    
+    # Formato dei log
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+
+    # Aggiungi il gestore al logger
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+
+    logger.info("Logger configurato con rotazione giornaliera." if log_file else "Logger configurato su stderr.")
 
-def save_to_file(data, filename):
-    """Salva i dati in un file JSON."""
-    try:
-        file_path = os.path.join(data_directory, filename)
-        with open(file_path, 'w') as outfile:
-            json.dump(data, outfile, indent=4)
-        logger.info(f"Dati salvati correttamente in {file_path}")
-        
-        cleanup_old_files(data_directory, max_files=3)
-        
-        
-    except Exception as e:
-        logger.error(f"Errore nel salvataggio dei dati: {e}")
 
 @app.route('/.well-known/appspecific/com.tesla.3p.public-key.pem', methods=['GET'])
 def serve_public_key():
@@ -130,7 +200,7 @@ def callback():
         }
 
         logger.info("Invio richiesta POST a Tesla...")
-        response = requests.post(TOKEN_URL, data=payload)
+        response = requests.post(TOKEN_URL, data=payload, timeout=30)
         logger.info(f"Risposta ricevuta da Tesla: {response.status_code}")
         logger.debug(f"Risposta Tesla: {response.text}")
 
@@ -146,13 +216,9 @@ def callback():
         if response.status_code == 200:
             logger.info("Token ottenuto con successo.")
 
-            # Salva i dati nel file JSON
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"tesla_token_{timestamp}.json"
-            save_to_file(response_data, filename)
-            
-            # Salva anche con nome fisso per accesso rapido
-            save_to_file(response_data, "tesla_token_latest.json")
+            # Salva il token (scrittura atomica del file 'latest')
+            TOKEN_MANAGER.store(response_data)
+            filename = os.path.basename(TOKEN_MANAGER.token_file)
 
             return jsonify({
                 "success": True,
@@ -178,14 +244,12 @@ def callback():
         logger.error(traceback.format_exc())
         return jsonify({"success": False, "error": str(e)}), 500
 
-CONFIG_PATH = "/app/config.json"
-LOCK_PATH = CONFIG_PATH + ".lock"
-
 @app.route('/config_tesla', methods=['GET'])
 def handle_config():
     """
     Restituisce la configurazione come lista di dict {key, value}.
     """
+    from filelock import FileLock, Timeout
     lock = FileLock(LOCK_PATH, timeout=5)
     try:
         with lock:
@@ -218,6 +282,7 @@ def config_tesla_get():
     if not key or not value:
         return jsonify({"error": "Missing key or value"}), 400
 
+    from filelock import FileLock, Timeout
     lock = FileLock(LOCK_PATH, timeout=5)
     try:
         with lock:
@@ -268,6 +333,8 @@ def update_conf():
 
     # aggiorna DB
     conn, cursor = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database non disponibile"}), 503
     try:
         sql = f"""
             UPDATE conf
@@ -287,156 +354,107 @@ def update_conf():
         conn.close()
 
 
-def cleanup_old_files(directory, max_files=5, filter_func=None):
-    """
-    Mantiene al massimo 'max_files' file nella directory specificata.
-    Puoi fornire una funzione 'filter_func' per filtrare i file da mantenere.
-    """
-    try:
-        all_files = os.listdir(directory)
-
-        # Applica filtro, se fornito
-        if filter_func:
-            all_files = list(filter(filter_func, all_files))
-
-        # Ordina i file per data di modifica
-        all_files = sorted(
-            all_files,
-            key=lambda f: os.path.getmtime(os.path.join(directory, f))
-        )
-
-        # Rimuove i più vecchi se necessario
-        if len(all_files) > max_files:
-            to_delete = all_files[:-max_files]
-            for file_name in to_delete:
-                full_path = os.path.join(directory, file_name)
-                os.remove(full_path)
-                logger.info(f"File rimosso: {full_path}")
-
-    except Exception as e:
-        logger.error(f"Errore nella pulizia dei file: {e}")
-
-
-#def is_token_file(filename):
-#    return filename.startswith("tesla_token_") and filename.endswith(".json")
+def request_token_refresh(refresh_token_value):
+    """Richiesta HTTP di refresh a Tesla. Ritorna i nuovi dati del token o None."""
+    payload = {
+        "grant_type": "refresh_token",
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+        "refresh_token": refresh_token_value,
+        "scope": "openid vehicle_device_data vehicle_cmds vehicle_charging_cmds offline_access user_data",
+        "audience": "https://fleet-api.prd.eu.vn.cloud.tesla.com"
+    }
 
-def refresh_token():
-    latest_file = os.path.join(data_directory, "tesla_token_latest.json")
     try:
-        with open(latest_file, "r") as f:
-            token_data = json.load(f)
-
-        refresh_token_value = token_data.get("refresh_token")
-        if not refresh_token_value:
-            logger.error("❌ refresh_token non trovato.")
-            return False
-
-        payload = {
-            "grant_type": "refresh_token",
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "refresh_token": refresh_token_value,
-            "scope": "openid vehicle_device_data vehicle_cmds vehicle_charging_cmds offline_access user_data",
-            "audience": "https://fleet-api.prd.eu.vn.cloud.tesla.com"
-        }
-
         logger.info("🔄 Invio richiesta di refresh token a Tesla...")
-        response = requests.post(TOKEN_URL, data=payload)
+        response = requests.post(TOKEN_URL, data=payload, timeout=30)
         logger.info(f"✅ Risposta ricevuta: {response.status_code}")
 
         if response.status_code == 200:
-            new_token_data = response.json()
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            save_to_file(new_token_data, f"tesla_token_{timestamp}.json")
-            save_to_file(new_token_data, "tesla_token_latest.json")
-            logger.info("✅ Token aggiornato e salvato con successo.")
-            return True
-        else:
-            logger.error(f"❌ Errore nel refresh: {response.text}")
-            return False
+            return response.json()
+        logger.error(f"❌ Errore nel refresh: {response.text}")
+        return None
 
     except Exception as e:
         logger.error(f"❌ Eccezione durante il refresh: {str(e)}")
-        return False
+        return None
 
 
+def _build_token_manager():
+    from token_manager import TokenManager
+    return TokenManager(
+        token_file=os.path.join(data_directory, "tesla_token_latest.json"),
+        logger=logger,
+        request_refresh=request_token_refresh,
+        refresh_margin=float(CONFIG.get("TOKEN_REFRESH_MARGIN", 600))
+    )
 
-def get_access_token_from_file():
-    token_file = "/app/data/tesla_token_latest.json"
-    try:
-        with open(token_file, "r") as f:
-            data = json.load(f)
-            token = data.get("access_token")
-            if token:
-                return token
-            else:
-                logger.warning("⚠️ Nessun access_token trovato nel file.")
-    except Exception as e:
-        logger.error(f"❌ Errore lettura token da file: {e}")
-    return None
 
+# Token Tesla in memoria, con refresh proattivo prima della scadenza
+TOKEN_MANAGER = _service("TOKEN_MANAGER", _build_token_manager)
 
-async def get_vehicle_data(access_token: str):
 
+def refresh_token():
+    return TOKEN_MANAGER.refresh()
+
+
+def get_access_token_from_file():
+    return TOKEN_MANAGER.get_access_token()
+
+
+async def get_vehicle_data(access_token: str, session=None):
+    """
+    Legge vehicle_data dalla Fleet API. Se 'session' è fornita (es. la sessione
+    keep-alive di TeslaProxy) la riusa, altrimenti ne apre una temporanea.
+    """
     url = f"https://fleet-api.prd.eu.vn.cloud.tesla.com/api/1/vehicles/{VIN}/vehicle_data"
 
     headers = {
         "Authorization": f"Bearer {access_token}"
     }
-        
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url, headers=headers) as resp:
-                data = await resp.text()
-                logger.info(f"📡 Risposta get_vehicle_data HTTP: {resp.status}")
-                logger.debug(f"📥 Contenuto completo (raw):\n{data}")
-                return resp.status, data
-
-        except Exception as e:
-            logger.error(f"❌ Errore durante richiesta vehicle_data: {e}")
-            return None
+    if session is None:
+        async with aiohttp.ClientSession() as own_session:
+            return await get_vehicle_data(access_token, session=own_session)
+
+    try:
+        async with session.get(url, headers=headers) as resp:
+            data = await resp.text()
+            logger.info(f"📡 Risposta get_vehicle_data HTTP: {resp.status}")
+            logger.debug(f"📥 Contenuto completo (raw):\n{data}")
+            return resp.status, data
+
+    except Exception as e:
+        logger.error(f"❌ Errore durante richiesta vehicle_data: {e}")
+        return None, json.dumps({"error": str(e)})
 
 
 def insert_tesla_status(charging_amps: int, latitude: float = None, longitude: float = None, battery_level: int = None):
-    conn, cursor = get_db_connection()
-    if not conn:
-        return
+    # Costruzione dinamica delle colonne
+    columns = ["charging_amps"]
+    values = [charging_amps]
 
-    try:
-        # Costruzione dinamica della query
-        columns = ["charging_amps"]
-        values = [charging_amps]
-        placeholders = ["%s"]
-
-        if latitude is not None:
-            columns.append("latitude")
-            values.append(latitude)
-            placeholders.append("%s")
-
-        if longitude is not None:
-            columns.append("longitude")
-            values.append(longitude)
-            placeholders.append("%s")
-
-        if battery_level is not None:
-            columns.append("battery_level")
-            values.append(battery_level)
-            placeholders.append("%s")
-
-        query = f"INSERT INTO tesla_status ({', '.join(columns)}) VALUES ({', '.join(placeholders)})"
-        cursor.execute(query, values)
-        conn.commit()
+    if latitude is not None:
+        columns.append("latitude")
+        values.append(latitude)
 
-        logger.info(f"📥 Stato Tesla registrato nel DB: {dict(zip(columns, values))}")
-    except Error as e:
-        logger.error(f"❌ Errore durante l'inserimento nel DB: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+    if longitude is not None:
+        columns.append("longitude")
+        values.append(longitude)
+
+    if battery_level is not None:
+        columns.append("battery_level")
+        values.append(battery_level)
 
+    WRITE_BEHIND.add("tesla_status", columns, values)
+    logger.info(f"📥 Stato Tesla accodato per il DB: {dict(zip(columns, values))}")
 
-def fetch_shelly_data():
+
+# Timeout (s) delle richieste asincrone ai dispositivi
+DEVICE_TIMEOUT_S = 10
+
+
+async def fetch_shelly_data(session):
     if not SHELLY_IP:
         logger.error("❌ Indirizzo IP di Shelly non configurato.")
         return default_shelly_data()
@@ -444,12 +462,14 @@ def fetch_shelly_data():
     url = f"http://{SHELLY_IP}/status"
     logger.info(f"Richiesta a Shelly: {url}")
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        logger.info(f"Risposta Shelly: {response.status_code}")
+        async with session.get(url) as response:
+            response.raise_for_status()
+            data = json.loads(await response.text())
+            logger.info(f"Risposta Shelly: {response.status}")
+        DEVICES.mark_ok("shelly")
         return data.get("emeters", [])
-    except requests.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        DEVICES.mark_failure("shelly")
         logger.error(f"Errore nella richiesta a Shelly: {e}")
         logger.error("⚠️ Utilizzo dati di default per Shelly:\n" + json.dumps(default_shelly_data(), indent=2))
         return default_shelly_data()
@@ -477,16 +497,17 @@ def default_shelly_data():
     ]
 
 
-def fetch_esp8266_data():
+async def fetch_esp8266_data(session):
 
     url = f"http://{ESP8266_IP}/status"
     logger.info(f"Richiesta all'ESP8266: {url}")
 
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        logger.info(f"Risposta ESP8266: {response.status_code}")
+        async with session.get(url) as response:
+            response.raise_for_status()
+            data = json.loads(await response.text())
+            logger.info(f"Risposta ESP8266: {response.status}")
+        DEVICES.mark_ok("esp8266")
 
         if data.get("status") != "ok":
             logger.warning(f"⚠️ ESP8266 ha risposto ma con stato: {data.get('status')}")
@@ -494,7 +515,8 @@ def fetch_esp8266_data():
 
         return data
 
-    except requests.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        DEVICES.mark_failure("esp8266")
         logger.error(f"Errore nella richiesta all'ESP8266: {e}")
         return None
 
@@ -535,62 +557,466 @@ def store_data_in_db(emeters):
         logger.warning("⚠️ Nessun dato Shelly disponibile per il salvataggio.")
         return None
     
-    # Connessione al database
-    conn, cursor = get_db_connection()
-    if not conn:
-        logger.error("❌ Connessione al database fallita.")
-        return None
-    
-    
     try:
-        query = """
-            INSERT INTO shelly_emeters (timestamp, 
-                                        power_1, pf_1, current_1, voltage_1, total_1, total_returned_1,
-                                        power_2, pf_2, current_2, voltage_2, total_2, total_returned_2,
-                                        power_3, pf_3, current_3, voltage_3, total_3, total_returned_3)
-            VALUES (NOW(), %s, %s, %s, %s, %s, %s, 
-                        %s, %s, %s, %s, %s, %s, 
-                        %s, %s, %s, %s, %s, %s)
-        """
-        
-        
-        
         # Prende i valori delle tre fasi (o mette 0 se non disponibili)
         values = []
         for i in range(3):
             emeter = emeters[i] if i < len(emeters) else {"power": 0, "pf": 0, "current": 0, "voltage": 0, "total": 0, "total_returned": 0}
             values.extend([emeter["power"], emeter["pf"], emeter["current"], emeter["voltage"], emeter["total"], emeter["total_returned"]])
-        
-        #logger.debug(f"Query: {query}")
-        
-        cursor.execute(query, tuple(values))
-        conn.commit()
-        
-        logger.info("✅ Dati Shelly inseriti correttamente nel DB.")
+
+        WRITE_BEHIND.add("shelly_emeters", SHELLY_EMETERS_COLUMNS, values)
+        logger.info("✅ Dati Shelly accodati per il DB.")
     except Exception as e:
         logger.error(f"❌ Errore durante l'inserimento dei dati Shelly: {e}")
         return None
-    finally:
-        cursor.close()
-        conn.close()
 
     
 
-def get_db_connection(dictionary=False):
+def _build_db_pool(pool_name="energy_monitor", pool_size=None, acquire_timeout=None):
+    from db_pool import DbPool
+    return DbPool(
+        logger=logger,
+        pool_name=pool_name,
+        pool_size=pool_size or int(os.getenv("MYSQL_POOL_SIZE", "5")),
+        acquire_timeout=acquire_timeout or float(os.getenv("MYSQL_POOL_TIMEOUT", "5")),
+        host=os.getenv("MYSQL_HOST", "mysql"),
+        user=os.getenv("MYSQL_USER", "root"),
+        password=os.getenv("MYSQL_PASSWORD", "local"),
+        database=os.getenv("MYSQL_DATABASE", "dati")
+    )
+
+
+# Pool di connessioni MySQL condiviso da route Flask e logger
+DB_POOL = _service("DB_POOL", _build_db_pool)
+
+# Connessioni separate per manutenzione, export dell'archivio e rollup: query
+# lunghe che non devono togliere connessioni al ciclo di controllo (get_conf, ...).
+# Due connessioni: in rollup_runner.py schema e rollup hanno ciascuno un thread
+MAINTENANCE_DB_POOL = _service("MAINTENANCE_DB_POOL", lambda: _build_db_pool(
+    "energy_monitor_maintenance", pool_size=int(os.getenv("MAINTENANCE_POOL_SIZE", "2")),
+    acquire_timeout=float(os.getenv("MAINTENANCE_POOL_TIMEOUT", "60"))
+))
+
+
+def get_db_connection(dictionary=False, pool=DB_POOL):
+    """Preleva una connessione dal pool. conn.close() la restituisce al pool."""
+    conn = pool.acquire()
+    if conn is None:
+        return None, None
     try:
-        conn = mysql.connector.connect(
-            host=os.getenv("MYSQL_HOST", "mysql"),
-            user=os.getenv("MYSQL_USER", "root"),
-            password=os.getenv("MYSQL_PASSWORD", "local"),
-            database=os.getenv("MYSQL_DATABASE", "dati")
-        )
         cursor = conn.cursor(dictionary=dictionary)
         return conn, cursor
-    except mysql.connector.Error as e:
+    except mysql_connector.Error as e:
         logger.error(f"❌ Errore connessione al DB: {e}")
+        conn.close()
         return None, None
 
 
+def get_maintenance_connection():
+    """Connessione dal pool di manutenzione (schema, archivio, rollup)."""
+    return get_db_connection(pool=MAINTENANCE_DB_POOL)
+
+
+def _build_spool():
+    return DurableSpool(
+        logger=logger,
+        get_connection=get_db_connection,
+        path=os.path.join(data_directory, "spool", "spool.sqlite"),
+        max_rows=int(os.getenv("SPOOL_MAX_ROWS", "500000")),
+        max_bytes=int(os.getenv("SPOOL_MAX_MB", "200")) * 1024 * 1024,
+        replay_rate=float(os.getenv("SPOOL_REPLAY_RATE", "2000"))
+    )
+
+
+# Spool locale: conserva le misure quando MySQL non è raggiungibile
+SPOOL = _service("SPOOL", _build_spool)
+
+
+def _build_write_behind():
+    return WriteBehindBuffer(
+        logger=logger,
+        get_connection=get_db_connection,
+        batch_size=int(os.getenv("DB_BATCH_SIZE", "50")),
+        flush_interval=float(os.getenv("DB_FLUSH_INTERVAL", "10")),
+        max_rows=int(os.getenv("DB_BUFFER_MAX_ROWS", "10000")),
+        spool=SPOOL
+    )
+
+
+# Scrittura differita delle misure (executemany ogni N righe o T secondi);
+# creata al primo uso perché registra il flush finale con atexit
+WRITE_BEHIND = _service("WRITE_BEHIND", _build_write_behind)
+
+def _build_rollups():
+    return RollupManager(
+        logger=logger,
+        get_connection=get_maintenance_connection,
+        settle_s=float(os.getenv("ROLLUP_SETTLE_S", "120")),
+        interval=float(os.getenv("ROLLUP_INTERVAL", "60"))
+    )
+
+
+# Aggregati al minuto / ora / giorno per Grafana (processo rollup_runner.py)
+ROLLUPS = _service("ROLLUPS", _build_rollups)
+
+
+def _build_archive():
+    from archive import ColdArchive
+    return ColdArchive(
+        logger=logger,
+        get_connection=get_maintenance_connection,
+        root=os.path.join(data_directory, "archive")
+    )
+
+
+# Archivio freddo (.npy per colonna) delle partizioni uscite dalla retention
+ARCHIVE = _service("ARCHIVE", _build_archive)
+
+
+def _archive_before_drop(table, partition, start, end):
+    return ARCHIVE.before_drop(table, partition, start, end)
+
+
+def _build_schema():
+    return SchemaManager(
+        logger=logger,
+        get_connection=get_maintenance_connection,
+        before_drop=_archive_before_drop,
+        retention_months=int(os.getenv("RAW_RETENTION_MONTHS", "12")),
+        future_months=int(os.getenv("PARTITION_FUTURE_MONTHS", "3"))
+    )
+
+
+# Indici, partizioni mensili e retention delle tabelle di misura
+SCHEMA = _service("SCHEMA", _build_schema)
+
+# Executor limitato per le chiamate bloccanti (MySQL) dal loop asyncio
+BLOCKING_EXECUTOR = _service("BLOCKING_EXECUTOR", lambda: ThreadPoolExecutor(
+    max_workers=int(os.getenv("BLOCKING_IO_WORKERS", "4")),
+    thread_name_prefix="blocking-io"
+))
+
+
+# Un solo thread per manutenzione, archivio e rollup: non occupano BLOCKING_EXECUTOR
+MAINTENANCE_EXECUTOR = _service("MAINTENANCE_EXECUTOR", lambda: ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix="maintenance"
+))
+
+
+async def run_blocking(fn, *args, executor=BLOCKING_EXECUTOR, **kwargs):
+    """Esegue una funzione bloccante nell'executor senza fermare il loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(resolve(executor), functools.partial(fn, *args, **kwargs))
+
+
+async def run_maintenance(fn, *args, **kwargs):
+    """Come run_blocking, nell'executor di manutenzione (operazioni lunghe)."""
+    return await run_blocking(fn, *args, executor=MAINTENANCE_EXECUTOR, **kwargs)
+
+
+def install_shutdown_handler():
+    """SIGTERM -> SystemExit, così gli handler atexit (flush delle misure) vengono eseguiti."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+SHELLY_EMETERS_COLUMNS = [
+    "power_1", "pf_1", "current_1", "voltage_1", "total_1", "total_returned_1",
+    "power_2", "pf_2", "current_2", "voltage_2", "total_2", "total_returned_2",
+    "power_3", "pf_3", "current_3", "voltage_3", "total_3", "total_returned_3",
+]
+
+
+def _build_live():
+    from live_buffer import RingBuffer
+    return RingBuffer(
+        path=os.getenv("LIVE_BUFFER_PATH", "/dev/shm/energy_monitor_live.bin"),
+        capacity=int(LIVE_BUFFER_HOURS * 3600 / float(CONFIG.get("POLL_MIN_PERIOD", 3)))
+    )
+
+
+# Ultime ore di campioni elaborati, in memoria condivisa tra logger e Flask
+LIVE = _service("LIVE", _build_live)
+
+
+@app.route("/live", methods=["GET"])
+def live():
+    """Ultimo campione del ciclo di controllo."""
+    sample = LIVE.latest()
+    if sample is None:
+        return jsonify({"error": "Nessun campione disponibile"}), 404
+    sample["age_s"] = round(time.time() - sample["t"], 1)
+    return jsonify(sample)
+
+
+@app.route("/live/window", methods=["GET"])
+def live_window():
+    """Campioni degli ultimi 'seconds' secondi (default 600), opzionale 'fields' separati da virgola."""
+    try:
+        seconds = min(float(request.args.get("seconds", 600)), LIVE_BUFFER_HOURS * 3600)
+    except ValueError:
+        return jsonify({"error": "seconds non valido"}), 400
+    fields = [f for f in request.args.get("fields", "").split(",") if f]
+    unknown = [f for f in fields if f not in LIVE.fields]
+    if unknown:
+        return jsonify({"error": f"Campi non validi: {', '.join(unknown)}"}), 400
+    if fields and "t" not in fields:
+        fields.insert(0, "t")
+    return jsonify(LIVE.window(seconds, fields or None))
+
+
+def _build_events():
+    return event_stream.EventLog(
+        path=os.getenv("EVENT_LOG_PATH", "/dev/shm/energy_monitor_events.bin"),
+        capacity=int(os.getenv("EVENT_LOG_CAPACITY", "4096"))
+    )
+
+
+# Eventi per lo stream live (misure, decisioni, esiti dei comandi)
+EVENTS = _service("EVENTS", _build_events)
+
+
+# Client /stream contemporanei per worker: ognuno tiene un thread gthread finché
+# resta collegato, gli altri thread restano alle API (/config_tesla, /live, ...)
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", str(max(int(os.getenv("HTTP_THREADS", "16")) // 4, 1))))
+_sse_lock = threading.Lock()
+_sse_open = 0
+
+
+def _release_stream():
+    global _sse_open
+    with _sse_lock:
+        _sse_open -= 1
+
+
+@app.route("/stream", methods=["GET"])
+def stream():
+    """
+    Server-Sent Events: measurement, decision, command_result.
+    Parametro opzionale 'types' (separati da virgola). Con l'header
+    Last-Event-ID il client riprende dall'evento successivo.
+    Oltre SSE_MAX_STREAMS client per worker risponde 503 (il client
+    EventSource riprova da solo).
+    """
+    global _sse_open
+    with _sse_lock:
+        if _sse_open >= SSE_MAX_STREAMS:
+            return jsonify({"error": "Troppi client /stream collegati"}), 503, {"Retry-After": "10"}
+        _sse_open += 1
+
+    types = {t for t in request.args.get("types", "").split(",") if t} or None
+    last_id = request.headers.get("Last-Event-ID")
+    cursor = int(last_id) + 1 if last_id and last_id.isdigit() else EVENTS.head()
+    response = Response(
+        event_stream.sse_stream(EVENTS, cursor, types),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # Chiamata dal server a connessione chiusa (anche se il client se ne va subito)
+    response.call_on_close(_release_stream)
+    return response
+
+
+def db_stats_snapshot():
+    """
+    Statistiche del pool MySQL, della scrittura differita e dello spool del
+    processo corrente (solo i servizi già creati: None per gli altri).
+    """
+    return {
+        "pool": DB_POOL.stats() if is_loaded(DB_POOL) else None,
+        "maintenance_pool": MAINTENANCE_DB_POOL.stats() if is_loaded(MAINTENANCE_DB_POOL) else None,
+        "write_behind": WRITE_BEHIND.stats() if is_loaded(WRITE_BEHIND) else None,
+        "spool": SPOOL.stats() if is_loaded(SPOOL) else None,
+    }
+
+
+# Stato scritto dal supervisor (task, statistiche DB), leggibile da ogni worker HTTP
+HEALTH_PATH = os.getenv("SUPERVISOR_HEALTH_PATH", "/dev/shm/energy_monitor_health.json")
+HEALTH_MAX_AGE_S = float(os.getenv("SUPERVISOR_HEALTH_MAX_AGE_S", "30"))
+
+
+def _supervisor_status():
+    """Ultimo stato pubblicato dal supervisor (None se non disponibile)."""
+    try:
+        with open(HEALTH_PATH) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+    status["fresh"] = time.time() - status.get("updated_at", 0) <= HEALTH_MAX_AGE_S
+    return status
+
+
+@app.route("/db_stats", methods=["GET"])
+def db_stats():
+    """
+    Statistiche del pool MySQL (per dimensionarlo) e della scrittura differita
+    del processo del controllo, pubblicate dal supervisor.
+    """
+    status = _supervisor_status()
+    if status is None or "db" not in status:
+        return jsonify({"error": "Stato del supervisor non disponibile"}), 503
+    return jsonify({**status["db"], "updated_at": status["updated_at"], "fresh": status["fresh"]})
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Stato dei task del supervisor (503 se qualcuno non è in esecuzione o lo stato è vecchio)."""
+    status = _supervisor_status()
+    if status is None:
+        return jsonify({"error": "Stato del supervisor non disponibile"}), 503
+    status.pop("db", None)
+    return jsonify(status), 200 if status.get("healthy") and status["fresh"] else 503
+
+
+# Serie per dashboard: sorgente (grezza o aggregata) scelta in base all'intervallo
+SERIES_DEFAULT_POINTS = 1000
+SERIES_MAX_POINTS = int(os.getenv("SERIES_MAX_POINTS", "10000"))
+SERIES_CHUNK_ROWS = int(os.getenv("SERIES_CHUNK_ROWS", "5000"))
+
+
+def _parse_time(value, default):
+    if not value:
+        return default
+    try:
+        return datetime.fromtimestamp(float(value))
+    except ValueError:
+        return datetime.fromisoformat(value)
+
+
+def _series_source(table, columns, start, end, points):
+    """Aggregato più grossolano che dà ancora almeno 'points' punti (solo grandezze istantanee)."""
+    if any(col not in ROLLUP_SOURCES[table]["gauges"] for col in columns):
+        return "raw"
+    spacing = (end - start).total_seconds() / points
+    source = "raw"
+    for level, step, _ in ROLLUP_LEVELS:
+        if step.total_seconds() <= spacing:
+            source = level
+    return source
+
+
+def _stream_rows(cursor, query, params, reducers, min_max=False):
+    """
+    Legge il risultato a blocchi (cursore non bufferizzato) e lo passa ai riduttori.
+    min_max: per ogni riduttore due colonne (min, max) dello stesso bucket,
+    passate come due punti con lo stesso timestamp.
+    """
+    cursor.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(SERIES_CHUNK_ROWS)
+        if not rows:
+            break
+        block = np.array(rows, dtype=float)
+        for i, reducer in enumerate(reducers):
+            if min_max:
+                reducer.add(np.repeat(block[:, 0], 2), block[:, 2 * i + 1:2 * i + 3].ravel())
+            else:
+                reducer.add(block[:, 0], block[:, i + 1])
+
+
+@app.route("/series", methods=["GET"])
+def series():
+    """
+    Serie ridotta per i grafici.
+    Parametri: table, columns (separate da virgola), start / end (ISO o epoch),
+    points (default 1000), method (lttb | minmax), source (auto | raw | 1m | 1h | 1d).
+    """
+    table = request.args.get("table", "")
+    if table not in ROLLUP_SOURCES:
+        return jsonify({"error": f"Tabella non valida. Disponibili: {', '.join(ROLLUP_SOURCES)}"}), 400
+    spec = ROLLUP_SOURCES[table]
+    columns = [c for c in request.args.get("columns", "").split(",") if c]
+    unknown = [c for c in columns if c not in spec["gauges"] + spec["counters"]]
+    if not columns or unknown:
+        return jsonify({"error": f"Colonne non valide: {', '.join(unknown) or '(nessuna)'}"}), 400
+
+    try:
+        end = _parse_time(request.args.get("end"), datetime.now())
+        start = _parse_time(request.args.get("start"), end - timedelta(days=1))
+        points = min(int(request.args.get("points", SERIES_DEFAULT_POINTS)), SERIES_MAX_POINTS)
+    except ValueError as e:
+        return jsonify({"error": f"Parametro non valido: {e}"}), 400
+    method = request.args.get("method", "lttb")
+    if method not in ("lttb", "minmax") or start >= end or points < 3:
+        return jsonify({"error": "Parametri non validi (method, start/end o points)"}), 400
+
+    source = request.args.get("source", "auto")
+    levels = [level for level, _, _ in ROLLUP_LEVELS]
+    if source == "auto":
+        source = _series_source(table, columns, start, end, points)
+    elif source not in ["raw"] + levels:
+        return jsonify({"error": "source non valida"}), 400
+
+    conn, cursor = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database non disponibile"}), 503
+
+    reducers = [downsampling.StreamingReducer(points, start.timestamp(), end.timestamp(), method) for _ in columns]
+    raw_query = (
+        f"SELECT UNIX_TIMESTAMP(timestamp), {', '.join(columns)} FROM {table} "
+        "WHERE timestamp >= %s AND timestamp < %s ORDER BY timestamp"
+    )
+    try:
+        raw_from = start
+        if source != "raw":
+            try:
+                cursor.execute("SELECT watermark FROM rollup_watermark WHERE source = %s AND level = %s",
+                               (table, source))
+                row = cursor.fetchone()
+                if row and row[0] > start:
+                    # minmax conserva i picchi: servono _min/_max, non le medie
+                    if method == "minmax":
+                        rollup_cols = [f"{c}_min, {c}_max" for c in columns]
+                    else:
+                        rollup_cols = [f"{c}_avg" for c in columns]
+                    _stream_rows(
+                        cursor,
+                        f"SELECT UNIX_TIMESTAMP(bucket), {', '.join(rollup_cols)} "
+                        f"FROM {rollup_table(table, source)} WHERE bucket >= %s AND bucket < %s ORDER BY bucket",
+                        (start, min(row[0], end)), reducers, min_max=(method == "minmax")
+                    )
+                    raw_from = min(row[0], end)
+                else:
+                    source = "raw"
+            except mysql_connector.ProgrammingError as e:
+                # Aggregati non ancora creati (rollup mai avviato): solo dati grezzi
+                logger.warning(f"⚠️ Aggregati {table} non disponibili, uso i dati grezzi: {e}")
+                source = "raw"
+        # Dati grezzi più vecchi della retention: dall'archivio mappato in memoria
+        if source == "raw" and all(c in ARCHIVE.tables.get(table, {}) for c in columns):
+            archive_end = ARCHIVE.end_time(table)
+            if archive_end and raw_from.timestamp() < archive_end:
+                for part in ARCHIVE.iter_months(table, columns, raw_from.timestamp(),
+                                                min(end.timestamp(), archive_end)):
+                    for i in range(0, len(part["t"]), SERIES_CHUNK_ROWS):
+                        x = np.asarray(part["t"][i:i + SERIES_CHUNK_ROWS], dtype=float)
+                        for col, reducer in zip(columns, reducers):
+                            reducer.add(x, np.asarray(part[col][i:i + SERIES_CHUNK_ROWS], dtype=float))
+                raw_from = max(raw_from, datetime.fromtimestamp(archive_end))
+                source = "archive+raw"
+        # Dati grezzi per l'intervallo non ancora aggregato
+        if raw_from < end:
+            _stream_rows(cursor, raw_query, (raw_from, end), reducers)
+    except mysql_connector.Error as e:
+        logger.error(f"❌ Errore lettura serie {table}: {e}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+    result = {}
+    for col, reducer in zip(columns, reducers):
+        x, y = reducer.result()
+        result[col] = {"t": (x * 1000).astype(np.int64).tolist(), "v": y.round(4).tolist()}
+    return jsonify({
+        "table": table,
+        "source": source,
+        "method": method,
+        "rows_read": reducers[0].rows,
+        "columns": result,
+    })
+
+
 def is_shelly_ip(ip):
     """Verifica se l'IP appartiene a un dispositivo Shelly (controlla il campo 'mac')."""
     try:
@@ -604,12 +1030,22 @@ def is_shelly_ip(ip):
         logger.debug(f"[Shelly] Nessuna risposta valida da {ip}: {e}")
     return False
 
+def discover_devices(targets):
+    """Scansione parallela della LAN per tutti i target in un solo passaggio."""
+    return device_discovery.discover_sync(
+        targets,
+        subnet=LAN_SUBNET,
+        timeout=DISCOVERY_TIMEOUT,
+        concurrency=DISCOVERY_CONCURRENCY,
+        logger=logger
+    )
+
+def _first_match(found, key):
+    ips = found.get(key) or []
+    return ips[0] if ips else None
+
 def find_shelly_ip():
-    for i in range(1, 255):
-        ip = f"192.168.1.{i}"
-        if is_shelly_ip(ip):
-            return ip
-    return None
+    return _first_match(discover_devices([device_discovery.shelly_target(SHELLY_MAC)]), "shelly")
 
 def verify_and_update_shelly_ip():
     global SHELLY_IP
@@ -656,18 +1092,14 @@ def is_esp_mac_ip(ESP32_IP, ESP32_MAC):
     return False
 
 def find_esp_mac_ip(ESP32_MAC):
-    for i in range(1, 255):
-        IP = f"192.168.1.{i}"
-        if is_esp_mac_ip(IP, ESP32_MAC):
-            return IP
-    return None
+    return _first_match(discover_devices([device_discovery.esp32_target(ESP32_MAC)]), "esp32")
 
 
 # ---- ESP8266 ----
 def is_esp8266_ip(ip):
     """Verifica se l'IP appartiene al tuo ESP8266 personalizzato (campo 'name' == 'tesla_esp')."""
     try:
-        response = requests.get(f"http://{ip}/status?token=Merca10tello", timeout=1)
+        response = requests.get(f"http://{ip}/status?token={ESP8266_TOKEN}", timeout=1)
         if response.status_code == 200:
             data = response.json()
             name = data.get("name", "").lower()
@@ -679,11 +1111,7 @@ def is_esp8266_ip(ip):
  
 
 def find_esp8266_ip():
-    for i in range(1, 255):
-        ip = f"192.168.1.{i}"
-        if is_esp8266_ip(ip):
-            return ip
-    return None
+    return _first_match(discover_devices([device_discovery.esp8266_target(ESP8266_NAME, ESP8266_TOKEN)]), "esp8266")
 
 def verify_and_update_esp8266_ip():
     global ESP8266_IP
@@ -699,9 +1127,44 @@ def verify_and_update_esp8266_ip():
             logger.error("Dispositivo ESP8266 non trovato sulla rete.")
     else:
         logger.info(f"ESP8266 già configurato all'indirizzo: {ESP8266_IP}")
-        
+
+
+def _on_device_ip_change(key, old_ip, new_ip):
+    """Aggiorna variabili globali e config.json quando il registro sposta un dispositivo."""
+    global SHELLY_IP, ESP8266_IP
+    if key == "shelly":
+        CONFIG["SHELLY_IP"] = SHELLY_IP = new_ip
+    elif key == "esp8266":
+        CONFIG["ESP8266_IP"] = ESP8266_IP = new_ip
+    with open(config_path, "w") as f:
+        json.dump(CONFIG, f, indent=2)
+    logger.info(f"📍 Indirizzo di '{key}' aggiornato: {old_ip} → {new_ip}")
+
+
+def _build_devices():
+    from device_registry import DeviceRegistry
+    devices = DeviceRegistry(
+        logger=logger,
+        subnet=LAN_SUBNET,
+        timeout=DISCOVERY_TIMEOUT,
+        concurrency=DISCOVERY_CONCURRENCY,
+        failure_threshold=int(CONFIG.get("DEVICE_FAILURE_THRESHOLD", 3)),
+        revalidate_interval=float(CONFIG.get("DEVICE_REVALIDATE_INTERVAL", 600)),
+        on_change=_on_device_ip_change
+    )
+    devices.register("shelly", SHELLY_IP, device_discovery.shelly_target(SHELLY_MAC), mac=SHELLY_MAC)
+    devices.register("esp8266", ESP8266_IP, device_discovery.esp8266_target(ESP8266_NAME, ESP8266_TOKEN))
+    return devices
+
+
+# Registro dispositivi: verifica degli indirizzi fuori dal ciclo di controllo
+DEVICES = _service("DEVICES", _build_devices)
+
+
 def get_conf():
     conn, cursor = get_db_connection(dictionary=True)
+    if not conn:
+        return None
     try:
         cursor.execute("""
             SELECT STATE, MAX_ENERGY_PRELEVABILE
@@ -725,6 +1188,8 @@ def set_conf(key, value):
         raise ValueError("Chiave non valida: deve essere 'STATE' o 'MAX_ENERGY_PRELEVABILE'")
 
     conn, cursor = get_db_connection()
+    if not conn:
+        return False
     try:
         sql = f"""
             UPDATE conf
@@ -778,7 +1243,7 @@ async def shelly_logger():
     CERT_PATH        = "/app/tesla-proxy-config/cert.pem"
     PROXY_URL_BASE   = "https://tesla_http_proxy:4443/api/1/vehicles"
 
-    tesla = TeslaProxy(
+    tesla = tesla_proxy.TeslaProxy(
         vin=VIN,
         proxy_base="https://tesla_http_proxy:4443/api/1/vehicles",
         token_file="/app/data/tesla_token_latest.json",
@@ -786,14 +1251,73 @@ async def shelly_logger():
         logger=logger,
         get_vehicle_data=get_vehicle_data,     # <— la tua funzione esistente (async)
         refresh_token=refresh_token,           # <— la tua funzione esistente (sync o async)
-        log_pretty=log_dict_pretty             # <— opzionale; se ce l’hai
+        log_pretty=log_dict_pretty,            # <— opzionale; se ce l’hai
+        token_provider=TOKEN_MANAGER.get_access_token,
+        state_ttl=float(CONFIG.get("VEHICLE_STATE_TTL", 60))
 )
 
-    period = 30  # secondi tra i cicli di polling
+    # Periodo di polling adattivo (veloce vicino al limite, lento in attesa)
+    scheduler = AdaptiveScheduler(
+        logger=logger,
+        min_period=float(CONFIG.get("POLL_MIN_PERIOD", 3)),
+        base_period=float(CONFIG.get("POLL_PERIOD", 30)),
+        max_period=float(CONFIG.get("POLL_MAX_PERIOD", 120)),
+        near_limit_w=float(CONFIG.get("POLL_NEAR_LIMIT_W", 500)),
+        settle_s=float(CONFIG.get("POLL_SETTLE_S", 20))
+    )
+
+    # Verifica indirizzi dei dispositivi e refresh del token in background
+    registry_task = asyncio.create_task(DEVICES.run())
+    token_task = asyncio.create_task(TOKEN_MANAGER.run())
+
+    # Sessione HTTP condivisa per le letture dei dispositivi
+    session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DEVICE_TIMEOUT_S))
+    # Coda comandi Tesla: un solo worker, priorità, deduplica, scadenze e retry
+    command_queue = TeslaCommandQueue(
+        execute=tesla.execute,
+        logger=logger,
+        deadline_s=float(CONFIG.get("TESLA_COMMAND_DEADLINE_S", 120)),
+        max_retries=int(CONFIG.get("TESLA_COMMAND_MAX_RETRIES", 3))
+    )
+    command_queue.start()
+    # Riduzione comandi: isteresi, permanenza minima, budget orario
+    controller = ChargeController(
+        execute=command_queue.submit,
+        logger=logger,
+        hysteresis_amps=int(CONFIG.get("CHARGE_HYSTERESIS_AMPS", 1)),
+        min_dwell_s=float(CONFIG.get("CHARGE_MIN_DWELL_S", 120)),
+        max_commands_per_hour=int(CONFIG.get("CHARGE_MAX_COMMANDS_PER_HOUR", 20)),
+        settle_s=float(CONFIG.get("POLL_SETTLE_S", 20))
+    )
+
+    try:
+        await _shelly_logger_loop(controller, session, scheduler)
+    finally:
+        registry_task.cancel()
+        token_task.cancel()
+        await command_queue.stop()
+        await session.close()
+        await tesla.close()
+
+
+def _on_command_result(command, amps, future):
+    """Esito di un comando accodato: in caso di errore il sistema viene disattivato."""
+    result = future.result()
+    status = result.get("status")
+    EVENTS.publish("command_result", command=command, amps=amps, status=status,
+                   message=result.get("message"), http_status=result.get("http_status"))
+    if status in ("superseded", "expired", "cancelled"):
+        logger.info(f"ℹ️ Comando {command} ({amps} A) non eseguito: {result.get('message')}")
+        return
+    if status == "error":
+        logger.error(f"❌ Errore inviando il comando {command} ({amps} A).")
+        asyncio.ensure_future(run_blocking(set_conf, "STATE", "OFF"))
+        logger.error("🛑 Sistema disattivato: STATE = OFF")
+
 
+async def _shelly_logger_loop(controller, session, scheduler):
+    scheduler.start()
     while True:
-        verify_and_update_shelly_ip()
-        verify_and_update_esp8266_ip()
 
         # Verifica e aggiorna ESP32 (lasciato come nel tuo codice, ma disattivato)
         global ESP32_IP_1
@@ -801,8 +1325,15 @@ async def shelly_logger():
         # result = verify_and_update_esp32_mac_ip(ESP32_IP_1, ESP32_MAC_1)
         # ...
 
+        # --- Letture indipendenti in parallelo: ESP8266, Shelly, config ---
+        # La durata del ciclo è quella della lettura più lenta, non la somma.
+        esp8266_data, shelly_data, conf = await asyncio.gather(
+            fetch_esp8266_data(session),
+            fetch_shelly_data(session),
+            run_blocking(get_conf)
+        )
+
         # --- Lettura ESP8266 ---
-        esp8266_data = fetch_esp8266_data()
         if esp8266_data:
             tesla_amps = esp8266_data.get("irms_A")
             tesla_amps_int = round(tesla_amps) if tesla_amps > 5.5 else 0
@@ -813,11 +1344,12 @@ async def shelly_logger():
         else:
             logger.warning("📡 Nessun dato ricevuto dall'ESP8266.")
 
-        # --- Lettura Shelly ---
-        shelly_data = fetch_shelly_data()
-
         # --- Config ---
-        conf = get_conf()
+        if not conf:
+            scheduler.update()
+            logger.error(f"❌ Configurazione non disponibile dal DB. Riprovo tra {scheduler.period:.0f} secondi...")
+            await scheduler.wait()
+            continue
         STATE = conf["STATE"]
         MAX_ENERGY_PRELEVABILE = float(conf["MAX_ENERGY_PRELEVABILE"])
 
@@ -834,11 +1366,13 @@ async def shelly_logger():
             store_data_in_db(shelly_data)
             logger.info("✅ Dati Shelly e ESP8266 salvati correttamente.")
         else:
-            logger.warning(f"⚠️ Dati Shelly o ESP8266 non disponibili. Riprovo tra {period} secondi...")
-            await asyncio.sleep(period)
+            scheduler.update()
+            logger.warning(f"⚠️ Dati Shelly o ESP8266 non disponibili. Riprovo tra {scheduler.period:.0f} secondi...")
+            await scheduler.wait()
             continue
 
         # --- Decisione e comandi Tesla ---
+        max_allowed_amps = None
         if STATE == "ON":
             tesla_power_draw = tesla_amps_int * grid_voltage
             grid_power = shelly_data_processed["grid_power"]
@@ -846,48 +1380,60 @@ async def shelly_logger():
             logger.info(f"⚡ Potenza prelevata da Enel: {grid_power} W")
             logger.info(f"⚡ Potenza assorbita da Tesla: {tesla_power_draw} W")
 
-            max_allowed_amps = 0
-            for amps in range(13, 5, -1):
-                total_power = amps * grid_voltage + grid_power
-                if total_power < MAX_ENERGY_PRELEVABILE:
-                    max_allowed_amps = amps
-                    break
+            phase_power, phase_voltage = charging_solver.grid_from_emeters(shelly_data, SHELLY_GRID_PHASES)
+            max_allowed_amps = charging_solver.max_allowed_amps(
+                phase_power, phase_voltage, MAX_ENERGY_PRELEVABILE,
+                min_amps=CHARGE_MIN_AMPS, max_amps=CHARGE_MAX_AMPS,
+                margin=CHARGE_SAFETY_MARGIN_W, phases=CHARGE_PHASES
+            )
 
             logger.info(f"🔧 Max corrente consentita: {max_allowed_amps} A")
 
             if max_allowed_amps == tesla_amps_int:
                 logger.info(f"✅ Corrente Tesla già impostata a {tesla_amps_int} A. Nessuna azione necessaria.")
-
             elif max_allowed_amps == 0:
                 logger.warning(f"⚠️ Nessuna corrente impostabile trovata che rispetti il limite di {MAX_ENERGY_PRELEVABILE} W.")
-                logger.info("🔴 Invio comando charge_stop.")
-                result_charge_stop = await tesla.execute("charge_stop")
-                if result_charge_stop.get("status") == "error":
-                    logger.error("❌ Errore inviando il comando charge_stop.")
-                    set_conf("STATE", "OFF")
-                    logger.error("🛑 Sistema disattivato: STATE = OFF")
-
             else:
-                if tesla_amps_int == 0:
-                    logger.info(f"🔌 Corrente Tesla attuale = 0 A. Corrente da impostare: {max_allowed_amps} A")
-                    logger.info("🔴 Invio comando charge_start.")
-                    result_charge_start = await tesla.execute("charge_start")
-                    if result_charge_start.get("status") == "error":
-                        logger.error("❌ Errore inviando il comando charge_start.")
-                        set_conf("STATE", "OFF")
-                        logger.error("🛑 Sistema disattivato: STATE = OFF")
-                else:
-                    logger.info(f"🔌 Corrente Tesla attuale = {tesla_amps_int} A. Corrente da impostare: {max_allowed_amps} A")
-                    logger.info("🔴 Invio comando set_charging_amps.")
-                    result_set_charging_amps = await tesla.execute("set_charging_amps", charging_amps_value=max_allowed_amps)
-                    if result_set_charging_amps.get("status") == "error":
-                        logger.error(f"❌ Errore inviando il comando set_charging_amps {max_allowed_amps} A.")
-                        set_conf("STATE", "OFF")
-                        logger.error("🛑 Sistema disattivato: STATE = OFF")
+                logger.info(f"🔌 Corrente Tesla attuale = {tesla_amps_int} A. Corrente da impostare: {max_allowed_amps} A")
+
+            # Isteresi, permanenza minima e budget orario decidono se inviare davvero.
+            # Il comando viene solo accodato: l'esito arriva a _on_command_result.
+            sent = await controller.apply(max_allowed_amps, tesla_amps_int, local_amps=tesla_amps)
+            if sent:
+                command, pending = sent
+                pending.add_done_callback(functools.partial(_on_command_result, command, max_allowed_amps))
+                scheduler.note_command()
+            EVENTS.publish("decision", state=STATE, max_allowed_amps=max_allowed_amps,
+                           current_amps=tesla_amps_int, command=sent[0] if sent else None,
+                           max_power=MAX_ENERGY_PRELEVABILE)
+
+            # In attesa se la vettura non carica e non c'è margine per farla partire
+            total_grid_power = sum(shelly_data[i]["power"] for i in SHELLY_GRID_PHASES)
+            scheduler.update(total_grid_power, MAX_ENERGY_PRELEVABILE,
+                             active=tesla_amps_int > 0 or max_allowed_amps > 0)
         else:
             logger.info("🚫 Stato = OFF. Sistema gestione ricarica disattivato. Nessun comando verrà inviato.")
+            scheduler.update(shelly_data_processed["grid_power"], None, active=False)
+            EVENTS.publish("decision", state=STATE, max_allowed_amps=None, current_amps=tesla_amps_int,
+                           command=None, max_power=MAX_ENERGY_PRELEVABILE)
+
+        # Ultimo campione elaborato nel buffer live (letto da /live senza DB) e nello stream
+        sample = dict(
+            grid_power=shelly_data_processed["grid_power"],
+            solar_production=shelly_data_processed["solar_production"],
+            house_consumption=shelly_data_processed["house_consumption"],
+            grid_voltage=shelly_data_processed["grid_voltage"],
+            pv_voltage=shelly_data_processed["pv_voltage"],
+            grid_current=shelly_data_processed["grid_current"],
+            pv_current=shelly_data_processed["pv_current"],
+            tesla_amps=tesla_amps,
+            max_allowed_amps=max_allowed_amps,
+            valid=1 if shelly_data_processed["measurements_valid"] else 0
+        )
+        LIVE.append(**sample)
+        EVENTS.publish("measurement", **sample)
 
-        await asyncio.sleep(period)
+        await scheduler.wait()
                
 
 
@@ -1039,35 +1585,118 @@ def log_dict_pretty(d, prefix="", level=0):
 VOLTAGE_IP = "192.168.1.2"
 VOLTAGE_URL = f"http://{VOLTAGE_IP}/voltage"
 
+# Campionamento e compressione della tensione: parametri VOLTAGE_* letti da init()
+VOLTAGE_STATS_COLUMNS = ["sent_by", "v_min", "v_max", "v_mean", "samples"]
+# Attesa tra i tentativi di creare litum_battery_stats (MySQL non ancora pronto)
+VOLTAGE_STATS_RETRY_S = 30
+
+
+def ensure_voltage_stats_table():
+    conn, cursor = get_db_connection()
+    if not conn:
+        return False
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS litum_battery_stats (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                timestamp DATETIME NOT NULL,
+                sent_by VARCHAR(64),
+                v_min FLOAT,
+                v_max FLOAT,
+                v_mean FLOAT,
+                samples INT,
+                INDEX idx_timestamp (timestamp)
+            )
+        """)
+        conn.commit()
+        return True
+    except mysql_connector.Error as e:
+        logger.error(f"❌ Errore creazione tabella litum_battery_stats: {e}")
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+class VoltagePipeline:
+    """
+    Per ogni sensore: compressione dei campioni + min/max/media per intervallo.
+    Gli intervalli restano in memoria finché litum_battery_stats non esiste
+    (stats_ready): MySQL può non essere ancora pronto all'avvio del container.
+    """
+    def __init__(self):
+        compressor = SwingingDoor if VOLTAGE_COMPRESSION == "swinging_door" else DeadbandFilter
+        self._compressor = lambda: compressor(VOLTAGE_DEVIATION, VOLTAGE_KEEPALIVE_S)
+        self._sensors = {}
+        self._held = []
+        self.stats_ready = False
+        self.stats = {"samples": 0, "stored": 0}
+
+    def set_stats_ready(self):
+        self.stats_ready = True
+        held, self._held = self._held, []
+        for name, intervals in held:
+            self._store(name, [], intervals)
+
+    def feed(self, name, t, voltage):
+        if name not in self._sensors:
+            self._sensors[name] = (self._compressor(), IntervalAggregator(VOLTAGE_STATS_INTERVAL))
+        compressor, aggregator = self._sensors[name]
+        self.stats["samples"] += 1
+        self._store(name, compressor.feed(t, voltage), aggregator.feed(t, voltage))
+
+    def flush(self):
+        for name, (compressor, aggregator) in self._sensors.items():
+            self._store(name, compressor.flush(), aggregator.flush())
+
+    def _store(self, name, points, intervals):
+        for t, voltage in points:
+            WRITE_BEHIND.add("litum_battery", ["voltage", "sent_by"], [voltage, name],
+                             timestamp=datetime.fromtimestamp(t))
+            self.stats["stored"] += 1
+        if not self.stats_ready:
+            if intervals:
+                self._held.append((name, intervals))
+            return
+        for start, v_min, v_max, v_mean, count in intervals:
+            WRITE_BEHIND.add("litum_battery_stats", VOLTAGE_STATS_COLUMNS,
+                             [name, v_min, v_max, round(v_mean, 4), count],
+                             timestamp=datetime.fromtimestamp(start))
+
+
 async def voltage_logger_loop():
-    async with aiohttp.ClientSession() as session:
-        while True:
-            try:
-                async with session.get(VOLTAGE_URL, timeout=5) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        voltage = data.get("voltage")
-                        name = data.get("name", "sconosciuto")
-
-                        print(f"🔌 Tensione da {name}: {voltage:.2f} V")
-
-                        # Inserimento nel database
-                        conn, cursor = get_db_connection()
-                        if conn and cursor:
-                            try:
-                                cursor.execute(
-                                    "INSERT INTO litum_battery (voltage, sent_by) VALUES (%s, %s)",
-                                    (voltage, name)
-                                )
-                                conn.commit()
-                            except Exception as db_err:
-                                print(f"❌ Errore durante INSERT: {db_err}")
-                            finally:
-                                cursor.close()
-                                conn.close()
+    pipeline = VoltagePipeline()
+    next_table_check = 0.0
+    # Stesso periodo a ogni ciclo, con scadenze assolute (niente deriva)
+    rate = AdaptiveScheduler(logger, min_period=VOLTAGE_SAMPLE_PERIOD,
+                             base_period=VOLTAGE_SAMPLE_PERIOD, max_period=VOLTAGE_SAMPLE_PERIOD)
+    rate.start()
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DEVICE_TIMEOUT_S)) as session:
+            while True:
+                # Tabella delle statistiche: riprova finché MySQL non è pronto
+                if not pipeline.stats_ready and time.monotonic() >= next_table_check:
+                    if await run_blocking(ensure_voltage_stats_table):
+                        pipeline.set_stats_ready()
                     else:
-                        print(f"⚠️ Risposta HTTP non OK: {resp.status}")
-            except Exception as e:
-                print(f"❌ Errore richiesta: {e}")
-
-            await asyncio.sleep(30)
\ No newline at end of file
+                        next_table_check = time.monotonic() + VOLTAGE_STATS_RETRY_S
+                try:
+                    async with session.get(VOLTAGE_URL, timeout=5) as resp:
+                        if resp.status == 200:
+                            data = await resp.json()
+                            voltage = data.get("voltage")
+                            name = data.get("name", "sconosciuto")
+
+                            if voltage is not None:
+                                pipeline.feed(name, time.time(), float(voltage))
+                                print(f"🔌 Tensione da {name}: {voltage:.2f} V "
+                                      f"(salvati {pipeline.stats['stored']}/{pipeline.stats['samples']})")
+                        else:
+                            print(f"⚠️ Risposta HTTP non OK: {resp.status}")
+                except Exception as e:
+                    print(f"❌ Errore richiesta: {e}")
+
+                await rate.wait()
+    finally:
+        # Ultimo punto e intervallo in corso
+        pipeline.flush()
@@ -0,0 +1,177 @@
+# archive.py
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+
+
+def _phases(*names):
+    return [f"{name}_{i}" for i in (1, 2, 3) for name in names]
+
+
+# Colonne archiviate e tipo NumPy (float32 dove la precisione basta, float64 per
+# i contatori di energia e le coordinate). 't' = epoch in secondi.
+ARCHIVE_COLUMNS = {
+    "shelly_emeters": dict(
+        [(c, "float32") for c in _phases("power", "pf", "current", "voltage")]
+        + [(c, "float64") for c in _phases("total", "total_returned")]
+    ),
+    "tesla_status": {
+        "charging_amps": "float32",
+        "latitude": "float64",
+        "longitude": "float64",
+        "battery_level": "float32",
+    },
+}
+
+
+class ColdArchive:
+    """
+    Archivio freddo a colonne: una directory per tabella e mese
+    (<root>/<tabella>/<YYYYMM>/) con un file .npy per colonna più meta.json.
+    I file .npy non sono compressi per poterli mappare in memoria: la
+    dimensione si riduce con tipi compatti (float32 dove basta).
+      - export_partition(): esporta un intervallo da MySQL a blocchi
+        (memoria costante), scrivendo in una directory temporanea poi
+        rinominata: un archivio esiste solo se completo
+      - iter_months() / load(): lettura con np.load(mmap_mode="r"), i dati
+        vengono letti dal disco solo quando servono
+    get_connection: () -> (conn, cursor) | (None, None)
+    """
+    def __init__(self, logger, get_connection, root, tables=None, chunk_rows=50000):
+        self.logger = logger
+        self.get_connection = get_connection
+        self.root = root
+        self.tables = tables or ARCHIVE_COLUMNS
+        self.chunk_rows = chunk_rows
+
+    # -------------------- Scrittura --------------------
+
+    def month_dir(self, table, month):
+        return os.path.join(self.root, table, f"{month.year:04d}{month.month:02d}")
+
+    def is_archived(self, table, month):
+        return os.path.exists(os.path.join(self.month_dir(table, month), "meta.json"))
+
+    def export_partition(self, table, start, end):
+        """Esporta le righe di [start, end) (un mese). Ritorna il numero di righe."""
+        columns = self.tables[table]
+        target = self.month_dir(table, start)
+        tmp = target + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        conn, cursor = self.get_connection()
+        if not conn:
+            raise RuntimeError("Database non disponibile")
+        try:
+            cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE timestamp >= %s AND timestamp < %s", (start, end))
+            rows = cursor.fetchone()[0]
+
+            # File di destinazione allocati subito: i blocchi vengono copiati direttamente
+            arrays = {"t": np.lib.format.open_memmap(os.path.join(tmp, "t.npy"), "w+", "int64", (rows,))}
+            for col, dtype in columns.items():
+                arrays[col] = np.lib.format.open_memmap(os.path.join(tmp, f"{col}.npy"), "w+", dtype, (rows,))
+
+            cursor.execute(
+                f"SELECT UNIX_TIMESTAMP(timestamp), {', '.join(columns)} FROM {table} "
+                "WHERE timestamp >= %s AND timestamp < %s ORDER BY timestamp",
+                (start, end)
+            )
+            written = 0
+            while True:
+                block = cursor.fetchmany(self.chunk_rows)
+                if not block:
+                    break
+                data = np.array(block, dtype=float)
+                n = min(len(data), rows - written)
+                arrays["t"][written:written + n] = data[:n, 0]
+                for i, col in enumerate(columns):
+                    arrays[col][written:written + n] = data[:n, i + 1]
+                written += n
+        finally:
+            cursor.close()
+            conn.close()
+
+        if written != rows:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise RuntimeError(f"Righe esportate {written} invece di {rows} per {table} {start:%Y-%m}")
+
+        for array in arrays.values():
+            array.flush()
+        del arrays
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({
+                "table": table,
+                "start": start.strftime("%Y-%m-%d %H:%M:%S"),
+                "end": end.strftime("%Y-%m-%d %H:%M:%S"),
+                "rows": rows,
+                "columns": {"t": "int64", **columns},
+                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }, f, indent=2)
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp, target)
+        self.logger.info(f"🧊 [Archivio] {table} {start:%Y-%m}: {rows} righe archiviate.")
+        return rows
+
+    def before_drop(self, table, partition, start, end):
+        """Hook per SchemaManager: archivia la partizione prima del DROP."""
+        if table not in self.tables:
+            return True
+        if self.is_archived(table, start):
+            return True
+        try:
+            self.export_partition(table, start, end)
+            return True
+        except Exception as e:
+            self.logger.error(f"❌ [Archivio] Export di {table}.{partition} fallito: {e}")
+            return False
+
+    # -------------------- Lettura --------------------
+
+    def months(self, table):
+        """Mesi archiviati (directory YYYYMM complete), in ordine."""
+        base = os.path.join(self.root, table)
+        if not os.path.isdir(base):
+            return []
+        return sorted(
+            name for name in os.listdir(base)
+            if name.isdigit() and os.path.exists(os.path.join(base, name, "meta.json"))
+        )
+
+    def end_time(self, table):
+        """Fine dell'ultimo mese archiviato (epoch) o None."""
+        months = self.months(table)
+        if not months:
+            return None
+        with open(os.path.join(self.root, table, months[-1], "meta.json")) as f:
+            end = json.load(f)["end"]
+        return datetime.strptime(end, "%Y-%m-%d %H:%M:%S").timestamp()
+
+    def iter_months(self, table, columns, start=None, end=None):
+        """
+        Per ogni mese: dict {"t": ..., col: ...} di array mappati in memoria,
+        già ristretti a [start, end) (epoch). Nessun dato viene copiato in RAM.
+        """
+        for month in self.months(table):
+            directory = os.path.join(self.root, table, month)
+            t = np.load(os.path.join(directory, "t.npy"), mmap_mode="r")
+            if not len(t):
+                continue
+            lo = 0 if start is None else int(np.searchsorted(t, start, side="left"))
+            hi = len(t) if end is None else int(np.searchsorted(t, end, side="left"))
+            if lo >= hi:
+                continue
+            out = {"t": t[lo:hi]}
+            for col in columns:
+                out[col] = np.load(os.path.join(directory, f"{col}.npy"), mmap_mode="r")[lo:hi]
+            yield out
+
+    def load(self, table, columns, start=None, end=None):
+        """Come iter_months() ma concatena i mesi (copia in RAM solo l'intervallo richiesto)."""
+        parts = list(self.iter_months(table, columns, start, end))
+        if not parts:
+            return {key: np.array([]) for key in ["t"] + list(columns)}
+        return {key: np.concatenate([p[key] for p in parts]) for key in ["t"] + list(columns)}
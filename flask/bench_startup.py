@@ -0,0 +1,107 @@
+# bench_startup.py
+"""
+Tempo di avvio a freddo dei punti di ingresso. Ogni misura è un nuovo
+interprete Python che esegue import, init() e la creazione dei servizi che
+il punto di ingresso usa subito, fermandosi prima dei cicli di lavoro.
+Riporta la mediana di:
+  - wall_s: dall'avvio del processo alla fine (interprete compreso)
+  - ready_s: dal primo import a "pronto" (misurato nel processo)
+  - modules: moduli caricati (sys.modules)
+Esempio:
+    python bench_startup.py --repeat 5
+    python bench_startup.py --only wsgi --importtime
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Punto di ingresso: (modulo importato, attributi di app.py usati subito | None = senza init())
+ENTRY_POINTS = {
+    "app (solo import)": ("app", None),
+    "wsgi.py (worker HTTP)": ("wsgi", []),
+    "supervisor.py": ("supervisor", ["DB_POOL", "WRITE_BEHIND", "SPOOL", "TOKEN_MANAGER", "DEVICES", "LIVE",
+                                     "EVENTS", "ROLLUPS", "SCHEMA", "BLOCKING_EXECUTOR",
+                                     "aiohttp", "tesla_proxy", "charging_solver"]),
+    "shelly_logger.py": ("shelly_logger", ["DB_POOL", "WRITE_BEHIND", "SPOOL", "TOKEN_MANAGER", "DEVICES", "LIVE",
+                                           "EVENTS", "BLOCKING_EXECUTOR", "aiohttp", "tesla_proxy",
+                                           "charging_solver"]),
+    "voltage_logger_runner.py": ("voltage_logger_runner", ["DB_POOL", "WRITE_BEHIND", "SPOOL",
+                                                           "BLOCKING_EXECUTOR", "aiohttp"]),
+    "get_vehicle_data.py": ("get_vehicle_data", ["TOKEN_MANAGER", "aiohttp"]),
+    "rollup_runner.py": ("rollup_runner", ["DB_POOL", "ROLLUPS", "SCHEMA"]),
+}
+
+_SNIPPET = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+warm = {warm!r}
+if warm is not None:
+    import app
+    from lazy import resolve
+    app.init()
+    for name in warm:
+        resolve(getattr(app, name))
+print(json.dumps({{"ready_s": time.perf_counter() - t0, "modules": len(sys.modules)}}))
+"""
+
+
+def measure(module, warm):
+    """Una misura a freddo in un nuovo interprete."""
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", _SNIPPET.format(module=module, warm=warm)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True
+    )
+    wall = time.perf_counter() - start
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result["wall_s"] = wall
+    return result
+
+
+def importtime(module, warm, top=10):
+    """Moduli di primo livello più lenti da importare (python -X importtime)."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _SNIPPET.format(module=module, warm=warm)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2]
+        if name.startswith(" ") and not name.startswith("  "):
+            rows.append((int(parts[1]), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tempo di avvio a freddo dei punti di ingresso.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", help="solo i punti di ingresso che contengono questo testo")
+    parser.add_argument("--importtime", action="store_true", help="mostra anche gli import più lenti")
+    args = parser.parse_args()
+
+    print(f"{'punto di ingresso':<28} {'wall_s':>8} {'ready_s':>8} {'modules':>8}")
+    for name, (module, warm) in ENTRY_POINTS.items():
+        if args.only and args.only not in name:
+            continue
+        runs = [measure(module, warm) for _ in range(args.repeat)]
+        print(f"{name:<28} {statistics.median(r['wall_s'] for r in runs):>8.3f} "
+              f"{statistics.median(r['ready_s'] for r in runs):>8.3f} "
+              f"{int(statistics.median(r['modules'] for r in runs)):>8d}")
+        if args.importtime:
+            for us, module_name in importtime(module, warm):
+                print(f"    {us / 1e6:>8.3f} s  {module_name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# charge_controller.py
+import asyncio
+import time
+from collections import deque
+
+
+class ChargeController:
+    """
+    Strato tra la decisione del ciclo di controllo e l'invio dei comandi Tesla,
+    per ridurre il numero di comandi (lenti e soggetti a rate limit):
+      - isteresi: un aumento di corrente viene inviato solo se supera la
+        corrente attuale di più di 'hysteresis_amps' (con 1 A le oscillazioni
+        di ±1 A vengono assorbite)
+      - permanenza minima: dopo un comando, aumenti e charge_start attendono
+        'min_dwell_s' secondi
+      - coalescenza: mentre un comando è trattenuto conta solo l'ultimo target
+        (i target superati vengono scartati)
+      - budget orario: al massimo 'max_commands_per_hour' comandi nell'ultima ora
+      - ripetizioni: lo stesso comando (stesso valore) inviato da meno di
+        'settle_s' secondi non viene reinviato mentre la corrente misurata
+        si adegua; se il comando fallisce o non viene eseguito si può reinviare
+    Riduzioni di corrente e charge_stop servono a rispettare il limite di
+    prelievo: vengono sempre inviati subito, anche a budget esaurito.
+    Nel budget e in stats["sent"] contano solo i comandi eseguiti davvero
+    (non quelli superati, scaduti o annullati nella coda).
+    execute: async (command, charging_amps_value=None, local_amps=None) -> dict
+             (oppure -> asyncio.Future se i comandi passano da TeslaCommandQueue)
+    """
+    def __init__(self, execute, logger, hysteresis_amps=1, min_dwell_s=120, max_commands_per_hour=20, settle_s=20):
+        self.execute = execute
+        self.logger = logger
+        self.hysteresis_amps = hysteresis_amps
+        self.min_dwell_s = min_dwell_s
+        self.max_commands_per_hour = max_commands_per_hour
+        self.settle_s = settle_s
+
+        self._last_command_time = None
+        self._last_sent = None          # [comando, valore, istante] dell'ultimo invio
+        self._sent_times = deque()
+        self._pending_target = None
+        self.stats = {
+            "sent": 0,
+            "suppressed_hysteresis": 0,
+            "suppressed_dwell": 0,
+            "suppressed_budget": 0,
+            "suppressed_repeat": 0,
+            "superseded": 0,
+            "not_executed": 0,
+        }
+
+    def decide(self, target_amps, current_amps):
+        """Comando corrispondente al target (stessa logica del ciclo di controllo)."""
+        if target_amps == current_amps:
+            return None, None
+        if target_amps == 0:
+            return "charge_stop", None
+        if current_amps == 0:
+            return "charge_start", None
+        return "set_charging_amps", target_amps
+
+    async def apply(self, target_amps, current_amps, local_amps=None):
+        """
+        Applica il target. Ritorna (command, result) se un comando è stato
+        inviato (result è quanto restituito da execute), None se non serve
+        o se è stato trattenuto.
+        """
+        command, value = self.decide(target_amps, current_amps)
+        if command is None:
+            self._pending_target = None
+            return None
+
+        now = time.monotonic()
+        reason = self._suppress_reason(command, value, target_amps, current_amps, now)
+        if reason:
+            if self._pending_target is not None and self._pending_target != target_amps:
+                self.stats["superseded"] += 1
+            self._pending_target = target_amps
+            self.stats[f"suppressed_{reason}"] += 1
+            self.logger.info(
+                f"⏸️ Comando '{command}' ({target_amps} A) trattenuto: {reason}. "
+                f"Soppressi finora: {self.suppressed_total()} (inviati: {self.stats['sent']})"
+            )
+            return None
+
+        self._pending_target = None
+        self._last_command_time = now
+        self._prune_sent(now)
+        self._sent_times.append(now)
+        self.stats["sent"] += 1
+        sent = [command, value, now]
+        self._last_sent = sent
+
+        self.logger.info(f"🔴 Invio comando {command}.")
+        if value is None:
+            result = await self.execute(command, local_amps=local_amps)
+        else:
+            result = await self.execute(command, charging_amps_value=value, local_amps=local_amps)
+
+        if asyncio.isfuture(result):
+            result.add_done_callback(lambda future: self._on_result(sent, self._future_result(future)))
+        else:
+            self._on_result(sent, result)
+        return command, result
+
+    def suppressed_total(self):
+        return (self.stats["suppressed_hysteresis"] + self.stats["suppressed_dwell"]
+                + self.stats["suppressed_budget"] + self.stats["suppressed_repeat"])
+
+    # -------------------- Interni --------------------
+
+    def _prune_sent(self, now):
+        while self._sent_times and now - self._sent_times[0] > 3600:
+            self._sent_times.popleft()
+
+    @staticmethod
+    def _future_result(future):
+        if future.cancelled():
+            return {"status": "cancelled"}
+        if future.exception() is not None:
+            return {"status": "error", "message": str(future.exception())}
+        return future.result()
+
+    def _on_result(self, sent, result):
+        """Esito di un invio: i comandi non eseguiti escono dal budget, quelli falliti si possono ripetere."""
+        status = (result or {}).get("status")
+        if status in ("superseded", "expired", "cancelled"):
+            self.stats["sent"] -= 1
+            self.stats["not_executed"] += 1
+            try:
+                self._sent_times.remove(sent[2])
+            except ValueError:
+                pass
+        if status != "success" and self._last_sent is sent:
+            self._last_sent = None
+
+    def _is_increase(self, command, target_amps, current_amps):
+        return command == "charge_start" or (command == "set_charging_amps" and target_amps > current_amps)
+
+    def _suppress_reason(self, command, value, target_amps, current_amps, now):
+        # Stesso comando appena inviato: la corrente misurata non si è ancora adeguata
+        last = self._last_sent
+        if last is not None and last[:2] == [command, value] and now - last[2] < self.settle_s:
+            return "repeat"
+
+        if not self._is_increase(command, target_amps, current_amps):
+            return None
+
+        if command == "set_charging_amps" and target_amps - current_amps <= self.hysteresis_amps:
+            return "hysteresis"
+
+        if self._last_command_time is not None and now - self._last_command_time < self.min_dwell_s:
+            return "dwell"
+
+        self._prune_sent(now)
+        if len(self._sent_times) >= self.max_commands_per_hour:
+            return "budget"
+
+        return None
@@ -0,0 +1,61 @@
+# charging_solver.py
+import numpy as np
+
+
+def max_allowed_amps(grid_power, grid_voltage, max_power, min_amps=6, max_amps=13,
+                     margin=0.0, phases=1, max_phase_power=None):
+    """
+    Corrente massima di ricarica che rispetta il limite di prelievo dalla rete.
+    Stesso criterio del ciclo 'for amps in range(13, 5, -1)':
+        amps * tensione + potenza_rete < max_power - margin
+    calcolato in forma chiusa (senza cicli), sia per un singolo campione sia
+    per array NumPy di campioni storici.
+
+    grid_power / grid_voltage:
+      - monofase (phases=1): scalari o array (...,)
+      - trifase  (phases=3): array (..., 3), una colonna per fase Shelly;
+        la vettura assorbe 'amps' su ogni fase
+    max_phase_power: limite opzionale per singola fase (W), solo trifase.
+    Ritorna un int (input scalare) o un array di int; 0 se nemmeno 'min_amps'
+    rispetta il limite.
+    """
+    power = np.asarray(grid_power, dtype=float)
+    voltage = np.asarray(grid_voltage, dtype=float)
+    scalar = power.ndim == 0 if phases == 1 else power.ndim == 1
+
+    if phases == 1:
+        amps = _solve(power, voltage, max_power - margin)
+    else:
+        if power.shape[-1] != phases or voltage.shape[-1] != phases:
+            raise ValueError(f"Servono {phases} fasi per la ricarica trifase.")
+        amps = _solve(power.sum(axis=-1), voltage.sum(axis=-1), max_power - margin)
+        if max_phase_power is not None:
+            per_phase = _solve(power, voltage, max_phase_power - margin / phases)
+            amps = np.minimum(amps, per_phase.min(axis=-1))
+
+    amps = np.minimum(amps, max_amps)
+    amps = np.where(amps < min_amps, 0, amps).astype(int)
+    return int(amps) if scalar else amps
+
+
+def _solve(power, voltage, limit):
+    # Massimo intero 'a' con a * voltage + power < limit
+    with np.errstate(divide="ignore", invalid="ignore"):
+        amps = np.floor((limit - power) / voltage)
+    amps = np.where(np.isfinite(amps) & (voltage > 0), amps, -1)
+    # Correzione per gli arrotondamenti: disuguaglianza stretta come nel ciclo originale
+    amps = np.where(amps * voltage + power >= limit, amps - 1, amps)
+    return amps
+
+
+def grid_from_emeters(emeters, grid_phases=(1,)):
+    """
+    Potenza e tensione di rete dalle letture Shelly ('emeters').
+    grid_phases: indici delle fasi di rete (default: fase 2 come in process_shelly_phases).
+    Monofase -> (power, voltage) scalari; più fasi -> array (len(grid_phases),).
+    """
+    power = np.array([emeters[i]["power"] for i in grid_phases], dtype=float)
+    voltage = np.array([emeters[i]["voltage"] for i in grid_phases], dtype=float)
+    if len(grid_phases) == 1:
+        return float(power[0]), float(voltage[0])
+    return power, voltage
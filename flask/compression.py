@@ -0,0 +1,124 @@
+# compression.py
+import math
+
+
+class DeadbandFilter:
+    """
+    Compressione a banda morta: un campione viene salvato solo se si discosta
+    di più di 'deviation' dall'ultimo salvato, o se sono passati
+    'max_interval' secondi (punto di keep-alive).
+    feed(t, value) -> lista dei punti (t, value) da salvare.
+    """
+    def __init__(self, deviation, max_interval=600):
+        self.deviation = deviation
+        self.max_interval = max_interval
+        self._last = None
+
+    def feed(self, t, value):
+        if (self._last is None
+                or abs(value - self._last[1]) > self.deviation
+                or t - self._last[0] >= self.max_interval):
+            self._last = (t, value)
+            return [(t, value)]
+        return []
+
+    def flush(self):
+        return []
+
+
+class SwingingDoor:
+    """
+    Compressione "swinging door": salva i punti necessari a ricostruire la
+    serie per interpolazione lineare con errore massimo 'deviation'.
+    Un punto di keep-alive viene salvato almeno ogni 'max_interval' secondi.
+    feed(t, value) -> lista dei punti (t, value) da salvare.
+    flush() -> ultimo punto ricevuto se non ancora salvato (alla chiusura).
+    """
+    def __init__(self, deviation, max_interval=600):
+        self.deviation = deviation
+        self.max_interval = max_interval
+        self._archived = None     # ultimo punto salvato
+        self._held = None         # ultimo punto ricevuto
+        self._upper = math.inf
+        self._lower = -math.inf
+
+    def feed(self, t, value):
+        if self._archived is None:
+            return self._archive(t, value)
+
+        ta, va = self._archived
+        if t <= ta:
+            return []
+
+        if t - ta >= self.max_interval:
+            out = []
+            if self._held is not None and self._held[0] > ta:
+                out += self._archive(*self._held)
+            return out + self._archive(t, value)
+
+        self._narrow(t, value)
+        if self._lower > self._upper:
+            # Il punto esce dalla "porta": si salva il precedente e si riparte da lì
+            out = self._archive(*self._held)
+            self._held = (t, value)
+            self._narrow(t, value)
+            return out
+
+        self._held = (t, value)
+        return []
+
+    def flush(self):
+        if self._held is not None and self._held != self._archived:
+            return self._archive(*self._held)
+        return []
+
+    def _narrow(self, t, value):
+        ta, va = self._archived
+        dt = t - ta
+        self._upper = min(self._upper, (value + self.deviation - va) / dt)
+        self._lower = max(self._lower, (value - self.deviation - va) / dt)
+
+    def _archive(self, t, value):
+        self._archived = (t, value)
+        self._held = None
+        self._upper = math.inf
+        self._lower = -math.inf
+        return [(t, value)]
+
+
+class IntervalAggregator:
+    """
+    Min / max / media per intervalli fissi di 'interval' secondi (allineati
+    all'epoch), calcolati su tutti i campioni, compressi o no: i picchi brevi
+    non vanno persi.
+    feed(t, value) -> lista degli intervalli completati
+                      (inizio, minimo, massimo, media, numero campioni).
+    """
+    def __init__(self, interval=300):
+        self.interval = interval
+        self._start = None
+        self._min = self._max = self._sum = None
+        self._count = 0
+
+    def feed(self, t, value):
+        start = t - (t % self.interval)
+        out = []
+        if self._start is not None and start != self._start:
+            out = self.flush()
+        if self._start is None:
+            self._start = start
+            self._min = self._max = value
+            self._sum = 0.0
+        self._min = min(self._min, value)
+        self._max = max(self._max, value)
+        self._sum += value
+        self._count += 1
+        return out
+
+    def flush(self):
+        if self._start is None or not self._count:
+            return []
+        result = (self._start, self._min, self._max, self._sum / self._count, self._count)
+        self._start = None
+        self._count = 0
+        return [result]
@@ -0,0 +1,172 @@
+# db_pool.py
+import threading
+import time
+
+import mysql.connector # type: ignore
+from mysql.connector import pooling # type: ignore
+
+
+class PooledConnection:
+    """
+    Wrapper sottile della connessione del pool: close() la restituisce al pool
+    e aggiorna le statistiche. Tutto il resto è delegato alla connessione reale.
+    """
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._released = False
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._pool._release(self._conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class DbPool:
+    """
+    Pool di connessioni MySQL condiviso dal processo.
+      - creato al primo utilizzo (il DB può non essere ancora pronto all'avvio)
+      - health check (ping con riconnessione) a ogni prelievo
+      - attesa limitata (acquire_timeout) quando il pool è esaurito
+      - se il DB è stato riavviato il pool viene ricreato in modo trasparente
+    """
+    def __init__(self, logger, pool_name="energy_monitor", pool_size=5,
+                 acquire_timeout=5.0, retry_interval=5.0, **conn_kwargs):
+        self.logger = logger
+        self.pool_name = pool_name
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        self.retry_interval = retry_interval
+        self.conn_kwargs = conn_kwargs
+
+        self._pool = None
+        self._lock = threading.Lock()
+        self._last_create_attempt = 0.0
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "acquired": 0,
+            "released": 0,
+            "pool_created": 0,
+            "reconnects": 0,
+            "exhausted_waits": 0,
+            "failures": 0,
+            "wait_time_total_s": 0.0,
+            "wait_time_max_s": 0.0,
+        }
+
+    def _count(self, key, value=1):
+        with self._stats_lock:
+            self._stats[key] += value
+
+    # -------------------- Pool --------------------
+
+    def _get_pool(self):
+        if self._pool is not None:
+            return self._pool
+        with self._lock:
+            if self._pool is not None:
+                return self._pool
+            now = time.monotonic()
+            if now - self._last_create_attempt < self.retry_interval:
+                return None
+            self._last_create_attempt = now
+            try:
+                self._pool = pooling.MySQLConnectionPool(
+                    pool_name=self.pool_name,
+                    pool_size=self.pool_size,
+                    pool_reset_session=True,
+                    **self.conn_kwargs
+                )
+                self._count("pool_created")
+                self.logger.info(f"🗄️ Pool MySQL creato ({self.pool_size} connessioni).")
+            except mysql.connector.Error as e:
+                self.logger.error(f"❌ Impossibile creare il pool MySQL: {e}")
+                self._pool = None
+            return self._pool
+
+    def _reset_pool(self):
+        with self._lock:
+            self._pool = None
+            self._last_create_attempt = 0.0
+
+    def _healthy(self, conn):
+        try:
+            if conn.is_connected():
+                return True
+            conn.ping(reconnect=True, attempts=1, delay=0)
+            self._count("reconnects")
+            return True
+        except mysql.connector.Error:
+            return False
+
+    # -------------------- API --------------------
+
+    def acquire(self):
+        """Ritorna una connessione sana dal pool oppure None."""
+        start = time.monotonic()
+        deadline = start + self.acquire_timeout
+        waited = False
+
+        while True:
+            pool = self._get_pool()
+            if pool is None:
+                self._count("failures")
+                return None
+            try:
+                conn = pool.get_connection()
+            except pooling.PoolError:
+                # Pool esaurito: attende che una connessione venga restituita
+                if not waited:
+                    self._count("exhausted_waits")
+                    waited = True
+                if time.monotonic() >= deadline:
+                    self.logger.error("❌ Pool MySQL esaurito: timeout in attesa di una connessione.")
+                    self._count("failures")
+                    return None
+                time.sleep(0.05)
+                continue
+            except mysql.connector.Error as e:
+                # Tipicamente il DB è stato riavviato: ricrea il pool al prossimo giro
+                self.logger.error(f"❌ Errore connessione al DB: {e}")
+                self._reset_pool()
+                self._count("failures")
+                return None
+
+            if not self._healthy(conn):
+                self.logger.warning("⚠️ Connessione MySQL non valida, ricreo il pool.")
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                self._reset_pool()
+                if time.monotonic() >= deadline:
+                    self._count("failures")
+                    return None
+                continue
+
+            elapsed = time.monotonic() - start
+            with self._stats_lock:
+                self._stats["acquired"] += 1
+                self._stats["wait_time_total_s"] += elapsed
+                self._stats["wait_time_max_s"] = max(self._stats["wait_time_max_s"], elapsed)
+            return PooledConnection(self, conn)
+
+    def _release(self, conn):
+        self._count("released")
+        try:
+            conn.close()
+        except Exception as e:
+            self.logger.warning(f"⚠️ Errore restituendo la connessione al pool: {e}")
+
+    def stats(self):
+        with self._stats_lock:
+            s = dict(self._stats)
+        s["pool_size"] = self.pool_size
+        s["in_use"] = s["acquired"] - s["released"]
+        s["available"] = self._pool is not None
+        s["wait_time_avg_s"] = s["wait_time_total_s"] / s["acquired"] if s["acquired"] else 0.0
+        return s
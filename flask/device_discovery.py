@@ -0,0 +1,115 @@
+# device_discovery.py
+import asyncio
+import ipaddress
+import json
+
+import aiohttp
+
+
+class DeviceTarget:
+    """
+    Descrive un dispositivo da cercare sulla LAN:
+      - key:   nome logico (es. 'shelly', 'esp8266', 'esp32_1')
+      - path:  path HTTP da interrogare (es. '/status')
+      - match: funzione (dict JSON) -> bool che riconosce il dispositivo
+    """
+    def __init__(self, key, path, match):
+        self.key = key
+        self.path = path
+        self.match = match
+
+
+def shelly_target(mac, key="shelly"):
+    """Shelly EM: campo 'mac' (maiuscolo, senza separatori)."""
+    mac = (mac or "").upper()
+    return DeviceTarget(key, "/status", lambda d: str(d.get("mac", "")).upper() == mac)
+
+
+def esp8266_target(name, token, key="esp8266"):
+    """ESP8266 personalizzato: campo 'name'."""
+    name = (name or "").lower()
+    return DeviceTarget(key, f"/status?token={token}", lambda d: str(d.get("name", "")).lower() == name)
+
+
+def esp32_target(mac, key="esp32"):
+    """ESP32: campo 'mac_sta'."""
+    mac = (mac or "").lower()
+    return DeviceTarget(key, "/status", lambda d: str(d.get("mac_sta", "")).lower() == mac)
+
+
+def subnet_hosts(subnet):
+    """'192.168.1.0/24' -> ['192.168.1.1', ..., '192.168.1.254']"""
+    return [str(ip) for ip in ipaddress.ip_network(subnet, strict=False).hosts()]
+
+
+async def discover(targets, subnet="192.168.1.0/24", timeout=1.5, concurrency=256, logger=None, hosts=None):
+    """
+    Scansione asincrona della subnet in un solo passaggio.
+    Ogni host viene interrogato una sola volta per ciascun path distinto e la
+    risposta viene confrontata con tutti i target che usano quel path.
+    Con concurrency >= numero di host l'intera subnet viene sondata in parallelo,
+    quindi la scansione dura circa un timeout.
+    'hosts' (opzionale) limita la scansione a una lista esplicita di IP.
+    Ritorna {key: [ip, ...]} con TUTTI gli host che corrispondono.
+    """
+    by_path = {}
+    for t in targets:
+        by_path.setdefault(t.path, []).append(t)
+
+    found = {t.key: [] for t in targets}
+    sem = asyncio.Semaphore(concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    connector = aiohttp.TCPConnector(limit=0, force_close=True)
+
+    async def probe(session, ip, path, path_targets):
+        try:
+            async with session.get(f"http://{ip}{path}") as resp:
+                if resp.status != 200:
+                    return
+                data = json.loads(await resp.text())
+        except Exception as e:
+            if logger:
+                logger.debug(f"[Discovery] Nessuna risposta valida da {ip}{path}: {e}")
+            return
+        if not isinstance(data, dict):
+            return
+        for t in path_targets:
+            try:
+                if t.match(data):
+                    found[t.key].append(ip)
+            except Exception:
+                pass
+
+    async def probe_host(session, ip):
+        async with sem:
+            await asyncio.gather(*(probe(session, ip, path, path_targets)
+                                   for path, path_targets in by_path.items()))
+
+    async with aiohttp.ClientSession(timeout=client_timeout, connector=connector) as session:
+        if hosts is None:
+            hosts = subnet_hosts(subnet)
+        await asyncio.gather(*(probe_host(session, ip) for ip in hosts))
+
+    for key, ips in found.items():
+        ips.sort(key=lambda ip: ipaddress.ip_address(ip))
+        if logger:
+            if len(ips) > 1:
+                logger.warning(f"⚠️ [Discovery] '{key}' trovato su più indirizzi: {ips}")
+            elif ips:
+                logger.info(f"🔎 [Discovery] '{key}' trovato all'indirizzo: {ips[0]}")
+            else:
+                logger.error(f"❌ [Discovery] '{key}' non trovato sulla rete.")
+    return found
+
+
+def discover_sync(targets, **kwargs):
+    """
+    Versione sincrona di discover(), solo per codice senza event loop (script,
+    thread). Dentro un loop attivo bloccherebbe il loop per tutta la scansione:
+    lì usare 'await discover(...)'.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(discover(targets, **kwargs))
+    raise RuntimeError("discover_sync() chiamata da un event loop attivo: usare 'await discover(...)'")
@@ -0,0 +1,174 @@
+# device_registry.py
+import asyncio
+import time
+
+from device_discovery import discover
+
+
+def normalize_mac(mac):
+    """'EC64C9C6BB08' / 'ec:64:c9:c6:bb:08' -> 'ec64c9c6bb08'"""
+    return "".join(c for c in (mac or "").lower() if c in "0123456789abcdef")
+
+
+def read_arp_table(path="/proc/net/arp"):
+    """
+    Legge la tabella ARP/neighbor del kernel.
+    Ritorna {mac_normalizzato: ip} per le sole voci complete (flag 0x2).
+    """
+    table = {}
+    try:
+        with open(path) as f:
+            next(f, None)  # intestazione
+            for line in f:
+                fields = line.split()
+                if len(fields) < 4:
+                    continue
+                ip, flags, mac = fields[0], fields[2], fields[3]
+                if int(flags, 16) & 0x2 and mac != "00:00:00:00:00:00":
+                    table[normalize_mac(mac)] = ip
+    except (OSError, ValueError):
+        pass
+    return table
+
+
+class DeviceEntry:
+    def __init__(self, key, ip, target, mac=None):
+        self.key = key
+        self.ip = ip
+        self.target = target
+        self.mac = normalize_mac(mac) or None
+        self.failures = 0
+        self.last_ok = 0.0
+        self.last_rescan = 0.0
+
+
+class DeviceRegistry:
+    """
+    Registro degli indirizzi dei dispositivi LAN.
+      - una lettura dati riuscita vale come verifica dell'indirizzo (mark_ok)
+      - dopo 'failure_threshold' errori consecutivi prova la tabella ARP
+        (MAC -> IP) e, se non basta, chiede una nuova scansione
+      - le scansioni e le rivalidazioni periodiche girano in background (run())
+    on_change(key, old_ip, new_ip) viene chiamata quando un indirizzo cambia.
+    """
+    def __init__(self, logger, subnet="192.168.1.0/24", timeout=1.5, concurrency=256,
+                 failure_threshold=3, revalidate_interval=600, min_rescan_interval=60,
+                 arp_path="/proc/net/arp", on_change=None):
+        self.logger = logger
+        self.subnet = subnet
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.failure_threshold = failure_threshold
+        self.revalidate_interval = revalidate_interval
+        self.min_rescan_interval = min_rescan_interval
+        self.arp_path = arp_path
+        self.on_change = on_change
+        self._entries = {}
+        self._wakeup = None
+
+    def register(self, key, ip, target, mac=None):
+        self._entries[key] = DeviceEntry(key, ip, target, mac)
+
+    def ip(self, key):
+        entry = self._entries.get(key)
+        return entry.ip if entry else None
+
+    def mark_ok(self, key):
+        entry = self._entries[key]
+        entry.failures = 0
+        entry.last_ok = time.monotonic()
+        if not entry.mac and self.arp_path:
+            # Impara il MAC dell'indirizzo verificato per i lookup ARP futuri
+            for mac, ip in read_arp_table(self.arp_path).items():
+                if ip == entry.ip:
+                    entry.mac = mac
+                    self.logger.info(f"🔗 [Registry] '{key}': MAC {mac} associato a {ip}")
+                    break
+
+    def mark_failure(self, key):
+        entry = self._entries[key]
+        entry.failures += 1
+        if entry.failures < self.failure_threshold:
+            return
+        if self._update_from_arp(entry):
+            return
+        self._wake()
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _update_from_arp(self, entry):
+        if not entry.mac or not self.arp_path:
+            return False
+        ip = read_arp_table(self.arp_path).get(entry.mac)
+        if not ip or ip == entry.ip:
+            return False
+        self.logger.info(f"🔗 [Registry] '{entry.key}' trovato in tabella ARP: {ip}")
+        self._set_ip(entry, ip)
+        return True
+
+    def _set_ip(self, entry, new_ip):
+        old_ip = entry.ip
+        entry.ip = new_ip
+        entry.failures = 0
+        if old_ip != new_ip and self.on_change:
+            try:
+                self.on_change(entry.key, old_ip, new_ip)
+            except Exception as e:
+                self.logger.error(f"❌ [Registry] Errore in on_change per '{entry.key}': {e}")
+
+    async def _revalidate(self, entries):
+        """Verifica solo gli indirizzi correnti (un host per dispositivo)."""
+        for entry in entries:
+            found = await discover([entry.target], timeout=self.timeout, hosts=[entry.ip])
+            if found.get(entry.key):
+                entry.last_ok = time.monotonic()
+                entry.failures = 0
+            else:
+                entry.failures = max(entry.failures, self.failure_threshold)
+                self.logger.warning(f"⚠️ [Registry] '{entry.key}' non risponde più a {entry.ip}")
+
+    async def _rescan(self, entries):
+        now = time.monotonic()
+        entries = [e for e in entries if now - e.last_rescan >= self.min_rescan_interval]
+        if not entries:
+            return
+        for e in entries:
+            e.last_rescan = now
+
+        found = await discover([e.target for e in entries], subnet=self.subnet,
+                               timeout=self.timeout, concurrency=self.concurrency,
+                               logger=self.logger)
+        for entry in entries:
+            ips = found.get(entry.key) or []
+            if ips:
+                self._set_ip(entry, entry.ip if entry.ip in ips else ips[0])
+                entry.last_ok = time.monotonic()
+
+    async def run(self):
+        """Task di background: rivalidazione periodica e scansioni su richiesta."""
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.revalidate_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                now = time.monotonic()
+                stale = [e for e in self._entries.values()
+                         if e.failures < self.failure_threshold
+                         and now - e.last_ok >= self.revalidate_interval]
+                if stale:
+                    await self._revalidate(stale)
+
+                failing = [e for e in self._entries.values()
+                           if e.failures >= self.failure_threshold and not self._update_from_arp(e)]
+                if failing:
+                    await self._rescan(failing)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"❌ [Registry] Errore durante la verifica dei dispositivi: {e}")
@@ -0,0 +1,105 @@
+# downsampling.py
+import numpy as np
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets: sceglie 'n_out' punti che conservano la
+    forma visiva della serie (primo e ultimo punto sempre inclusi).
+    x, y: array NumPy ordinati per x. Ritorna (x, y) ridotti.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+
+    # Confini dei bucket interni (il primo e l'ultimo punto fanno bucket a sé)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0] = 0
+    keep[-1] = n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Media del bucket successivo (per l'ultimo: l'ultimo punto)
+        if i + 2 < len(edges):
+            nlo, nhi = edges[i + 1], edges[i + 2]
+            avg_x, avg_y = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        # Area del triangolo (a, punto del bucket, media successiva)
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+
+    return x[keep], y[keep]
+
+
+def minmax_buckets(x, y, n_out, x_start=None, x_end=None):
+    """
+    Per ogni bucket di tempo a larghezza fissa tiene il punto minimo e il
+    massimo (picchi sempre visibili): al più 'n_out' punti, ordinati per x.
+    I valori NaN vengono ignorati.
+    """
+    valid = ~np.isnan(y)
+    x, y = x[valid], y[valid]
+    if len(x) <= n_out:
+        return x, y
+    buckets = max(n_out // 2, 1)
+    x_start = x[0] if x_start is None else x_start
+    x_end = x[-1] if x_end is None else x_end
+    width = (x_end - x_start) / buckets or 1
+    idx = np.clip(((x - x_start) / width).astype(int), 0, buckets - 1)
+
+    # Ordinando per (bucket, valore) il primo di ogni bucket è il minimo, l'ultimo il massimo
+    order = np.lexsort((y, idx))
+    sorted_idx = idx[order]
+    first = np.r_[True, sorted_idx[1:] != sorted_idx[:-1]]
+    last = np.r_[sorted_idx[1:] != sorted_idx[:-1], True]
+    keep = np.unique(np.concatenate([order[first], order[last]]))
+    return x[keep], y[keep]
+
+
+class StreamingReducer:
+    """
+    Riduzione a blocchi per serie troppo lunghe per stare in memoria:
+    i blocchi di righe (dal cursore) vengono ridotti subito con min/max su
+    'ratio * n_out' bucket di tempo fissi; alla fine LTTB (o min/max) porta
+    il risultato a 'n_out' punti. La memoria dipende da n_out, non dalle righe.
+    """
+    def __init__(self, n_out, x_start, x_end, method="lttb", ratio=4):
+        self.n_out = n_out
+        self.method = method
+        self.x_start = x_start
+        self.x_end = x_end
+        self.n_pre = n_out * ratio
+        self._bucket_width = (x_end - x_start) / max(self.n_pre // 2, 1) or 1
+        self._x = []
+        self._y = []
+        self.rows = 0
+
+    def add(self, x, y):
+        """Aggiunge un blocco ordinato per x."""
+        self.rows += len(x)
+        valid = ~np.isnan(y)
+        x, y = x[valid], y[valid]
+        if not len(x):
+            return
+        # Bucket allineati all'intervallo richiesto: blocchi diversi non si sovrappongono
+        # se non nel bucket di confine, che viene ridotto di nuovo alla fine
+        first = int((x[0] - self.x_start) // self._bucket_width)
+        last = int((x[-1] - self.x_start) // self._bucket_width) + 1
+        n_buckets = max(last - first, 1)
+        bx, by = minmax_buckets(x, y, 2 * n_buckets,
+                                self.x_start + first * self._bucket_width,
+                                self.x_start + last * self._bucket_width)
+        self._x.append(bx)
+        self._y.append(by)
+
+    def result(self):
+        if not self._x:
+            return np.array([]), np.array([])
+        x, y = np.concatenate(self._x), np.concatenate(self._y)
+        if self.method == "minmax":
+            return minmax_buckets(x, y, self.n_out, self.x_start, self.x_end)
+        return lttb(x, y, self.n_out)
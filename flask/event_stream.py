@@ -0,0 +1,123 @@
+# event_stream.py
+import json
+import os
+import time
+
+import numpy as np
+
+
+_HEADER = 4                 # int64: versione, capacità, dimensione slot, eventi pubblicati
+_VERSION = 1
+
+
+class EventLog:
+    """
+    Registro circolare di eventi (misure, decisioni, esiti dei comandi) su un
+    file mappato in memoria condiviso tra il processo del controllo (che
+    pubblica) e Flask (che inoltra ai client SSE).
+      - publish() non attende mai i lettori: scrive uno slot e avanza il contatore
+      - ogni lettore tiene il proprio cursore (numero dell'evento); un client
+        lento che resta indietro di più di 'capacity' eventi perde i più
+        vecchi e riceve il numero di eventi persi, senza rallentare gli altri
+    Ogni slot contiene 4 byte di lunghezza + JSON UTF-8 (max slot_size - 4 byte).
+    """
+    def __init__(self, path, capacity=4096, slot_size=1024):
+        self.path = path
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self._header = None
+        self._slots = None
+
+    def _open(self):
+        if self._slots is not None:
+            return
+        size = 8 * _HEADER + self.capacity * self.slot_size
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fresh = not os.path.exists(self.path) or os.path.getsize(self.path) != size
+        if fresh:
+            with open(self.path, "wb") as f:
+                f.truncate(size)
+        header = np.memmap(self.path, dtype=np.int64, mode="r+", shape=(_HEADER,))
+        if fresh or header[0] != _VERSION or header[1] != self.capacity or header[2] != self.slot_size:
+            header[:] = (_VERSION, self.capacity, self.slot_size, 0)
+        self._header = header
+        self._slots = np.memmap(self.path, dtype=np.uint8, mode="r+", offset=8 * _HEADER,
+                                shape=(self.capacity, self.slot_size))
+
+    # -------------------- Pubblicazione --------------------
+
+    def publish(self, kind, **data):
+        """Pubblica un evento. Ritorna il suo numero (None se troppo grande)."""
+        self._open()
+        payload = json.dumps({"type": kind, "t": round(time.time(), 3), **data}, default=str).encode()
+        if len(payload) > self.slot_size - 4:
+            return None
+        number = int(self._header[3])
+        slot = self._slots[number % self.capacity]
+        slot[:4] = np.frombuffer(len(payload).to_bytes(4, "little"), dtype=np.uint8)
+        slot[4:4 + len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+        # Il contatore avanza solo a slot completo
+        self._header[3] = number + 1
+        return number
+
+    # -------------------- Lettura --------------------
+
+    def head(self):
+        """Numero del prossimo evento (cursore per leggere solo i nuovi)."""
+        self._open()
+        return int(self._header[3])
+
+    def read_since(self, cursor, limit=256):
+        """
+        Eventi a partire da 'cursor'. Ritorna (eventi, nuovo_cursore, persi):
+        eventi = [(numero, dict)], persi = eventi sovrascritti prima della lettura.
+        """
+        self._open()
+        count = int(self._header[3])
+        lost = 0
+        oldest = max(count - self.capacity, 0)
+        if cursor < oldest:
+            lost, cursor = oldest - cursor, oldest
+        stop = min(count, cursor + limit)
+
+        raw = []
+        for number in range(cursor, stop):
+            slot = self._slots[number % self.capacity]
+            length = int.from_bytes(bytes(slot[:4]), "little")
+            raw.append((number, bytes(slot[4:4 + length])))
+
+        # Scartati gli slot che lo scrittore ha riutilizzato durante la lettura
+        valid_from = int(self._header[3]) - self.capacity + 1
+        events = []
+        for number, payload in raw:
+            if number < valid_from:
+                lost += 1
+                continue
+            try:
+                events.append((number, json.loads(payload)))
+            except ValueError:
+                lost += 1
+        return events, stop, lost
+
+
+def sse_stream(log, cursor, types=None, poll_interval=0.2, heartbeat=15.0, limit=256):
+    """
+    Generatore Server-Sent Events per un client. Legge dal registro al ritmo
+    del client: se il client è lento resta indietro solo lui.
+    """
+    last_sent = time.monotonic()
+    yield "retry: 2000\n\n"
+    while True:
+        events, cursor, lost = log.read_since(cursor, limit)
+        if lost:
+            yield f"event: lag\ndata: {json.dumps({'lost': lost})}\n\n"
+        for number, event in events:
+            if types and event.get("type") not in types:
+                continue
+            yield f"id: {number}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            last_sent = time.monotonic()
+        if not events:
+            if time.monotonic() - last_sent >= heartbeat:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(poll_interval)
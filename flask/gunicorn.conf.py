@@ -0,0 +1,25 @@
+# gunicorn.conf.py
+# Server HTTP di produzione, avviato e sorvegliato da supervisor.py.
+# Worker gthread: ogni richiesta lenta (es. /callback verso Tesla, lock sul
+# file di configurazione, MySQL) occupa un solo thread, le altre continuano.
+# Budget dei thread, per worker: HTTP_THREADS (16) thread in totale, di cui al
+# più SSE_MAX_STREAMS (default HTTP_THREADS // 4 = 4) occupati dai client
+# /stream (SSE), che tengono un thread finché restano collegati; oltre il
+# limite /stream risponde 503. Gli altri thread (12) restano sempre alle API
+# (/config_tesla, /live, /callback, ...). Con 2 worker: 8 client SSE, 24
+# thread per le API. Per più dashboard aumentare HTTP_THREADS insieme a
+# SSE_MAX_STREAMS, lasciando sempre thread liberi per le API.
+# Ricarica graduale dei worker: SIGHUP al supervisor (inoltrato a gunicorn).
+import os
+
+bind = f"{os.getenv('HTTP_HOST', '0.0.0.0')}:{os.getenv('HTTP_PORT', '5000')}"
+worker_class = "gthread"
+workers = int(os.getenv("HTTP_WORKERS", "2"))
+threads = int(os.getenv("HTTP_THREADS", "16"))
+keepalive = int(os.getenv("HTTP_KEEPALIVE", "5"))
+timeout = int(os.getenv("HTTP_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("HTTP_GRACEFUL_TIMEOUT", "10"))
+max_requests = int(os.getenv("HTTP_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+accesslog = "-"
+errorlog = "-"                  # anche il log dei worker (app.init(log_file=False))
@@ -0,0 +1,56 @@
+# lazy.py
+import importlib
+import threading
+
+
+class Lazy:
+    """
+    Segnaposto di un oggetto creato al primo accesso a un suo attributo:
+    moduli pesanti (numpy, aiohttp, mysql.connector, ...) e servizi condivisi
+    di app.py vengono caricati solo dai punti di ingresso che li usano davvero.
+      - factory: () -> oggetto reale; se fallisce verrà ritentata al prossimo accesso
+      - require: () -> None se si può costruire, altrimenti il messaggio di errore
+        (es. app.init() non ancora chiamato)
+    La costruzione è protetta da un lock (worker HTTP con più thread).
+    Tutto il resto è delegato all'oggetto reale, come PooledConnection in db_pool.py.
+    """
+    def __init__(self, factory, name, require=None):
+        self._factory = factory
+        self._name = name
+        self._require = require
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        target = self._target
+        if target is None:
+            with self._lock:
+                if self._target is None:
+                    error = self._require() if self._require else None
+                    if error:
+                        raise RuntimeError(f"{self._name}: {error}")
+                    self._target = self._factory()
+                target = self._target
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __repr__(self):
+        state = "caricato" if self._target is not None else "non caricato"
+        return f"<Lazy {self._name} ({state})>"
+
+
+def lazy_module(name):
+    """Modulo importato al primo accesso a un suo attributo."""
+    return Lazy(lambda: importlib.import_module(name), name)
+
+
+def resolve(obj):
+    """Oggetto reale dietro un Lazy (costruito se serve); gli altri oggetti sono restituiti così come sono."""
+    return obj._resolve() if isinstance(obj, Lazy) else obj
+
+
+def is_loaded(obj):
+    """False per un Lazy non ancora costruito (True per ogni altro oggetto)."""
+    return not isinstance(obj, Lazy) or obj._target is not None
@@ -0,0 +1,115 @@
+# live_buffer.py
+import os
+import time
+
+import numpy as np
+
+
+# Campi di ogni campione (una riga float64 per ciclo del controllo)
+LIVE_FIELDS = (
+    "t",                    # epoch (s)
+    "grid_power",
+    "solar_production",
+    "house_consumption",
+    "grid_voltage",
+    "pv_voltage",
+    "grid_current",
+    "pv_current",
+    "tesla_amps",           # corrente letta dall'ESP8266
+    "max_allowed_amps",     # NaN se STATE = OFF
+    "valid",                # 1 se le misure Shelly sono valide
+)
+
+_HEADER = 4                 # int64: versione, capacità, campioni scritti, sequenza
+_VERSION = 1
+
+
+class RingBuffer:
+    """
+    Buffer circolare a dimensione fissa degli ultimi campioni elaborati,
+    su un file mappato in memoria (default in /dev/shm): il processo del
+    controllo scrive, Flask legge, senza passare dal database.
+      - una matrice float64 (capacity x campi), nessun dict per campione
+      - un solo scrittore; i lettori usano un seqlock (sequenza dispari =
+        scrittura in corso) e riprovano se la lettura si sovrappone
+    """
+    def __init__(self, path, capacity, fields=LIVE_FIELDS):
+        self.path = path
+        self.capacity = capacity
+        self.fields = fields
+        self._index = {name: i for i, name in enumerate(fields)}
+        self._header = None
+        self._data = None
+
+    def _open(self):
+        if self._data is not None:
+            return
+        row_bytes = 8 * len(self.fields)
+        size = 8 * _HEADER + row_bytes * self.capacity
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fresh = not os.path.exists(self.path) or os.path.getsize(self.path) != size
+        if fresh:
+            with open(self.path, "wb") as f:
+                f.truncate(size)
+        header = np.memmap(self.path, dtype=np.int64, mode="r+", shape=(_HEADER,))
+        if fresh or header[0] != _VERSION or header[1] != self.capacity:
+            header[:] = (_VERSION, self.capacity, 0, 0)
+        self._header = header
+        self._data = np.memmap(self.path, dtype=np.float64, mode="r+", offset=8 * _HEADER,
+                               shape=(self.capacity, len(self.fields)))
+
+    # -------------------- Scrittura --------------------
+
+    def append(self, **values):
+        """Aggiunge un campione (campi mancanti = NaN, 't' di default = adesso)."""
+        self._open()
+        row = np.full(len(self.fields), np.nan)
+        row[self._index["t"]] = time.time()
+        for name, value in values.items():
+            row[self._index[name]] = np.nan if value is None else value
+
+        header = self._header
+        header[3] += 1                              # sequenza dispari: scrittura in corso
+        self._data[header[2] % self.capacity] = row
+        header[2] += 1
+        header[3] += 1
+
+    # -------------------- Lettura --------------------
+
+    def _snapshot(self, last_n):
+        """Copia coerente degli ultimi 'last_n' campioni, in ordine cronologico."""
+        self._open()
+        header = self._header
+        for _ in range(100):
+            seq = int(header[3])
+            if seq % 2:
+                time.sleep(0.0001)
+                continue
+            count = int(header[2])
+            n = min(last_n, count, self.capacity)
+            idx = (np.arange(count - n, count) % self.capacity) if n else np.array([], dtype=int)
+            rows = np.array(self._data[idx])
+            if int(header[3]) == seq:
+                return rows
+        raise RuntimeError("Buffer live occupato")
+
+    def latest(self):
+        rows = self._snapshot(1)
+        if not len(rows):
+            return None
+        return {name: (None if np.isnan(v) else float(v)) for name, v in zip(self.fields, rows[0])}
+
+    def window(self, seconds, fields=None):
+        """Campioni degli ultimi 'seconds' secondi: {campo: lista} (NaN -> None)."""
+        rows = self._snapshot(self.capacity)
+        if len(rows):
+            rows = rows[rows[:, self._index["t"]] >= time.time() - seconds]
+        out = {}
+        for name in fields or self.fields:
+            column = rows[:, self._index[name]] if len(rows) else np.array([])
+            out[name] = [None if np.isnan(v) else round(float(v), 4) for v in column]
+        return out
+
+    def count(self):
+        self._open()
+        return int(min(self._header[2], self.capacity))
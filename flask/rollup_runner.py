@@ -0,0 +1,30 @@
+import sys
+import time
+from datetime import datetime
+from app import init, ROLLUPS, SCHEMA, install_shutdown_handler, logger
+from schema import MANAGED_TABLES
+
+if __name__ == "__main__":
+    init()
+    install_shutdown_handler()
+    if len(sys.argv) == 5 and sys.argv[1] == "backfill":
+        # python rollup_runner.py backfill shelly_emeters 2026-01-01 2026-02-01
+        ROLLUPS.ensure_tables()
+        ROLLUPS.backfill(sys.argv[2], datetime.fromisoformat(sys.argv[3]), datetime.fromisoformat(sys.argv[4]))
+    elif len(sys.argv) == 2 and sys.argv[1] == "migrate":
+        # Una tantum: indici mancanti e partizioni mensili (ricostruisce le tabelle)
+        SCHEMA.ensure_indexes()
+        for table in MANAGED_TABLES:
+            SCHEMA.partition_table(table)
+    elif len(sys.argv) == 2 and sys.argv[1] == "retention":
+        SCHEMA.maintain()
+    else:
+        # Controllo all'avvio: segnala gli indici mancanti
+        try:
+            SCHEMA.check_indexes()
+        except Exception as e:
+            logger.error(f"❌ [Schema] Controllo indici non riuscito: {e}")
+        SCHEMA.start()
+        ROLLUPS.start()
+        while True:
+            time.sleep(3600)
\ No newline at end of file
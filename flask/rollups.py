@@ -0,0 +1,336 @@
+# rollups.py
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+def _phases(*names):
+    return [f"{name}_{i}" for i in (1, 2, 3) for name in names]
+
+
+# Tabelle sorgente: grandezze istantanee (avg/min/max) e contatori cumulativi (delta)
+ROLLUP_SOURCES = {
+    "shelly_emeters": {
+        "gauges": _phases("power", "pf", "current", "voltage"),
+        "counters": _phases("total", "total_returned"),
+    },
+    "tesla_status": {
+        "gauges": ["charging_amps", "battery_level"],
+        "counters": [],
+    },
+    "litum_battery": {
+        "gauges": ["voltage"],
+        "counters": [],
+    },
+}
+
+# Livelli: suffisso tabella, durata, espressione del bucket (dal livello precedente)
+ROLLUP_LEVELS = [
+    ("1m", timedelta(minutes=1), "DATE_FORMAT({col}, '%Y-%m-%d %H:%i:00')"),
+    ("1h", timedelta(hours=1), "DATE_FORMAT({col}, '%Y-%m-%d %H:00:00')"),
+    ("1d", timedelta(days=1), "DATE({col})"),
+]
+
+# Righe precedenti considerate per il primo delta dei contatori
+COUNTER_LOOKBACK = timedelta(hours=1)
+
+
+def floor_time(ts, step):
+    """Arrotonda per difetto a un multiplo di 'step' (minuto, ora, giorno)."""
+    if step >= timedelta(days=1):
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    if step >= timedelta(hours=1):
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(second=0, microsecond=0)
+
+
+def rollup_table(source, level):
+    return f"{source}_{level}"
+
+
+class RollupManager:
+    """
+    Aggregati incrementali per Grafana: per ogni tabella sorgente mantiene
+    le tabelle <tabella>_1m, _1h e _1d con:
+      - samples
+      - <col>_avg / _min / _max per le grandezze istantanee
+      - <col>_delta per i contatori di energia (total_*): somma degli
+        incrementi tra campioni consecutivi (azzeramenti del contatore ignorati)
+    1m viene calcolato dai dati grezzi, 1h da 1m e 1d da 1h.
+    Solo i bucket completi (più vecchi di 'settle_s') vengono elaborati; il
+    punto raggiunto è salvato in rollup_watermark, nella stessa transazione
+    dei dati. Le scritture sono upsert: backfill() può ricalcolare qualunque
+    intervallo in modo idempotente.
+    Righe arrivate in ritardo (es. reinviate dallo spool dopo un disservizio
+    del DB) hanno un timestamp già sotto il watermark: ad ogni giro le righe
+    con id oltre l'ultimo visto (rollup_cursor) e timestamp sotto il watermark
+    fanno ricalcolare i bucket dal loro timestamp in poi.
+    get_connection: () -> (conn, cursor) | (None, None)
+    """
+    def __init__(self, logger, get_connection, sources=None, settle_s=120,
+                 chunk=timedelta(days=1), interval=60):
+        self.logger = logger
+        self.get_connection = get_connection
+        self.sources = sources or ROLLUP_SOURCES
+        self.settle_s = settle_s
+        self.chunk = chunk
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {"runs": 0, "buckets": 0, "errors": 0, "last_run_at": None}
+
+    # -------------------- Schema --------------------
+
+    def ensure_tables(self):
+        conn, cursor = self.get_connection()
+        if not conn:
+            return False
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS rollup_watermark (
+                    source VARCHAR(64) NOT NULL,
+                    level VARCHAR(8) NOT NULL,
+                    watermark DATETIME NOT NULL,
+                    PRIMARY KEY (source, level)
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS rollup_cursor (
+                    source VARCHAR(64) NOT NULL PRIMARY KEY,
+                    last_id BIGINT NOT NULL
+                )
+            """)
+            for source, spec in self.sources.items():
+                columns = ["samples INT NOT NULL"]
+                for col in spec["gauges"]:
+                    columns += [f"{col}_avg DOUBLE", f"{col}_min DOUBLE", f"{col}_max DOUBLE"]
+                columns += [f"{col}_delta DOUBLE" for col in spec["counters"]]
+                for level, _, _ in ROLLUP_LEVELS:
+                    cursor.execute(
+                        f"CREATE TABLE IF NOT EXISTS {rollup_table(source, level)} ("
+                        f"bucket DATETIME NOT NULL PRIMARY KEY, {', '.join(columns)})"
+                    )
+            conn.commit()
+            return True
+        finally:
+            cursor.close()
+            conn.close()
+
+    # -------------------- API --------------------
+
+    def run_once(self, now=None):
+        """Elabora i bucket completi arrivati dall'ultimo watermark. Ritorna i bucket scritti."""
+        with self._lock:
+            now = now or datetime.now()
+            limit = now - timedelta(seconds=self.settle_s)
+            total = 0
+            for source in self.sources:
+                total += self._catch_up_late(source)
+                upper = limit
+                for level, step, _ in ROLLUP_LEVELS:
+                    upper = floor_time(upper, step)
+                    total += self._advance(source, level, step, upper)
+                    # Il livello successivo si ferma dove è arrivato questo
+                    upper = min(upper, self._get_watermark(source, level) or upper)
+            self.stats["runs"] += 1
+            self.stats["buckets"] += total
+            self.stats["last_run_at"] = now.strftime("%Y-%m-%d %H:%M:%S")
+            return total
+
+    def backfill(self, source, start, end):
+        """Ricalcola tutti i livelli tra start ed end (idempotente, watermark invariato)."""
+        with self._lock:
+            written = 0
+            for level, step, _ in ROLLUP_LEVELS:
+                lower, upper = floor_time(start, step), floor_time(end, step)
+                if upper < end:
+                    upper += step
+                while lower < upper:
+                    stop = min(lower + self.chunk, upper)
+                    written += self._rollup(source, level, lower, stop, update_watermark=False)
+                    lower = stop
+            self.logger.info(f"📊 [Rollup] Backfill {source} {start} → {end}: {written} bucket.")
+            return written
+
+    def start(self):
+        """Avvia (una sola volta) il thread periodico."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="rollups", daemon=True)
+        self._thread.start()
+
+    # -------------------- Interni --------------------
+
+    def _advance(self, source, level, step, upper):
+        lower = self._get_watermark(source, level)
+        if lower is None:
+            lower = self._first_time(source, level)
+            if lower is None:
+                return 0
+            lower = floor_time(lower, step)
+
+        written = 0
+        while lower < upper:
+            stop = min(floor_time(lower + self.chunk, step), upper)
+            if stop <= lower:
+                stop = upper
+            written += self._rollup(source, level, lower, stop, update_watermark=True)
+            lower = stop
+        return written
+
+    def _catch_up_late(self, source):
+        """Ricalcola i bucket già elaborati che hanno ricevuto righe in ritardo."""
+        max_id = self._fetch_one(f"SELECT MAX(id) FROM {source}")[0]
+        if max_id is None:
+            return 0
+        row = self._fetch_one("SELECT last_id FROM rollup_cursor WHERE source = %s", (source,))
+        watermark = self._get_watermark(source, ROLLUP_LEVELS[0][0])
+
+        written = 0
+        if row is not None and watermark is not None and max_id > row[0]:
+            late = self._fetch_one(
+                f"SELECT MIN(timestamp) FROM {source} WHERE id > %s AND id <= %s AND timestamp < %s",
+                (row[0], max_id, watermark)
+            )[0]
+            if late is not None:
+                for level, step, _ in ROLLUP_LEVELS:
+                    upper = self._get_watermark(source, level)
+                    if upper is None:
+                        break
+                    lower = floor_time(late, step)
+                    while lower < upper:
+                        stop = min(lower + self.chunk, upper)
+                        written += self._rollup(source, level, lower, stop, update_watermark=False)
+                        lower = stop
+                self.logger.info(f"📊 [Rollup] {source}: righe in ritardo dal {late}, {written} bucket ricalcolati.")
+
+        if row is None or max_id > row[0]:
+            self._execute(
+                "INSERT INTO rollup_cursor (source, last_id) VALUES (%s, %s) "
+                "ON DUPLICATE KEY UPDATE last_id = GREATEST(last_id, VALUES(last_id))",
+                (source, max_id)
+            )
+        return written
+
+    def _rollup(self, source, level, start, end, update_watermark):
+        query, params = self._build_query(source, level, start, end)
+        conn, cursor = self.get_connection()
+        if not conn:
+            raise RuntimeError("Database non disponibile")
+        try:
+            cursor.execute(query, params)
+            written = cursor.rowcount
+            if update_watermark:
+                cursor.execute(
+                    "INSERT INTO rollup_watermark (source, level, watermark) VALUES (%s, %s, %s) "
+                    "ON DUPLICATE KEY UPDATE watermark = GREATEST(watermark, VALUES(watermark))",
+                    (source, level, end)
+                )
+            conn.commit()
+            return max(written, 0)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _build_query(self, source, level, start, end):
+        spec = self.sources[source]
+        gauges, counters = spec["gauges"], spec["counters"]
+        index = [lvl for lvl, _, _ in ROLLUP_LEVELS].index(level)
+        target = rollup_table(source, level)
+
+        out_cols = ["bucket", "samples"]
+        for col in gauges:
+            out_cols += [f"{col}_avg", f"{col}_min", f"{col}_max"]
+        out_cols += [f"{col}_delta" for col in counters]
+        update = ", ".join(f"{c} = VALUES({c})" for c in out_cols[1:])
+
+        if index == 0:
+            # Dai dati grezzi: i delta dei contatori usano anche le righe prima di 'start'
+            bucket = ROLLUP_LEVELS[0][2].format(col="timestamp")
+            deltas = "".join(
+                f", {col} - LAG({col}) OVER (ORDER BY timestamp) AS d_{col}" for col in counters
+            )
+            select = ["COUNT(*)"]
+            for col in gauges:
+                select += [f"AVG({col})", f"MIN({col})", f"MAX({col})"]
+            select += [f"SUM(GREATEST(d_{col}, 0))" for col in counters]
+            inner_cols = ", ".join(["timestamp"] + gauges)
+            lookback = start - COUNTER_LOOKBACK if counters else start
+            query = (
+                f"INSERT INTO {target} ({', '.join(out_cols)}) "
+                f"SELECT {bucket} AS b, {', '.join(select)} FROM ("
+                f"SELECT {inner_cols}{deltas} FROM {source} "
+                f"WHERE timestamp >= %s AND timestamp < %s"
+                f") r WHERE timestamp >= %s GROUP BY b "
+                f"ON DUPLICATE KEY UPDATE {update}"
+            )
+            return query, (lookback, end, start)
+
+        # Dal livello precedente: media pesata sul numero di campioni
+        lower = rollup_table(source, ROLLUP_LEVELS[index - 1][0])
+        bucket = ROLLUP_LEVELS[index][2].format(col="bucket")
+        select = ["SUM(samples)"]
+        for col in gauges:
+            select += [f"SUM({col}_avg * samples) / SUM(samples)", f"MIN({col}_min)", f"MAX({col}_max)"]
+        select += [f"SUM({col}_delta)" for col in counters]
+        query = (
+            f"INSERT INTO {target} ({', '.join(out_cols)}) "
+            f"SELECT {bucket} AS b, {', '.join(select)} FROM {lower} "
+            f"WHERE bucket >= %s AND bucket < %s GROUP BY b "
+            f"ON DUPLICATE KEY UPDATE {update}"
+        )
+        return query, (start, end)
+
+    def _get_watermark(self, source, level):
+        row = self._fetch_one(
+            "SELECT watermark FROM rollup_watermark WHERE source = %s AND level = %s", (source, level)
+        )
+        return row[0] if row else None
+
+    def _first_time(self, source, level):
+        index = [lvl for lvl, _, _ in ROLLUP_LEVELS].index(level)
+        if index == 0:
+            row = self._fetch_one(f"SELECT MIN(timestamp) FROM {source}")
+        else:
+            row = self._fetch_one(f"SELECT MIN(bucket) FROM {rollup_table(source, ROLLUP_LEVELS[index - 1][0])}")
+        return row[0] if row else None
+
+    def _fetch_one(self, query, params=()):
+        conn, cursor = self.get_connection()
+        if not conn:
+            raise RuntimeError("Database non disponibile")
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _execute(self, query, params=()):
+        conn, cursor = self.get_connection()
+        if not conn:
+            raise RuntimeError("Database non disponibile")
+        try:
+            cursor.execute(query, params)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _run(self):
+        tables_ready = False
+        while True:
+            try:
+                if not tables_ready:
+                    tables_ready = self.ensure_tables()
+                if tables_ready:
+                    written = self.run_once()
+                    if written:
+                        self.logger.info(f"📊 [Rollup] {written} bucket aggiornati.")
+            except Exception as e:
+                self.stats["errors"] += 1
+                self.logger.error(f"❌ [Rollup] Errore durante l'aggiornamento: {e}")
+            time.sleep(self.interval)
@@ -0,0 +1,254 @@
+# schema.py
+import threading
+import time
+from datetime import date
+
+
+# Tabelle di misura gestite dall'app: indici richiesti (colonne, nel loro ordine)
+MANAGED_TABLES = {
+    "shelly_emeters": {"indexes": {"idx_timestamp": ("timestamp",)}},
+    "tesla_status": {"indexes": {"idx_timestamp": ("timestamp",)}},
+    "litum_battery": {"indexes": {"idx_timestamp": ("timestamp",),
+                                  "idx_sent_by_timestamp": ("sent_by", "timestamp")}},
+}
+
+
+def month_start(d, offset=0):
+    """Primo giorno del mese di 'd' spostato di 'offset' mesi."""
+    month = d.year * 12 + (d.month - 1) + offset
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(d):
+    return f"p{d.year:04d}{d.month:02d}"
+
+
+class SchemaManager:
+    """
+    Schema delle tabelle di misura:
+      - check_indexes(): indici mancanti (controllo all'avvio, solo report)
+      - ensure_indexes(): crea gli indici mancanti
+      - partition_table(): migrazione una tantum a partizioni mensili
+        RANGE sul timestamp (la chiave primaria diventa (id, timestamp))
+      - ensure_partitions(): crea in anticipo le partizioni dei prossimi mesi
+      - apply_retention(): elimina le partizioni più vecchie di
+        'retention_months' con DROP PARTITION (niente DELETE lenti)
+    before_drop: (table, partition, start, end) -> bool, chiamata prima di
+    eliminare una partizione; se ritorna False la partizione viene tenuta.
+    get_connection: () -> (conn, cursor) | (None, None)
+    """
+    def __init__(self, logger, get_connection, tables=None, retention_months=12,
+                 future_months=3, interval=86400, before_drop=None):
+        self.logger = logger
+        self.get_connection = get_connection
+        self.tables = tables or MANAGED_TABLES
+        self.retention_months = retention_months
+        self.future_months = future_months
+        self.interval = interval
+        self.before_drop = before_drop
+        self._thread = None
+
+    # -------------------- Indici --------------------
+
+    def check_indexes(self):
+        """Ritorna [(tabella, nome_indice, colonne)] degli indici mancanti e li segnala nel log."""
+        missing = []
+        for table, spec in self.tables.items():
+            existing = self._index_columns(table)
+            if existing is None:
+                continue
+            for name, columns in spec["indexes"].items():
+                if not any(cols[:len(columns)] == columns for cols in existing):
+                    missing.append((table, name, columns))
+        for table, name, columns in missing:
+            self.logger.warning(f"⚠️ [Schema] Indice mancante su {table}: {name} ({', '.join(columns)})")
+        if not missing:
+            self.logger.info("✅ [Schema] Indici delle tabelle di misura presenti.")
+        return missing
+
+    def ensure_indexes(self):
+        created = 0
+        for table, name, columns in self.check_indexes():
+            self._execute(f"ALTER TABLE {table} ADD INDEX {name} ({', '.join(columns)})")
+            self.logger.info(f"✅ [Schema] Creato indice {name} su {table}.")
+            created += 1
+        return created
+
+    # -------------------- Partizioni --------------------
+
+    def partitions(self, table):
+        """[(nome, limite_superiore)] delle partizioni RANGE, in ordine; [] se non partizionata."""
+        rows = self._query(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION",
+            (table,)
+        )
+        return [(name, description) for name, description in rows]
+
+    def partition_table(self, table, today=None):
+        """
+        Migrazione a partizioni mensili (ricostruisce la tabella: da eseguire
+        a sistema fermo o in un momento tranquillo).
+        """
+        if self.partitions(table):
+            self.logger.info(f"ℹ️ [Schema] {table} è già partizionata.")
+            return False
+        today = today or date.today()
+        first = self._query(f"SELECT MIN(timestamp) FROM {table}")[0][0]
+        first = month_start(first or today)
+        last = month_start(today, self.future_months)
+
+        expr = self._partition_expr(table)
+        parts = []
+        month = first
+        while month <= last:
+            upper = month_start(month, 1)
+            parts.append(f"PARTITION {partition_name(month)} VALUES LESS THAN ({self._bound(expr, upper)})")
+            month = upper
+        parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+
+        # Con il partizionamento ogni chiave unica deve contenere la colonna di partizione
+        if self._has_primary_on_id(table):
+            self._execute(f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)")
+        self._execute(f"ALTER TABLE {table} PARTITION BY RANGE ({expr}) ({', '.join(parts)})")
+        self.logger.info(f"✅ [Schema] {table} partizionata per mese ({len(parts) - 1} partizioni).")
+        return True
+
+    def ensure_partitions(self, today=None):
+        """Aggiunge le partizioni mensili fino a 'future_months' mesi avanti (divise da pmax)."""
+        today = today or date.today()
+        added = 0
+        for table in self.tables:
+            parts = self.partitions(table)
+            if not parts:
+                continue
+            names = {name for name, _ in parts}
+            expr = self._partition_expr(table)
+            new = []
+            for offset in range(0, self.future_months + 1):
+                month = month_start(today, offset)
+                if partition_name(month) not in names:
+                    new.append(
+                        f"PARTITION {partition_name(month)} VALUES LESS THAN "
+                        f"({self._bound(expr, month_start(month, 1))})"
+                    )
+            if not new or "pmax" not in names:
+                continue
+            # pmax è vuota se le partizioni vengono create in anticipo: la riorganizzazione è immediata
+            self._execute(
+                f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO "
+                f"({', '.join(new)}, PARTITION pmax VALUES LESS THAN MAXVALUE)"
+            )
+            added += len(new)
+            self.logger.info(f"✅ [Schema] {table}: aggiunte {len(new)} partizioni mensili.")
+        return added
+
+    def apply_retention(self, today=None):
+        """Elimina le partizioni interamente più vecchie della finestra di retention."""
+        today = today or date.today()
+        cutoff = month_start(today, -self.retention_months)
+        dropped = 0
+        for table in self.tables:
+            parts = self.partitions(table)
+            if not parts:
+                self.logger.warning(f"⚠️ [Schema] {table} non è partizionata: retention non applicata.")
+                continue
+            for name, _ in parts:
+                start = self._partition_month(name)
+                if start is None or month_start(start, 1) > cutoff:
+                    continue
+                end = month_start(start, 1)
+                if self.before_drop and not self.before_drop(table, name, start, end):
+                    self.logger.warning(f"⚠️ [Schema] Partizione {table}.{name} mantenuta (pre-eliminazione fallita).")
+                    continue
+                self._execute(f"ALTER TABLE {table} DROP PARTITION {name}")
+                dropped += 1
+                self.logger.info(f"🗑️ [Schema] Eliminata partizione {table}.{name} (dati di {start:%Y-%m}).")
+        return dropped
+
+    def maintain(self):
+        self.ensure_partitions()
+        self.apply_retention()
+
+    def start(self):
+        """Avvia (una sola volta) il thread di manutenzione giornaliera."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="schema-maintenance", daemon=True)
+        self._thread.start()
+
+    # -------------------- Interni --------------------
+
+    def _partition_month(self, name):
+        try:
+            return date(int(name[1:5]), int(name[5:7]), 1)
+        except ValueError:
+            return None
+
+    def _partition_expr(self, table):
+        # TIMESTAMP si partiziona solo con UNIX_TIMESTAMP(), DATETIME con TO_DAYS()
+        rows = self._query(
+            "SELECT DATA_TYPE FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = 'timestamp'",
+            (table,)
+        )
+        data_type = rows[0][0].lower() if rows else "datetime"
+        return "UNIX_TIMESTAMP(timestamp)" if data_type == "timestamp" else "TO_DAYS(timestamp)"
+
+    def _bound(self, expr, day):
+        func = expr.split("(")[0]
+        return f"{func}('{day:%Y-%m-%d} 00:00:00')" if func == "UNIX_TIMESTAMP" else f"{func}('{day:%Y-%m-%d}')"
+
+    def _has_primary_on_id(self, table):
+        rows = self._query(
+            "SELECT COLUMN_NAME FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = 'PRIMARY' "
+            "ORDER BY SEQ_IN_INDEX",
+            (table,)
+        )
+        return [r[0] for r in rows] == ["id"]
+
+    def _index_columns(self, table):
+        rows = self._query(
+            "SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s ORDER BY INDEX_NAME, SEQ_IN_INDEX",
+            (table,)
+        )
+        if not rows and not self._query("SHOW TABLES LIKE %s", (table,)):
+            self.logger.warning(f"⚠️ [Schema] Tabella {table} non trovata.")
+            return None
+        indexes = {}
+        for name, column in rows:
+            indexes.setdefault(name, []).append(column)
+        return [tuple(cols) for cols in indexes.values()]
+
+    def _query(self, query, params=()):
+        conn, cursor = self.get_connection()
+        if not conn:
+            raise RuntimeError("Database non disponibile")
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _execute(self, query, params=()):
+        conn, cursor = self.get_connection()
+        if not conn:
+            raise RuntimeError("Database non disponibile")
+        try:
+            cursor.execute(query, params)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _run(self):
+        while True:
+            try:
+                self.maintain()
+            except Exception as e:
+                self.logger.error(f"❌ [Schema] Errore durante la manutenzione: {e}")
+            time.sleep(self.interval)
@@ -1,5 +1,7 @@
 import asyncio
-from app import shelly_logger
+from app import init, shelly_logger, install_shutdown_handler
 
 if __name__ == "__main__":
+    init()
+    install_shutdown_handler()
     asyncio.run(shelly_logger())
\ No newline at end of file
@@ -0,0 +1,281 @@
+# simulator.py
+"""
+Simulatore "what-if" del controllo di ricarica sullo storico.
+
+Rigioca la logica di shelly_logger() (calcolo della corrente + ChargeController)
+sui dati di shelly_emeters e tesla_status, senza Tesla né dispositivi.
+Il tempo avanza campione per campione, ma ogni passo è vettoriale su tutti i
+set di parametri: un mese di campioni a 30 s per decine di set richiede pochi
+secondi. sweep() distribuisce i set su più processi.
+
+Esempio:
+    python simulator.py --start 2026-09-01 --end 2026-10-01 \\
+        --max-power 3000,3500,4000 --period 30,60 --hysteresis 1,2
+"""
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from charging_solver import max_allowed_amps
+
+
+DEFAULT_PARAMS = {
+    "max_power": 3500.0,          # MAX_ENERGY_PRELEVABILE (W)
+    "period": 30,                 # secondi tra i cicli di polling
+    "min_amps": 6,
+    "max_amps": 13,
+    "margin": 0.0,                # margine di sicurezza (W)
+    "hysteresis_amps": 1,
+    "min_dwell_s": 120,
+    "max_commands_per_hour": 20,
+}
+
+
+# -------------------- Storico --------------------
+
+def load_history(get_connection, start, end):
+    """
+    Carica lo storico in blocco. Ritorna un dict di array NumPy allineati ai
+    campioni Shelly: t (epoch s), pv_power, grid_power, grid_voltage, tesla_amps.
+    get_connection: () -> (conn, cursor) | (None, None)
+    """
+    conn, cursor = get_connection()
+    if not conn:
+        raise RuntimeError("Database non disponibile")
+    try:
+        cursor.execute(
+            "SELECT UNIX_TIMESTAMP(timestamp), power_1, power_2, voltage_2 FROM shelly_emeters "
+            "WHERE timestamp >= %s AND timestamp < %s ORDER BY timestamp",
+            (start, end)
+        )
+        shelly = np.array(cursor.fetchall(), dtype=float).reshape(-1, 4)
+        cursor.execute(
+            "SELECT UNIX_TIMESTAMP(timestamp), charging_amps FROM tesla_status "
+            "WHERE timestamp >= %s AND timestamp < %s ORDER BY timestamp",
+            (start, end)
+        )
+        tesla = np.array(cursor.fetchall(), dtype=float).reshape(-1, 2)
+    finally:
+        cursor.close()
+        conn.close()
+
+    return build_history(shelly[:, 0], shelly[:, 1], shelly[:, 2], shelly[:, 3], tesla[:, 0], tesla[:, 1])
+
+
+def load_history_archive(archive, start, end):
+    """Come load_history(), ma dall'archivio freddo (ColdArchive) mappato in memoria."""
+    shelly = archive.load("shelly_emeters", ["power_1", "power_2", "voltage_2"], start.timestamp(), end.timestamp())
+    tesla = archive.load("tesla_status", ["charging_amps"], start.timestamp(), end.timestamp())
+    return build_history(shelly["t"], shelly["power_1"], shelly["power_2"], shelly["voltage_2"],
+                         tesla["t"], tesla["charging_amps"])
+
+
+def build_history(t, pv_power, grid_power, grid_voltage, tesla_t, tesla_amps):
+    """Allinea le letture Tesla ai campioni Shelly (ultimo valore noto)."""
+    if len(tesla_t) == 0:
+        amps = np.zeros(len(t))
+    else:
+        idx = np.searchsorted(tesla_t, t, side="right") - 1
+        amps = np.where(idx >= 0, np.asarray(tesla_amps, dtype=float)[np.clip(idx, 0, None)], 0.0)
+    return {
+        "t": np.asarray(t, dtype=float),
+        "pv_power": np.asarray(pv_power, dtype=float),
+        "grid_power": np.asarray(grid_power, dtype=float),
+        "grid_voltage": np.asarray(grid_voltage, dtype=float),
+        "tesla_amps": amps,
+    }
+
+
+def resample(history, period):
+    """Un campione ogni 'period' secondi (l'ultimo disponibile), come il ciclo di polling."""
+    t = history["t"]
+    if len(t) == 0:
+        return {k: v[:0] for k, v in history.items()}
+    grid = np.arange(t[0], t[-1] + 1e-9, period)
+    idx = np.clip(np.searchsorted(t, grid, side="right") - 1, 0, len(t) - 1)
+    out = {k: v[idx] for k, v in history.items()}
+    out["t"] = grid
+    return out
+
+
+# -------------------- Simulazione --------------------
+
+def simulate(history, param_sets):
+    """
+    Simula più set di parametri con lo stesso 'period'.
+    Ritorna una lista di risultati (uno per set, nello stesso ordine).
+    """
+    if not param_sets:
+        return []
+    params = [dict(DEFAULT_PARAMS, **p) for p in param_sets]
+    period = params[0]["period"]
+    if any(p["period"] != period for p in params):
+        raise ValueError("simulate() richiede lo stesso 'period' per tutti i set: usa sweep().")
+
+    h = resample(history, period)
+    steps = len(h["t"])
+    col = lambda key: np.array([p[key] for p in params], dtype=float)
+    max_power, margin = col("max_power"), col("margin")
+    min_amps, max_amps = col("min_amps"), col("max_amps")
+    hysteresis, dwell_steps = col("hysteresis_amps"), np.ceil(col("min_dwell_s") / period)
+    budget = col("max_commands_per_hour")
+
+    # Consumo della casa senza la vettura (la corrente Tesla misurata viene tolta)
+    voltage = h["grid_voltage"]
+    house_grid = h["grid_power"] - np.where(h["tesla_amps"] > 5.5, np.round(h["tesla_amps"]), 0) * voltage
+
+    n = len(params)
+    amps = np.zeros(n)
+    last_cmd = np.full(n, -np.inf)
+    window = max(int(np.ceil(3600 / period)), 1)
+    sent_ring = np.zeros((window, n))
+    sent_in_window = np.zeros(n)
+
+    commands = np.zeros(n, dtype=int)
+    suppressed = np.zeros(n, dtype=int)
+    amps_history = np.empty((steps, n))
+    limit = max_power - margin
+    ones = np.ones(n)
+
+    for i in range(steps):
+        v = voltage[i]
+        amps_history[i] = amps
+
+        # Stessa decisione di shelly_logger(): corrente massima + ChargeController
+        target = max_allowed_amps(house_grid[i] + amps * v, v * ones, limit,
+                                  min_amps=min_amps, max_amps=max_amps)
+        sent_in_window -= sent_ring[i % window]
+
+        change = target != amps
+        increase = change & (target > amps)
+        held = increase & (
+            ((amps > 0) & (target - amps <= hysteresis))
+            | (i - last_cmd < dwell_steps)
+            | (sent_in_window >= budget)
+        )
+        send = change & ~held
+
+        suppressed += held
+        commands += send
+        last_cmd = np.where(send, i, last_cmd)
+        sent_ring[i % window] = send
+        sent_in_window += send
+        amps = np.where(send, target, amps)
+
+    # Bilanci energetici calcolati in blocco sull'andamento simulato della corrente
+    car_power = amps_history * voltage[:, None]
+    grid = house_grid[:, None] + car_power
+    pv = h["pv_power"][:, None]
+    to_kwh = period / 3600.0 / 1000.0
+    pv_total = h["pv_power"].clip(min=0).sum()
+    grid_import = np.maximum(grid, 0).sum(axis=0)
+    grid_export = np.maximum(-grid, 0).sum(axis=0)
+    car_energy = car_power.sum(axis=0)
+    self_consumed = np.minimum(pv, pv + grid).clip(min=0).sum(axis=0)
+    over_limit = (grid > max_power).sum(axis=0)
+
+    results = []
+    for k, p in enumerate(params):
+        results.append({
+            "params": p,
+            "samples": steps,
+            "grid_import_kwh": round(float(grid_import[k]) * to_kwh, 3),
+            "grid_export_kwh": round(float(grid_export[k]) * to_kwh, 3),
+            "car_energy_kwh": round(float(car_energy[k]) * to_kwh, 3),
+            "self_consumption": round(float(self_consumed[k] / pv_total), 4) if pv_total else None,
+            "commands": int(commands[k]),
+            "suppressed": int(suppressed[k]),
+            "over_limit_s": int(over_limit[k]) * period,
+        })
+    return results
+
+
+# -------------------- Sweep in parallelo --------------------
+
+_HISTORY = None
+
+
+def _init_worker(history):
+    global _HISTORY
+    _HISTORY = history
+
+
+def _simulate_chunk(param_sets):
+    return simulate(_HISTORY, param_sets)
+
+
+def sweep(history, param_sets, processes=None, chunk_size=16):
+    """
+    Simula tutti i set di parametri: raggruppati per 'period' e distribuiti
+    a blocchi su più processi. Risultati nello stesso ordine di param_sets.
+    """
+    params = [dict(DEFAULT_PARAMS, **p) for p in param_sets]
+    chunks = []
+    by_period = {}
+    for index, p in enumerate(params):
+        by_period.setdefault(p["period"], []).append(index)
+    for indexes in by_period.values():
+        for start in range(0, len(indexes), chunk_size):
+            chunks.append(indexes[start:start + chunk_size])
+
+    results = [None] * len(params)
+    if processes == 1 or len(chunks) == 1:
+        outputs = [simulate(history, [params[i] for i in chunk]) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(history,)) as pool:
+            outputs = list(pool.map(_simulate_chunk, [[params[i] for i in chunk] for chunk in chunks]))
+    for chunk, output in zip(chunks, outputs):
+        for index, result in zip(chunk, output):
+            results[index] = result
+    return results
+
+
+def parameter_grid(**values):
+    """parameter_grid(max_power=[3000, 3500], period=[30, 60]) -> prodotto cartesiano dei valori."""
+    keys = list(values)
+    return [dict(zip(keys, combo)) for combo in itertools.product(*(values[k] for k in keys))]
+
+
+# -------------------- CLI --------------------
+
+def _float_list(text):
+    return [float(x) for x in text.split(",") if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulazione what-if del controllo di ricarica sullo storico.")
+    parser.add_argument("--start", required=True, help="es. 2026-09-01")
+    parser.add_argument("--end", required=True, help="es. 2026-10-01")
+    parser.add_argument("--max-power", type=_float_list, default=[DEFAULT_PARAMS["max_power"]])
+    parser.add_argument("--period", type=_float_list, default=[DEFAULT_PARAMS["period"]])
+    parser.add_argument("--margin", type=_float_list, default=[DEFAULT_PARAMS["margin"]])
+    parser.add_argument("--hysteresis", type=_float_list, default=[DEFAULT_PARAMS["hysteresis_amps"]])
+    parser.add_argument("--dwell", type=_float_list, default=[DEFAULT_PARAMS["min_dwell_s"]])
+    parser.add_argument("--budget", type=_float_list, default=[DEFAULT_PARAMS["max_commands_per_hour"]])
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--archive", action="store_true", help="legge lo storico dall'archivio freddo")
+    args = parser.parse_args()
+
+    from app import init
+    init()
+    if args.archive:
+        from app import ARCHIVE
+        history = load_history_archive(ARCHIVE, datetime.fromisoformat(args.start), datetime.fromisoformat(args.end))
+    else:
+        from app import get_db_connection
+        history = load_history(get_db_connection, args.start, args.end)
+    grid = parameter_grid(
+        max_power=args.max_power, period=args.period, margin=args.margin,
+        hysteresis_amps=args.hysteresis, min_dwell_s=args.dwell, max_commands_per_hour=args.budget
+    )
+    for result in sweep(history, grid, processes=args.processes):
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
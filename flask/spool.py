@@ -0,0 +1,259 @@
+# spool.py
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class DurableSpool:
+    """
+    Spool locale (SQLite) per le righe che non è stato possibile scrivere su MySQL.
+      - append-only: ogni riga viene salvata con tabella, colonne e valori
+        (compreso il timestamp di acquisizione)
+      - limiti di dimensione (max_rows / max_bytes): oltre si scartano le più vecchie
+      - un thread di background reinvia le righe in blocco quando il DB torna
+        disponibile, con un limite di righe al secondo
+    Il file può essere condiviso da più processi: un solo processo alla volta
+    fa il replay (lock file <path>.replay.lock), così le stesse righe non
+    vengono reinviate due volte. Il lock di scrittura SQLite è tenuto solo
+    per le singole DELETE/UPDATE, mai durante la chiamata a MySQL: append()
+    degli altri processi non resta bloccato durante un disservizio.
+    Errori di connessione (MySQL in riavvio, rete) lasciano le righe intatte;
+    solo gli errori sui dati contano come tentativi (max_attempts) prima
+    dello scarto.
+    get_connection: () -> (conn, cursor) | (None, None)
+    """
+    def __init__(self, logger, get_connection, path, max_rows=500000, max_bytes=200 * 1024 * 1024,
+                 replay_batch=500, replay_rate=2000.0, replay_interval=15.0, max_attempts=3):
+        self.logger = logger
+        self.get_connection = get_connection
+        self.path = path
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.replay_batch = replay_batch
+        self.replay_rate = replay_rate
+        self.replay_interval = replay_interval
+        self.max_attempts = max_attempts
+
+        self._db = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {
+            "spooled": 0,
+            "replayed": 0,
+            "dropped": 0,
+            "discarded": 0,
+            "replay_errors": 0,
+            "last_replay_at": None,
+        }
+
+    # -------------------- SQLite --------------------
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS spool (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tbl TEXT NOT NULL,
+                    cols TEXT NOT NULL,
+                    vals TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._db = db
+        return self._db
+
+    # -------------------- API --------------------
+
+    def append(self, batches):
+        """batches: [((table, columns), [row, ...]), ...] come nel WriteBehindBuffer."""
+        records = []
+        for (table, columns), rows in batches:
+            cols = json.dumps(list(columns))
+            for row in rows:
+                records.append((table, cols, json.dumps(list(row), default=str)))
+        if not records:
+            return 0
+
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany("INSERT INTO spool (tbl, cols, vals) VALUES (?, ?, ?)", records)
+                self._enforce_caps(db)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        self._stats["spooled"] += len(records)
+        self.logger.warning(f"📦 [Spool] {len(records)} righe salvate localmente in attesa del DB.")
+        self.start()
+        return len(records)
+
+    def pending(self):
+        with self._lock:
+            return self._conn().execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def size_bytes(self):
+        total = 0
+        for suffix in ("", "-wal"):
+            try:
+                total += os.path.getsize(self.path + suffix)
+            except OSError:
+                pass
+        return total
+
+    def stats(self):
+        s = dict(self._stats)
+        s["pending"] = self.pending()
+        s["size_bytes"] = self.size_bytes()
+        return s
+
+    def start(self):
+        """Avvia (una sola volta) il thread di replay."""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="spool-replay", daemon=True)
+            self._thread.start()
+
+    def replay_once(self):
+        """Reinvia un batch. Ritorna il numero di righe scritte su MySQL (-1 se il DB non è disponibile)."""
+        from filelock import FileLock, Timeout
+        try:
+            with FileLock(self.path + ".replay.lock", timeout=0):
+                with self._lock:
+                    rows = self._conn().execute(
+                        "SELECT id, tbl, cols, vals, attempts FROM spool ORDER BY id LIMIT ?",
+                        (self.replay_batch,)
+                    ).fetchall()
+                if not rows:
+                    return 0
+                return self._write_mysql(rows)
+        except Timeout:
+            # Replay in corso in un altro processo
+            return 0
+
+    # -------------------- Interni --------------------
+
+    def _transaction(self, statements):
+        """Breve transazione SQLite: [(query, parametri per executemany)]."""
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for query, params in statements:
+                    db.executemany(query, params)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def _write_mysql(self, rows):
+        conn, cursor = self.get_connection()
+        if not conn:
+            return -1
+
+        groups = {}
+        for row_id, tbl, cols, vals, attempts in rows:
+            groups.setdefault((tbl, cols), []).append((row_id, json.loads(vals), attempts))
+
+        written = 0
+        try:
+            for (tbl, cols), items in groups.items():
+                columns = json.loads(cols)
+                placeholders = ", ".join(["%s"] * len(columns))
+                query = f"INSERT INTO {tbl} ({', '.join(columns)}) VALUES ({placeholders})"
+                ids = [row_id for row_id, _, _ in items]
+                try:
+                    cursor.executemany(query, [vals for _, vals, _ in items])
+                    conn.commit()
+                except Exception as e:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        pass
+                    self._stats["replay_errors"] += 1
+                    if _is_connection_error(e):
+                        # DB di nuovo irraggiungibile: righe intatte, si riprova più tardi
+                        self.logger.warning(f"⚠️ [Spool] Connessione persa durante il reinvio verso {tbl}: {e}")
+                        written = written or -1
+                        break
+                    self.logger.error(f"❌ [Spool] Errore nel reinvio verso {tbl}: {e}")
+                    self._mark_failed(items)
+                    continue
+                # Righe scritte: eliminate subito (una transazione per gruppo)
+                self._transaction([("DELETE FROM spool WHERE id = ?", [(i,) for i in ids])])
+                written += len(ids)
+        finally:
+            cursor.close()
+            conn.close()
+
+        if written < 0:
+            return written
+
+        self._stats["replayed"] += written
+        self._stats["last_replay_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        return written
+
+    def _mark_failed(self, items):
+        # Le righe rifiutate ripetutamente da MySQL (errori sui dati) vengono scartate
+        discard = [(row_id,) for row_id, _, attempts in items if attempts + 1 >= self.max_attempts]
+        retry = [(row_id,) for row_id, _, attempts in items if attempts + 1 < self.max_attempts]
+        self._transaction([
+            ("UPDATE spool SET attempts = attempts + 1 WHERE id = ?", retry),
+            ("DELETE FROM spool WHERE id = ?", discard),
+        ])
+        if discard:
+            self._stats["discarded"] += len(discard)
+            self.logger.error(f"🗑️ [Spool] {len(discard)} righe scartate dopo {self.max_attempts} tentativi.")
+
+    def _enforce_caps(self, db):
+        count = db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        excess = count - self.max_rows
+        if excess <= 0 and self._used_bytes(db) > self.max_bytes:
+            excess = max(count // 10, 1)
+        if excess > 0:
+            db.execute("DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)", (excess,))
+            self._stats["dropped"] += excess
+            self.logger.error(f"⚠️ [Spool] Limite raggiunto: scartate le {excess} righe più vecchie.")
+
+    def _used_bytes(self, db):
+        # Pagine effettivamente occupate (le pagine liberate vengono riutilizzate)
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        page_count = db.execute("PRAGMA page_count").fetchone()[0]
+        freelist = db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist) * page_size
+
+    def _run(self):
+        while True:
+            try:
+                written = self.replay_once()
+            except Exception as e:
+                self.logger.error(f"❌ [Spool] Errore durante il replay: {e}")
+                written = -1
+
+            if written > 0:
+                self.logger.info(f"♻️ [Spool] {written} righe reinviate a MySQL.")
+                # Limite di velocità: righe al secondo
+                time.sleep(written / self.replay_rate if self.replay_rate else 0)
+            else:
+                time.sleep(self.replay_interval)
+
+
+def _is_connection_error(e):
+    """
+    True per gli errori di connessione (MySQL in riavvio, rete): OperationalError /
+    InterfaceError di mysql.connector o codici client 2000-2999 (es. 2006, 2013).
+    """
+    if isinstance(e, OSError):
+        return True
+    if type(e).__name__ in ("OperationalError", "InterfaceError"):
+        return True
+    errno = getattr(e, "errno", None)
+    return isinstance(errno, int) and 2000 <= errno < 3000
@@ -1,13 +1,11 @@
 #!/bin/bash
 
-# Avvia logger tensione in background
-echo "▶️ Avvio voltage_logger_runner.py..."
-python voltage_logger_runner.py &
-
-# Avvia logger Shelly in background
-echo "▶️ Avvio shelly_logger.py..."
-python shelly_logger.py &
-
-# Avvia il server Flask (in primo piano)
-echo "▶️ Avvio Flask..."
-flask run --host=0.0.0.0 --port=5000
+# Un solo processo (supervisor.py): ciclo di controllo, logger tensione,
+# aggregati e API Flask come task dello stesso event loop.
+# L'API è servita da gunicorn (processo figlio del supervisor, gunicorn.conf.py);
+# kill -HUP <pid> ricarica i worker senza interrompere le richieste in corso.
+# exec: SIGTERM arriva direttamente al supervisor, che chiude i task in ordine.
+# (I runner separati restano utilizzabili a mano: shelly_logger.py,
+#  voltage_logger_runner.py, rollup_runner.py)
+echo "▶️ Avvio supervisor.py..."
+exec python supervisor.py
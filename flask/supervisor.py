@@ -0,0 +1,319 @@
+# supervisor.py
+"""
+Avvio in un solo processo: ciclo di controllo, logger tensione, aggregati e
+API HTTP come task dello stesso event loop, con pool, cache, logger e buffer
+condivisi (un solo import di app.py).
+L'API HTTP di default è servita da gunicorn (processo figlio sorvegliato,
+vedi gunicorn.conf.py); HTTP_SERVER=werkzeug la tiene nel processo.
+    python supervisor.py
+SIGTERM/SIGINT: arresto ordinato. SIGHUP: ricarica graduale dei worker HTTP.
+"""
+import asyncio
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from app import (app, init, logger, shelly_logger, voltage_logger_loop, run_blocking,
+                 run_maintenance, ROLLUPS, SCHEMA, WRITE_BEHIND, CONFIG, HEALTH_PATH, db_stats_snapshot)
+from lazy import is_loaded
+
+
+class Supervisor:
+    """
+    Esegue i task registrati e li riavvia se terminano o falliscono, con
+    backoff esponenziale (azzerato dopo 'healthy_after' secondi di attività).
+    Alla chiusura i task vengono fermati uno alla volta in ordine inverso
+    di registrazione, chiamando prima l'eventuale funzione 'stop'.
+    health() riporta lo stato di ogni task; se 'health_path' è impostato lo
+    stato viene anche scritto su file (a ogni cambio e ogni 'health_interval'
+    secondi) per i worker HTTP che girano in altri processi, insieme a quanto
+    ritornato da 'extra_status' (es. statistiche del pool MySQL del processo).
+    """
+    def __init__(self, logger, backoff_base=1.0, backoff_max=60.0, healthy_after=60.0, stop_timeout=15.0,
+                 health_path=None, health_interval=10.0, extra_status=None):
+        self.logger = logger
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.healthy_after = healthy_after
+        self.stop_timeout = stop_timeout
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.extra_status = extra_status
+        self._specs = []
+        self._reloads = []
+        self._tasks = {}
+        self._health = {}
+        self._stopping = None
+
+    def add(self, name, factory, stop=None, reload=None):
+        """
+        factory: () -> coroutine del task; stop: funzione (sync) per fermarlo
+        in modo ordinato; reload: funzione (sync) chiamata su SIGHUP.
+        """
+        self._specs.append((name, factory, stop))
+        if reload is not None:
+            self._reloads.append((name, reload))
+        self._health[name] = {"state": "pending", "restarts": 0, "last_error": None,
+                              "started_at": None, "last_exit_at": None}
+
+    def health(self):
+        now = time.time()
+        out = {}
+        for name, h in self._health.items():
+            item = dict(h)
+            item["uptime_s"] = round(now - h["started_at"], 1) if h["state"] == "running" and h["started_at"] else 0
+            out[name] = item
+        return out
+
+    def healthy(self):
+        return all(h["state"] == "running" for h in self._health.values())
+
+    def request_stop(self):
+        if self._stopping and not self._stopping.is_set():
+            self.logger.info("🛑 [Supervisor] Arresto richiesto.")
+            self._stopping.set()
+
+    def request_reload(self):
+        for name, reload in self._reloads:
+            self.logger.info(f"🔄 [Supervisor] Ricarica di '{name}'...")
+            try:
+                reload()
+            except Exception as e:
+                self.logger.error(f"❌ [Supervisor] Errore ricaricando '{name}': {e}")
+
+    async def run(self):
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        handlers = [(signal.SIGTERM, self.request_stop), (signal.SIGINT, self.request_stop)]
+        if hasattr(signal, "SIGHUP"):
+            handlers.append((signal.SIGHUP, self.request_reload))
+        for sig, handler in handlers:
+            try:
+                loop.add_signal_handler(sig, handler)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        for name, factory, _ in self._specs:
+            self._tasks[name] = asyncio.create_task(self._supervise(name, factory), name=name)
+        self.logger.info(f"▶️ [Supervisor] Avviati: {', '.join(self._tasks)}")
+
+        while not self._stopping.is_set():
+            self._publish_health()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.health_interval)
+            except asyncio.TimeoutError:
+                pass
+        await self._shutdown()
+
+    # -------------------- Interni --------------------
+
+    async def _supervise(self, name, factory):
+        health = self._health[name]
+        failures = 0
+        while True:
+            started = time.monotonic()
+            health.update(state="running", started_at=time.time())
+            self._publish_health()
+            try:
+                await factory()
+                health["last_error"] = None
+                self.logger.warning(f"⚠️ [Supervisor] Task '{name}' terminato: riavvio.")
+            except asyncio.CancelledError:
+                health.update(state="stopped", last_exit_at=time.time())
+                self._publish_health()
+                raise
+            except Exception as e:
+                health["last_error"] = f"{type(e).__name__}: {e}"
+                self.logger.error(f"❌ [Supervisor] Task '{name}' fallito: {e}")
+
+            if time.monotonic() - started >= self.healthy_after:
+                failures = 0
+            delay = min(self.backoff_base * (2 ** failures), self.backoff_max)
+            failures += 1
+            health["restarts"] += 1
+            health.update(state="backoff", last_exit_at=time.time())
+            self._publish_health()
+            self.logger.info(f"🔁 [Supervisor] Riavvio di '{name}' tra {delay:.0f} s.")
+            await asyncio.sleep(delay)
+
+    async def _shutdown(self):
+        for name, _, stop in reversed(self._specs):
+            task = self._tasks.get(name)
+            self.logger.info(f"⏹️ [Supervisor] Arresto di '{name}'...")
+            if stop is not None:
+                try:
+                    await run_blocking(stop)
+                except Exception as e:
+                    self.logger.error(f"❌ [Supervisor] Errore fermando '{name}': {e}")
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await asyncio.wait_for(task, timeout=self.stop_timeout)
+                except (asyncio.CancelledError, asyncio.TimeoutError):
+                    pass
+                except Exception as e:
+                    self.logger.error(f"❌ [Supervisor] Errore in chiusura di '{name}': {e}")
+            self._health[name]["state"] = "stopped"
+        self._publish_health()
+        # Ultime misure in coda verso MySQL (o verso lo spool)
+        if is_loaded(WRITE_BEHIND):
+            await run_blocking(WRITE_BEHIND.close)
+        self.logger.info("✅ [Supervisor] Arresto completato.")
+
+    def _publish_health(self):
+        """Scrive lo stato su file in modo atomico (file temporaneo + rename)."""
+        if not self.health_path:
+            return
+        status = {"healthy": self.healthy(), "updated_at": round(time.time(), 3),
+                  "pid": os.getpid(), "tasks": self.health()}
+        if self.extra_status is not None:
+            try:
+                status.update(self.extra_status())
+            except Exception as e:
+                self.logger.error(f"❌ [Supervisor] Errore raccogliendo lo stato: {e}")
+        tmp = f"{self.health_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(status, f)
+            os.replace(tmp, self.health_path)
+        except OSError as e:
+            self.logger.error(f"❌ [Supervisor] Impossibile scrivere lo stato in {self.health_path}: {e}")
+
+
+# -------------------- Task --------------------
+
+class HttpServer:
+    """
+    Server WSGI di werkzeug (thread per richiesta) in un thread dedicato,
+    fermabile con stop(). Alternativa leggera a GunicornServer.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def run(self):
+        self._server = make_server(self.host, self.port, app, threaded=True)
+        logger.info(f"🌐 [Supervisor] API HTTP su {self.host}:{self.port}")
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def serve():
+            try:
+                self._server.serve_forever()
+            finally:
+                loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+        threading.Thread(target=serve, name="http", daemon=True).start()
+        try:
+            await done
+        finally:
+            self._server.server_close()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+
+class GunicornServer:
+    """
+    gunicorn come processo figlio (config in gunicorn.conf.py): più worker
+    con pool di thread, keep-alive e ricarica graduale.
+      - se gunicorn termina, run() solleva e il supervisor lo riavvia
+      - stop(): SIGTERM, gunicorn chiude i worker finendo le richieste in corso
+        (graceful_timeout); run() attende al massimo 'stop_timeout' poi SIGKILL
+      - reload(): SIGHUP, nuovi worker con il codice aggiornato, poi i vecchi
+        vengono chiusi senza interrompere le richieste in corso
+    env: variabili passate a gunicorn (HTTP_HOST, HTTP_PORT, HTTP_WORKERS, ...)
+    """
+    def __init__(self, config_path="gunicorn.conf.py", app_spec="wsgi:app", env=None, stop_timeout=12.0):
+        self.config_path = config_path
+        self.app_spec = app_spec
+        self.env = env or {}
+        self.stop_timeout = stop_timeout
+        self._process = None
+
+    async def run(self):
+        self._process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "gunicorn", "-c", self.config_path, self.app_spec,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env={**os.environ, **self.env}
+        )
+        logger.info(f"🌐 [Supervisor] gunicorn avviato (pid {self._process.pid}).")
+        try:
+            code = await self._process.wait()
+        except asyncio.CancelledError:
+            await self._terminate()
+            raise
+        raise RuntimeError(f"gunicorn terminato con codice {code}")
+
+    def stop(self):
+        self._signal(signal.SIGTERM)
+
+    def reload(self):
+        self._signal(signal.SIGHUP)
+
+    def _signal(self, sig):
+        if self._process is not None and self._process.returncode is None:
+            self._process.send_signal(sig)
+
+    async def _terminate(self):
+        self._signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self._process.wait(), timeout=self.stop_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ [Supervisor] gunicorn non si è fermato in tempo: SIGKILL.")
+            self._process.kill()
+            await self._process.wait()
+
+
+async def rollup_loop():
+    ready = False
+    while True:
+        if not ready:
+            ready = await run_maintenance(ROLLUPS.ensure_tables)
+        if ready:
+            written = await run_maintenance(ROLLUPS.run_once)
+            if written:
+                logger.info(f"📊 [Rollup] {written} bucket aggiornati.")
+        await asyncio.sleep(ROLLUPS.interval)
+
+
+async def schema_loop():
+    await run_maintenance(SCHEMA.check_indexes)
+    while True:
+        await run_maintenance(SCHEMA.maintain)
+        await asyncio.sleep(SCHEMA.interval)
+
+
+def build_supervisor():
+    supervisor = Supervisor(logger, health_path=HEALTH_PATH, extra_status=lambda: {"db": db_stats_snapshot()})
+    host = CONFIG.get("HTTP_HOST", "0.0.0.0")
+    port = int(CONFIG.get("HTTP_PORT", 5000))
+
+    # Ordine di arresto inverso: prima l'API, poi il controllo, infine i logger
+    supervisor.add("schema", schema_loop)
+    supervisor.add("rollups", rollup_loop)
+    supervisor.add("voltage_logger", voltage_logger_loop)
+    supervisor.add("shelly_logger", shelly_logger)
+    if os.getenv("HTTP_SERVER", "gunicorn") == "werkzeug":
+        http = HttpServer(host, port)
+        supervisor.add("http", http.run, stop=http.stop)
+    else:
+        env = {"HTTP_HOST": str(host), "HTTP_PORT": str(port)}
+        for key in ("HTTP_WORKERS", "HTTP_THREADS", "HTTP_KEEPALIVE", "SSE_MAX_STREAMS"):
+            if key in CONFIG:
+                env[key] = str(CONFIG[key])
+        http = GunicornServer(env=env)
+        supervisor.add("http", http.run, stop=http.stop, reload=http.reload)
+    return supervisor
+
+
+if __name__ == "__main__":
+    init()
+    asyncio.run(build_supervisor().run())
@@ -0,0 +1,201 @@
+# tesla_command_queue.py
+import asyncio
+import heapq
+import itertools
+import time
+
+
+# Priorità: numeri più bassi vengono eseguiti prima
+COMMAND_PRIORITY = {
+    "charge_stop": 0,          # comando di sicurezza
+    "charge_start": 1,
+    "set_charging_amps": 2,
+}
+DEFAULT_PRIORITY = 3
+
+# Comandi scavalcati (e scartati) da un charge_stop in coda
+PREEMPTED_BY_STOP = ("charge_start", "set_charging_amps")
+
+
+class _QueuedCommand:
+    def __init__(self, command, value, local_amps, deadline, future):
+        self.command = command
+        self.value = value
+        self.local_amps = local_amps
+        self.deadline = deadline
+        self.future = future
+        self.dropped = False
+        self.interrupt = asyncio.Event()    # interrompe l'attesa del retry
+
+
+class TeslaCommandQueue:
+    """
+    Coda asyncio dei comandi Tesla con un solo worker (nessun comando concorrente).
+      - priorità: charge_stop scavalca e scarta start / cambi di corrente in coda
+      - deduplica: un comando identico già in coda (o in esecuzione) restituisce
+        lo stesso future
+      - un nuovo set_charging_amps sostituisce quello ancora in coda
+      - scadenza per comando: se non eseguito entro 'deadline_s' viene scartato
+      - retry con backoff esponenziale solo sugli errori transitori (errori di
+        rete segnalati da execute con "transient": True, 429 e 5xx); un
+        comando che lo rende inutile interrompe subito l'attesa del retry
+    submit() accoda e ritorna subito un asyncio.Future con il risultato.
+    execute: async (command, charging_amps_value=None, local_amps=None) -> dict
+    """
+    def __init__(self, execute, logger, deadline_s=120, max_retries=3, backoff_base=2.0, backoff_max=30.0):
+        self.execute = execute
+        self.logger = logger
+        self.deadline_s = deadline_s
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._pending = {}                 # (command, value) -> _QueuedCommand
+        self._current = None               # comando in esecuzione (o in attesa di retry)
+        self._wakeup = None
+        self._worker = None
+        self.stats = {"submitted": 0, "executed": 0, "deduplicated": 0,
+                      "superseded": 0, "expired": 0, "retries": 0}
+
+    # -------------------- API --------------------
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+        return self._worker
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for item in list(self._pending.values()):
+            self._resolve(item, {"status": "cancelled", "message": "Coda comandi fermata"})
+        self._pending.clear()
+        self._heap.clear()
+
+    async def submit(self, command, charging_amps_value=None, local_amps=None, deadline_s=None):
+        self.start()
+        self.stats["submitted"] += 1
+        value = int(charging_amps_value) if charging_amps_value is not None else None
+        key = (command, value)
+
+        existing = self._pending.get(key)
+        current = self._current
+        if existing is None and current is not None and (current.command, current.value) == key:
+            existing = current
+        if existing is not None:
+            existing.local_amps = local_amps
+            self.stats["deduplicated"] += 1
+            return existing.future
+
+        if command == "set_charging_amps":
+            self._drop_pending(lambda c: c == "set_charging_amps", "sostituito da un nuovo set_charging_amps")
+        elif command == "charge_stop":
+            self._drop_pending(lambda c: c in PREEMPTED_BY_STOP, "scavalcato da charge_stop")
+        if current is not None and self._supersedes(command, current.command):
+            current.interrupt.set()
+
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + (deadline_s if deadline_s is not None else self.deadline_s)
+        item = _QueuedCommand(command, value, local_amps, deadline, loop.create_future())
+        self._pending[key] = item
+        heapq.heappush(self._heap, (COMMAND_PRIORITY.get(command, DEFAULT_PRIORITY), next(self._seq), item))
+        self._wakeup.set()
+        self.logger.info(f"📬 Comando '{command}' accodato (in coda: {len(self._pending)}).")
+        return item.future
+
+    # -------------------- Worker --------------------
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            _, _, item = heapq.heappop(self._heap)
+            if item.dropped:
+                continue
+            self._pending.pop((item.command, item.value), None)
+
+            self._current = item
+            try:
+                result = await self._execute_with_retry(item)
+            except asyncio.CancelledError:
+                self._resolve(item, {"status": "cancelled", "message": "Coda comandi fermata"})
+                raise
+            except Exception as e:
+                self.logger.error(f"❌ Eccezione eseguendo '{item.command}': {e}")
+                result = {"status": "error", "message": str(e)}
+            finally:
+                self._current = None
+            self._resolve(item, result)
+
+    async def _execute_with_retry(self, item):
+        attempt = 0
+        while True:
+            if time.monotonic() > item.deadline:
+                self.stats["expired"] += 1
+                self.logger.warning(f"⌛ Comando '{item.command}' scaduto prima dell'esecuzione.")
+                return {"status": "expired", "message": "Scadenza del comando superata"}
+
+            if item.value is None:
+                result = await self.execute(item.command, local_amps=item.local_amps)
+            else:
+                result = await self.execute(item.command, charging_amps_value=item.value, local_amps=item.local_amps)
+            self.stats["executed"] += 1
+
+            if result.get("status") != "error" or not self._is_transient(result) or attempt >= self.max_retries:
+                return result
+
+            delay = min(self.backoff_base * (2 ** attempt), self.backoff_max)
+            if time.monotonic() + delay > item.deadline:
+                return result
+            attempt += 1
+            self.stats["retries"] += 1
+            self.logger.warning(f"🔁 Retry {attempt}/{self.max_retries} di '{item.command}' tra {delay:.0f} s.")
+            try:
+                await asyncio.wait_for(item.interrupt.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+            # Un comando più recente potrebbe averlo reso inutile durante l'attesa
+            if self._superseded_while_waiting(item):
+                self.stats["superseded"] += 1
+                return {"status": "superseded", "message": "Superato da un comando più recente"}
+
+    # -------------------- Interni --------------------
+
+    def _is_transient(self, result):
+        # Errori di rete, rate limit e 5xx (non i controlli falliti prima dell'invio)
+        http_status = result.get("http_status")
+        if http_status is None:
+            return bool(result.get("transient"))
+        return http_status == 429 or http_status >= 500
+
+    def _supersedes(self, new_command, old_command):
+        if new_command == "charge_stop":
+            return old_command in PREEMPTED_BY_STOP
+        return new_command == "set_charging_amps" and old_command == "set_charging_amps"
+
+    def _superseded_while_waiting(self, item):
+        return any(self._supersedes(command, item.command) for command, _ in self._pending)
+
+    def _drop_pending(self, predicate, reason):
+        for key, item in list(self._pending.items()):
+            if predicate(item.command):
+                item.dropped = True
+                del self._pending[key]
+                self.stats["superseded"] += 1
+                self._resolve(item, {"status": "superseded", "message": reason})
+
+    def _resolve(self, item, result):
+        if not item.future.done():
+            item.future.set_result(result)
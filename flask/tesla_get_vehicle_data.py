@@ -1,5 +1,6 @@
 import asyncio
-from app import get_vehicle_data
+from app import init, get_vehicle_data, get_access_token_from_file
 
 if __name__ == "__main__":
-    asyncio.run(get_vehicle_data())
\ No newline at end of file
+    init()
+    asyncio.run(get_vehicle_data(get_access_token_from_file()))
\ No newline at end of file
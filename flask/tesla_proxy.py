@@ -1,29 +1,72 @@
 # tesla_proxy.py
-import os, json, ssl, aiohttp, inspect
+import os, json, ssl, aiohttp, inspect, asyncio, time
 
 class TeslaProxy:
     """
     Incapsula:
-      - lettura token da file
+      - lettura token da file (o da token_provider in memoria)
       - verifica stato veicolo (eccetto 'wake_up')
       - refresh token ONE-SHOT se scaduto/invalid
       - wake_up se veicolo 'unavailable'
       - normalizzazione 'charge_start' se latch engaged & charging_state='Stopped'
       - POST al proxy con SSL
+      - sessioni HTTP keep-alive persistenti (una per upstream: proxy e Fleet API)
+        e contesto SSL caricato una sola volta; chiudere con close()
+      - cache dello stato veicolo con TTL (state_ttl): il pre-check usa lo stato
+        in cache se abbastanza recente; comandi riusciti e letture la aggiornano,
+        solo gli errori che indicano uno stato diverso la invalidano
+      - fast path con telemetria locale (corrente letta dall'ESP8266): per un
+        set_charging_amps, se la vettura è in carica sia per la lettura locale
+        sia per l'ultimo stato cloud noto (entro local_state_max_age) il
+        pre-check cloud viene saltato
     Le funzioni esterne get_vehicle_data/refresh_token/log_pretty sono iniettate dal chiamante.
     """
     def __init__(self, vin, proxy_base, token_file, cert_path, logger,
-                 get_vehicle_data, refresh_token, log_pretty=None):
+                 get_vehicle_data, refresh_token, log_pretty=None,
+                 connector_limit=4, keepalive_timeout=60, request_timeout=30,
+                 token_provider=None, state_ttl=60,
+                 local_state_max_age=1800, local_charging_threshold=5.5):
         self.vin = vin
         self.proxy_base = proxy_base.rstrip("/")
         self.token_file = token_file
         self.cert_path = cert_path
         self.logger = logger
-        self.get_vehicle_data = get_vehicle_data          # async: (token) -> (status, data)
+        self.get_vehicle_data = get_vehicle_data          # async: (token, session=None) -> (status, data)
         self.refresh_token = refresh_token                # sync o async: () -> bool
         self.log_pretty = log_pretty                      # opzionale: (dict) -> None
+        self.token_provider = token_provider              # opzionale: () -> str|None (token in memoria)
+        self.connector_limit = connector_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.state_ttl = state_ttl
+        self.local_state_max_age = local_state_max_age
+        self.local_charging_threshold = local_charging_threshold
 
-    async def execute(self, command, charging_amps_value=None):
+        self._state = None                                # ultimo vehicle_data valido (dict)
+        self._state_time = 0.0                            # time.monotonic() dell'ultimo aggiornamento
+        self._ssl_ctx = None
+        self._proxy_session = None
+        self._fleet_session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """Chiude le sessioni persistenti."""
+        for session in (self._proxy_session, self._fleet_session):
+            if session is not None and not session.closed:
+                await session.close()
+        self._proxy_session = None
+        self._fleet_session = None
+
+    async def execute(self, command, charging_amps_value=None, local_amps=None):
+        """
+        local_amps (opzionale): corrente assorbita dall'auto misurata localmente,
+        usata per evitare il pre-check cloud quando concorda con lo stato noto.
+        """
         max_refresh_retries = 1
         refresh_attempts = 0
 
@@ -34,8 +77,22 @@ class TeslaProxy:
 
             # Pre-check stato veicolo per tutti i comandi tranne wake_up
             if command != "wake_up":
-                status, data = await self.get_vehicle_data(access_token)
+                cached = self.cached_state()
+                if cached is None and self._local_agrees(local_amps, command):
+                    self.logger.info(f"⚡ Corrente locale {local_amps:.1f} A coerente con l'ultimo stato noto: "
+                                     "pre-check cloud saltato.")
+                    cached = self._state
+                elif cached is not None:
+                    self.logger.info(f"🗃️ Stato veicolo da cache ({self.state_age():.0f} s).")
+                if cached is not None:
+                    status, data = 200, cached
+                else:
+                    status, data = await self.get_vehicle_data(access_token, session=self._get_fleet_session())
                 ok, action, normalized_command, error_msg = self._evaluate_vehicle_state(status, data, command)
+                if cached is None:
+                    self._store_state(status, data)
+                if action is not None:
+                    self.invalidate_state()
 
                 if action == "refresh_token":
                     if refresh_attempts < max_refresh_retries:
@@ -61,11 +118,121 @@ class TeslaProxy:
             if command == "set_charging_amps" and charging_amps_value is not None:
                 payload = {"charging_amps": int(charging_amps_value)}
 
-            return await self._post_command(command, access_token, payload)
+            result = await self._post_command(command, access_token, payload)
+            self._apply_command_result(command, payload, result)
+            return result
+
+    # -------------------- Cache stato veicolo --------------------
+
+    def cached_state(self, max_age=None):
+        """Ritorna l'ultimo vehicle_data se più recente di max_age (default state_ttl)."""
+        max_age = self.state_ttl if max_age is None else max_age
+        if self._state is None or self.state_age() > max_age:
+            return None
+        return self._state
+
+    def state_age(self):
+        return time.monotonic() - self._state_time if self._state is not None else float("inf")
+
+    def _local_agrees(self, local_amps, command):
+        """
+        True solo per un cambio di corrente (set_charging_amps) su una vettura
+        già in carica secondo entrambe le fonti: corrente locale sopra la
+        soglia e ultimo stato cloud "Charging" con connettore agganciato.
+        0 A non distingue vettura ferma, scollegata o addormentata: in quel
+        caso serve sempre il controllo cloud (eventuale wake_up).
+        """
+        if command != "set_charging_amps" or local_amps is None:
+            return False
+        if local_amps <= self.local_charging_threshold:
+            return False
+        last = self.cached_state(max_age=self.local_state_max_age)
+        if last is None:
+            return False
+        charge = last.get("response", {}).get("charge_state", {})
+        plugged = charge.get("charge_port_door_open") and charge.get("charge_port_latch") == "Engaged"
+        if not plugged:
+            return False
+        return charge.get("charging_state") == "Charging"
+
+    def invalidate_state(self):
+        self._state = None
+        self._state_time = 0.0
+
+    def _store_state(self, status, data):
+        if status != 200:
+            return
+        if isinstance(data, str):
+            try:
+                data = json.loads(data)
+            except Exception:
+                return
+        if isinstance(data, dict) and isinstance(data.get("response"), dict):
+            self._state = data
+            self._state_time = time.monotonic()
+
+    def _apply_command_result(self, command, payload, result):
+        """Aggiorna la cache con l'effetto atteso del comando, o la invalida se serve."""
+        if result.get("status") != "success":
+            # Errori di rete, rate limit (429) e 5xx non dicono nulla sullo stato del veicolo
+            http_status = result.get("http_status")
+            if http_status is not None and http_status != 429 and http_status < 500:
+                self.invalidate_state()
+            return
+
+        # HTTP 200 ma comando rifiutato dal veicolo (es. 'not_charging'): lo stato non è quello atteso
+        response = (result.get("data") or {}).get("response")
+        if isinstance(response, dict) and response.get("result") is False:
+            self.invalidate_state()
+            return
+
+        if self._state is None:
+            return
+        charge = self._state.setdefault("response", {}).setdefault("charge_state", {})
+        if command == "charge_start":
+            charge["charging_state"] = "Charging"
+        elif command == "charge_stop":
+            charge["charging_state"] = "Stopped"
+        elif command == "set_charging_amps" and "charging_amps" in payload:
+            charge["charge_current_request"] = payload["charging_amps"]
+        elif command == "wake_up":
+            return
+        self._state_time = time.monotonic()
 
     # -------------------- Helpers interni --------------------
 
+    def _get_ssl_context(self):
+        if self._ssl_ctx is None:
+            self._ssl_ctx = ssl.create_default_context(cafile=self.cert_path)
+        return self._ssl_ctx
+
+    def _new_session(self, ssl_ctx=None):
+        connector = aiohttp.TCPConnector(
+            limit=self.connector_limit,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=300,
+            ssl=ssl_ctx if ssl_ctx is not None else True
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+        )
+
+    def _get_proxy_session(self):
+        """Sessione verso tesla_http_proxy (certificato self-signed)."""
+        if self._proxy_session is None or self._proxy_session.closed:
+            self._proxy_session = self._new_session(self._get_ssl_context())
+        return self._proxy_session
+
+    def _get_fleet_session(self):
+        """Sessione verso la Fleet API."""
+        if self._fleet_session is None or self._fleet_session.closed:
+            self._fleet_session = self._new_session()
+        return self._fleet_session
+
     def _load_access_token(self):
+        if self.token_provider is not None:
+            return self.token_provider()
         if not os.path.exists(self.token_file):
             self.logger.error("❌ Token file non trovato.")
             return None
@@ -147,36 +314,47 @@ class TeslaProxy:
         headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
         self.logger.info(f"🚀 Invio comando '{command}' al proxy Tesla...")
 
-        ssl_ctx = ssl.create_default_context(cafile=self.cert_path)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=payload, ssl=ssl_ctx) as resp:
-                    status = resp.status
-                    text = await resp.text()
-
-                    try:
-                        data_resp = json.loads(text)
-                    except Exception:
-                        self.logger.error(f"❌ Risposta non valida: {text}")
-                        return {"status": "error", "message": f"Risposta non valida: {text}"}
-
-                    if status == 200:
-                        self.logger.info(f"✅ Comando '{command}' eseguito con successo.")
-                        # self.logger.debug("📦 Risposta JSON:\n%s", json.dumps(data_resp, indent=2))
-                        return {"status": "success", "data": data_resp}
-                    else:
-                        self.logger.error(f"❌ Errore comando '{command}': {status} - {text}")
-                        return {"status": "error", "message": f"Errore comando '{command}': {status} - {text}"}
+            session = self._get_proxy_session()
+            async with session.post(url, headers=headers, json=payload) as resp:
+                status = resp.status
+                text = await resp.text()
+
+                try:
+                    data_resp = json.loads(text)
+                except Exception:
+                    self.logger.error(f"❌ Risposta non valida: {text}")
+                    return {"status": "error", "message": f"Risposta non valida: {text}"}
+
+                if status == 200:
+                    self.logger.info(f"✅ Comando '{command}' eseguito con successo.")
+                    # self.logger.debug("📦 Risposta JSON:\n%s", json.dumps(data_resp, indent=2))
+                    return {"status": "success", "data": data_resp}
+                else:
+                    self.logger.error(f"❌ Errore comando '{command}': {status} - {text}")
+                    return {"status": "error", "message": f"Errore comando '{command}': {status} - {text}",
+                            "http_status": status}
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            # Errore di rete: il comando può essere ritentato
+            self.logger.error(f"❌ Errore di rete durante la richiesta: {e}")
+            return {"status": "error", "message": str(e), "transient": True}
         except Exception as e:
             self.logger.error(f"❌ Eccezione durante la richiesta: {e}")
             return {"status": "error", "message": str(e)}
 
     async def _maybe_async(self, fn):
-        """Accetta funzione sync o async, ritorna bool (successo)."""
+        """
+        Accetta funzione sync o async, ritorna bool (successo).
+        Le funzioni sync (es. refresh_token con requests) girano in un thread
+        dell'executor per non bloccare il loop.
+        """
         try:
-            res = fn()
-            if inspect.isawaitable(res):
-                res = await res
+            if inspect.iscoroutinefunction(fn):
+                res = await fn()
+            else:
+                res = await asyncio.get_running_loop().run_in_executor(None, fn)
+                if inspect.isawaitable(res):
+                    res = await res
             return bool(res)
         except Exception as e:
             self.logger.error(f"❌ Errore in refresh_token: {e}")
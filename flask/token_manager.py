@@ -0,0 +1,159 @@
+# token_manager.py
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class TokenManager:
+    """
+    Gestione in memoria del token Tesla.
+      - il file viene riletto solo se cambia (mtime), es. dopo /callback
+        o dopo un refresh fatto da un altro processo
+      - scadenza calcolata da 'expires_in' (salvata come 'expires_at')
+      - refresh proattivo in background prima della scadenza (run())
+      - refresh serializzati: un solo refresh alla volta, anche tra processi
+      - salvataggio atomico (file temporaneo + os.replace) del solo file 'latest'
+    request_refresh: (refresh_token) -> dict | None  (richiesta HTTP a Tesla, sync)
+    """
+    def __init__(self, token_file, logger, request_refresh, refresh_margin=600, retry_interval=60):
+        self.token_file = token_file
+        self.logger = logger
+        self.request_refresh = request_refresh
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+
+        self._data = None
+        self._mtime = None
+        self._lock = threading.RLock()
+        from filelock import FileLock
+        self._file_lock = FileLock(token_file + ".lock", timeout=30)
+
+    # -------------------- Lettura --------------------
+
+    def _reload_if_changed(self):
+        try:
+            mtime = os.stat(self.token_file).st_mtime
+        except OSError:
+            if self._data is None:
+                self.logger.error("❌ Token file non trovato.")
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.token_file) as f:
+                data = json.load(f)
+        except Exception as e:
+            self.logger.error(f"❌ Impossibile leggere il token: {e}")
+            return
+        if "expires_at" not in data and data.get("expires_in"):
+            # File scritto prima del token manager: scadenza stimata dalla data del file
+            data["expires_at"] = mtime + float(data["expires_in"])
+        self._data = data
+        self._mtime = mtime
+
+    def get_access_token(self):
+        self._reload_if_changed()
+        token = (self._data or {}).get("access_token")
+        if self._data is not None and not token:
+            self.logger.error("❌ Access token mancante nel file token.")
+        return token
+
+    def expires_in(self):
+        """Secondi alla scadenza (None se sconosciuta)."""
+        self._reload_if_changed()
+        expires_at = (self._data or {}).get("expires_at")
+        return None if expires_at is None else expires_at - time.time()
+
+    # -------------------- Scrittura --------------------
+
+    def store(self, token_data):
+        """Salva un nuovo token (da /callback o da refresh) in modo atomico."""
+        data = dict(token_data)
+        now = time.time()
+        data["obtained_at"] = now
+        if data.get("expires_in"):
+            data["expires_at"] = now + float(data["expires_in"])
+
+        directory = os.path.dirname(self.token_file)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tesla_token_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.token_file)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            self._data = data
+            self._mtime = os.stat(self.token_file).st_mtime
+        self.logger.info("✅ Token salvato.")
+
+    # -------------------- Refresh --------------------
+
+    def refresh(self, force=True):
+        """
+        Esegue il refresh (sync). Se nel frattempo un altro thread/processo ha
+        già ottenuto un token nuovo, non ne richiede un altro.
+        """
+        if self._data is None:
+            self._reload_if_changed()
+        from filelock import Timeout
+        seen = (self._data or {}).get("access_token")
+        with self._lock:
+            try:
+                with self._file_lock:
+                    self._reload_if_changed()
+                    data = self._data or {}
+                    if data.get("access_token") and data.get("access_token") != seen:
+                        self.logger.info("ℹ️ Token già aggiornato da un altro refresh.")
+                        return True
+                    remaining = self.expires_in()
+                    if not force and remaining is not None and remaining > self.refresh_margin:
+                        return True
+
+                    refresh_token_value = data.get("refresh_token")
+                    if not refresh_token_value:
+                        self.logger.error("❌ refresh_token non trovato.")
+                        return False
+
+                    new_data = self.request_refresh(refresh_token_value)
+                    if not new_data:
+                        return False
+                    self.store(new_data)
+                    self.logger.info("✅ Token aggiornato e salvato con successo.")
+                    return True
+            except Timeout:
+                self.logger.error("❌ Timeout in attesa del lock sul token.")
+                return False
+
+    async def refresh_async(self, force=True):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.refresh, force)
+
+    async def run(self):
+        """Task di background: refresh proattivo 'refresh_margin' secondi prima della scadenza."""
+        while True:
+            remaining = self.expires_in()
+            if remaining is None:
+                await asyncio.sleep(self.retry_interval)
+                continue
+
+            delay = remaining - self.refresh_margin
+            if delay > 0:
+                await asyncio.sleep(min(delay, 3600))
+                continue
+
+            self.logger.info("🔄 Token in scadenza: refresh proattivo...")
+            if not await self.refresh_async(force=False):
+                self.logger.error("❌ Refresh proattivo fallito, nuovo tentativo più tardi.")
+            await asyncio.sleep(self.retry_interval)
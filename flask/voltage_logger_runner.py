@@ -1,5 +1,7 @@
 import asyncio
-from app import voltage_logger_loop
+from app import init, voltage_logger_loop, install_shutdown_handler
 
 if __name__ == "__main__":
+    init()
+    install_shutdown_handler()
     asyncio.run(voltage_logger_loop())
\ No newline at end of file
@@ -0,0 +1,178 @@
+# write_behind.py
+import atexit
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+
+class WriteBehindBuffer:
+    """
+    Buffer di scrittura differita per le INSERT delle misure.
+      - le righe vengono raccolte per (tabella, colonne) con il proprio timestamp
+        di acquisizione (non NOW() al momento del flush)
+      - flush con executemany ogni 'batch_size' righe oppure ogni
+        'flush_interval' secondi, una transazione per (tabella, colonne): una
+        tabella in errore non trascina le altre nello spool
+      - memoria limitata a 'max_rows' righe: oltre si scartano le più vecchie
+      - flush finale all'uscita del processo (atexit)
+      - se il flush di un gruppo fallisce le sue righe passano allo spool
+        durevole (se presente), altrimenti restano in coda in memoria
+    get_connection: () -> (conn, cursor) | (None, None)
+    """
+    def __init__(self, logger, get_connection, batch_size=50, flush_interval=10.0, max_rows=10000, spool=None):
+        self.logger = logger
+        self.get_connection = get_connection
+        self.spool = spool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+
+        self._queues = OrderedDict()         # (table, columns) -> deque di tuple
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self._last_flush_failed = False
+        self._stats = {
+            "queued": 0,
+            "flushed_rows": 0,
+            "flushes": 0,
+            "flush_errors": 0,
+            "dropped": 0,
+            "last_flush_s": 0.0,
+        }
+        atexit.register(self.close)
+
+    # -------------------- API --------------------
+
+    def add(self, table, columns, values, timestamp=None, ts_column="timestamp"):
+        """Accoda una riga. Il timestamp di acquisizione viene aggiunto come prima colonna."""
+        ts = timestamp or datetime.now()
+        key = (table, (ts_column,) + tuple(columns))
+        row = (ts,) + tuple(values)
+
+        with self._cond:
+            self._queues.setdefault(key, deque()).append(row)
+            self._pending += 1
+            self._stats["queued"] += 1
+            if self._pending > self.max_rows:
+                self._drop_oldest()
+            if self._pending >= self.batch_size:
+                self._cond.notify()
+        self._ensure_thread()
+
+    def flush(self):
+        """Scrive tutte le righe in coda. Ritorna il numero di righe scritte."""
+        with self._flush_lock:
+            with self._cond:
+                batches = [(key, list(q)) for key, q in self._queues.items() if q]
+                self._queues.clear()
+                self._pending = 0
+            if not batches:
+                return 0
+
+            start = time.monotonic()
+            conn, cursor = self.get_connection()
+            if not conn:
+                self.logger.error("❌ [WriteBehind] DB non disponibile.")
+                self._requeue(batches)
+                self._stats["flush_errors"] += 1
+                self._last_flush_failed = True
+                return 0
+
+            written = 0
+            failed = []
+            try:
+                for (table, columns), rows in batches:
+                    placeholders = ", ".join(["%s"] * len(columns))
+                    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+                    try:
+                        cursor.executemany(query, rows)
+                        conn.commit()
+                        written += len(rows)
+                    except Exception as e:
+                        self.logger.error(f"❌ [WriteBehind] Errore durante il flush di {table}: {e}")
+                        try:
+                            conn.rollback()
+                        except Exception:
+                            pass
+                        failed.append(((table, columns), rows))
+            finally:
+                cursor.close()
+                conn.close()
+
+            if failed:
+                self._requeue(failed)
+                self._stats["flush_errors"] += 1
+            self._last_flush_failed = bool(failed)
+            if not written:
+                return 0
+            self._stats["flushes"] += 1
+            self._stats["flushed_rows"] += written
+            self._stats["last_flush_s"] = time.monotonic() - start
+            self.logger.info(f"💾 [WriteBehind] {written} righe scritte in {len(batches) - len(failed)} batch.")
+            return written
+
+    def close(self):
+        """Ferma il thread di flush e scrive le righe rimaste."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def stats(self):
+        s = dict(self._stats)
+        s["pending"] = self._pending
+        return s
+
+    # -------------------- Interni --------------------
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._cond:
+                if self._stopping or (self._thread and self._thread.is_alive()):
+                    return
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+            if self.spool is not None:
+                # Reinvia eventuali righe rimaste nello spool da esecuzioni precedenti
+                self.spool.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Dopo un flush fallito attende comunque l'intervallo (niente retry a raffica)
+                if not self._stopping and (self._pending < self.batch_size or self._last_flush_failed):
+                    self._cond.wait(timeout=self.flush_interval)
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f"❌ [WriteBehind] Errore inatteso nel flush: {e}")
+
+    def _drop_oldest(self):
+        # Chiamata con self._cond acquisito: scarta dalla coda più lunga
+        key = max(self._queues, key=lambda k: len(self._queues[k]))
+        self._queues[key].popleft()
+        self._pending -= 1
+        self._stats["dropped"] += 1
+
+    def _requeue(self, batches):
+        if self.spool is not None:
+            try:
+                self.spool.append(batches)
+                return
+            except Exception as e:
+                self.logger.error(f"❌ [WriteBehind] Spool non disponibile, righe rimesse in coda: {e}")
+        with self._cond:
+            for key, rows in reversed(batches):
+                q = self._queues.setdefault(key, deque())
+                q.extendleft(reversed(rows))
+                self._pending += len(rows)
+            while self._pending > self.max_rows:
+                self._drop_oldest()
@@ -0,0 +1,7 @@
+# Punto di ingresso WSGI per il server di produzione (gunicorn -c gunicorn.conf.py wsgi:app)
+# I worker scrivono il log su stderr (errorlog di gunicorn): il file
+# tesla_proxy.log e la sua rotazione appartengono al solo supervisor.
+from app import app, init
+
+init(log_file=False)
+application = app
\ No newline at end of file